@@ -24,6 +24,8 @@ class AccessCodeConfig:
         self.frequency_penalty = 0.5
         self.stop = ['.']
 
+        self.use_cache = False
+
         self.additional_data = None
 
         self.update(row)
@@ -46,6 +48,8 @@ class AccessCodeConfig:
 
             'engine': self.engine,
 
+            'use_cache': self.use_cache,
+
             'additional_data': self.additional_data,
         }
 
@@ -78,5 +82,8 @@ class AccessCodeConfig:
                 for token in row['stop'].split('|')
             ]
 
+        if 'use_cache' in row:
+            self.use_cache = row['use_cache'].strip().lower() in {'true', 'yes', '1'}
+
         if 'additional_data' in row and row['additional_data'] != 'na':
             self.additional_data = row['additional_data']
\ No newline at end of file
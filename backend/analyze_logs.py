@@ -0,0 +1,348 @@
+"""
+Computes statistics for all logs in a replay directory across processes.
+
+Each session becomes a row with its final text, authorship of the text, event
+counts, and suggestion acceptance, joined with its configuration in the
+metadata. Optionally, each event becomes a row in a separate table.
+
+Run the following in ./backend:
+    python3 analyze_logs.py --replay_dir ../logs --metadata_path ../logs/metadata.txt \
+        --output_dir ../analysis --events
+
+Results are written in parts under output_dir/sessions (and output_dir/events)
+as Parquet files if pyarrow is installed, or CSV files otherwise. Running the
+same command again only processes sessions that are not in output_dir yet.
+Sessions that failed are listed in output_dir/errors.csv and retried.
+"""
+
+import os
+import csv
+import glob
+import itertools
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from tqdm import tqdm
+
+from reader import read_log
+from helper import compute_stats
+from document import Document
+from log_index import LogIndex
+from metadata_store import MetadataStore, SQLiteMetadataStore
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+EVENT_NAMES = [
+    'system-initialize',
+    'text-insert', 'text-delete',
+    'cursor-backward', 'cursor-forward', 'cursor-select',
+    'suggestion-get', 'suggestion-open', 'suggestion-reopen', 'suggestion-update',
+    'suggestion-up', 'suggestion-down', 'suggestion-hover',
+    'suggestion-select', 'suggestion-close',
+    'suggestion-fail', 'skip',
+]
+
+CONFIG_KEYS = [
+    'access_code', 'domain', 'example', 'prompt', 'session_length',
+    'n', 'max_tokens', 'temperature', 'top_p', 'presence_penalty', 'frequency_penalty',
+    'stop', 'engine', 'start_timestamp',
+]
+
+EVENT_FIELDNAMES = [
+    'session_id', 'event_index', 'event_name', 'event_source',
+    'event_timestamp', 'cursor', 'text_len',
+]
+
+# Column types for Parquet (strings otherwise), so that all parts share a schema
+INT_COLUMNS = {
+    'num_events', 'text_len', 'prompt_len', 'user_len', 'api_len',
+    'config_session_length', 'config_n', 'config_max_tokens',
+    'event_index', 'event_timestamp', 'cursor',
+}
+FLOAT_COLUMNS = {
+    'duration', 'acceptance_rate', 'user_ratio', 'api_ratio',
+    'config_temperature', 'config_top_p', 'config_presence_penalty', 'config_frequency_penalty',
+    'config_start_timestamp',
+}
+
+
+def get_column_name(event_name):
+    return 'num_' + event_name.replace('-', '_')
+
+
+def analyze_session(session_id, log_path, include_events=False):
+    """Return (row, event rows) for a session."""
+    log = read_log(log_path)
+    event_counter = compute_stats(log)['eventCounter']
+
+    row = {
+        'session_id': session_id,
+        'log_path': log_path,
+        'num_events': len(log),
+    }
+    for event_name in EVENT_NAMES:
+        row[get_column_name(event_name)] = event_counter.get(event_name, 0)
+
+    # Suggestions accepted out of those shown to users
+    num_opens = event_counter.get('suggestion-open', 0) + event_counter.get('suggestion-reopen', 0)
+    num_selects = event_counter.get('suggestion-select', 0)
+    row['acceptance_rate'] = num_selects / num_opens if num_opens else None
+
+    # Skip events before initialization as in get_last_text_from_log
+    offset = 0
+    for i, event in enumerate(log):
+        if event['eventName'] == 'system-initialize':
+            offset = i
+            break
+    events = log[offset:]
+
+    # Replay the log once for the final text and the length after each event
+    prompt = events[0]['currentDoc'].strip() if events else ''
+    document = Document(prompt, 'P')
+    event_rows = []
+    for i, event in enumerate(events):
+        if 'ops' in event['textDelta']:
+            document.apply_ops(event['textDelta']['ops'], event['eventSource'])
+        if include_events:
+            event_rows.append({
+                'session_id': session_id,
+                'event_index': offset + i,
+                'event_name': event['eventName'],
+                'event_source': event['eventSource'],
+                'event_timestamp': event.get('eventTimestamp'),
+                'cursor': event.get('currentCursor'),
+                'text_len': len(document),
+            })
+    text, mask = document.get_text_and_mask()
+
+    timestamps = [event['eventTimestamp'] for event in events if event.get('eventTimestamp')]
+    row['duration'] = (max(timestamps) - min(timestamps)) / 1000 if timestamps else None  # In seconds
+
+    num_written = len(mask) - mask.count('P')
+    row['final_text'] = text
+    row['text_len'] = len(text)
+    row['prompt_len'] = mask.count('P')
+    row['user_len'] = mask.count('U')
+    row['api_len'] = mask.count('A')
+    row['user_ratio'] = mask.count('U') / num_written if num_written else None
+    row['api_ratio'] = mask.count('A') / num_written if num_written else None
+    return row, event_rows
+
+
+def analyze_session_safely(session_id, log_path, include_events=False):
+    try:
+        return analyze_session(session_id, log_path, include_events)
+    except Exception as e:
+        row = {
+            'session_id': session_id,
+            'log_path': log_path,
+            'error': f'{type(e).__name__}: {e}',
+        }
+        return row, []
+
+
+def get_config_columns(config):
+    columns = dict()
+    for key in CONFIG_KEYS:
+        value = config.get(key) if config else None
+        if isinstance(value, list):
+            value = '|'.join(value)
+        columns['config_' + key] = value
+    return columns
+
+
+def get_extension(output_format):
+    return '.parquet' if output_format == 'parquet' else '.csv'
+
+
+def write_part(rows, path, output_format, fieldnames):
+    """Write rows to a file at once, so that a part is either complete or missing."""
+    tmp_path = path + '.tmp'
+    if output_format == 'parquet':
+        schema = pyarrow.schema([
+            (fieldname, get_column_type(fieldname)) for fieldname in fieldnames
+        ])
+        table = pyarrow.Table.from_pydict({
+            fieldname: [row.get(fieldname) for row in rows] for fieldname in fieldnames
+        }, schema=schema)
+        pyarrow.parquet.write_table(table, tmp_path)
+    else:
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def get_column_type(fieldname):
+    if fieldname in INT_COLUMNS or fieldname.startswith('num_'):
+        return pyarrow.int64()
+    if fieldname in FLOAT_COLUMNS:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def read_session_ids(path, output_format):
+    if output_format == 'parquet':
+        table = pyarrow.parquet.read_table(path, columns=['session_id'])
+        return table.column('session_id').to_pylist()
+    with open(path, 'r', newline='') as f:
+        return [row['session_id'] for row in csv.DictReader(f)]
+
+
+ERROR_FIELDNAMES = ['session_id', 'log_path', 'error']
+
+
+def get_session_fieldnames():
+    fieldnames = ['session_id', 'log_path', 'num_events', 'duration']
+    fieldnames += [get_column_name(event_name) for event_name in EVENT_NAMES]
+    fieldnames += ['acceptance_rate']
+    fieldnames += ['text_len', 'prompt_len', 'user_len', 'api_len', 'user_ratio', 'api_ratio']
+    fieldnames += ['config_' + key for key in CONFIG_KEYS]
+    fieldnames += ['final_text']
+    return fieldnames
+
+
+class PartWriter:
+    """Writes results in numbered parts and keeps track of finished sessions."""
+
+    def __init__(self, output_dir, output_format, include_events):
+        self.output_format = output_format
+        self.include_events = include_events
+        self.extension = get_extension(output_format)
+
+        self.session_dir = os.path.join(output_dir, 'sessions')
+        self.error_path = os.path.join(output_dir, 'errors.csv')
+        self.event_dir = os.path.join(output_dir, 'events')
+        os.makedirs(self.session_dir, exist_ok=True)
+        if include_events:
+            os.makedirs(self.event_dir, exist_ok=True)
+
+        # Sessions in existing parts are done
+        self.done = set()
+        self.num_parts = 0
+        for path in self.get_paths(self.session_dir):
+            self.done.update(read_session_ids(path, output_format))
+            self.num_parts += 1
+
+    def get_paths(self, dir_path):
+        return sorted(glob.glob(os.path.join(dir_path, 'part-*' + self.extension)))
+
+    def write(self, rows, event_rows):
+        if not rows:
+            return
+        name = f'part-{self.num_parts:05d}' + self.extension
+
+        # Write events first, as a part of sessions marks the sessions as done
+        if self.include_events:
+            write_part(event_rows, os.path.join(self.event_dir, name), self.output_format, EVENT_FIELDNAMES)
+        write_part(rows, os.path.join(self.session_dir, name), self.output_format, get_session_fieldnames())
+
+        self.done.update(row['session_id'] for row in rows)
+        self.num_parts += 1
+
+    def write_errors(self, error_rows):
+        """Replace the list of failed sessions (which are not done, so they are retried)."""
+        if not error_rows and not os.path.exists(self.error_path):
+            return
+        write_part(error_rows, self.error_path, 'csv', ERROR_FIELDNAMES)
+
+    def merge(self, output_dir):
+        """Concatenate CSV parts into one file per table (Parquet parts can be read as a dataset)."""
+        if self.output_format != 'csv':
+            return
+        dir_paths = [self.session_dir] + ([self.event_dir] if self.include_events else [])
+        for dir_path in dir_paths:
+            path = dir_path + '.csv'
+            with open(path + '.tmp', 'w', newline='') as f:
+                for i, part_path in enumerate(self.get_paths(dir_path)):
+                    with open(part_path, 'r', newline='') as part:
+                        header = part.readline()
+                        if i == 0:
+                            f.write(header)
+                        for line in part:
+                            f.write(line)
+            os.replace(path + '.tmp', path)
+            print(f'Saved {path}')
+
+
+def get_metadata_store(args):
+    if args.metadata_db:
+        return SQLiteMetadataStore(args.metadata_db)
+    if args.metadata_path and os.path.exists(args.metadata_path):
+        return MetadataStore(args.metadata_path)
+    print('# No metadata; configurations will be empty')
+    return None
+
+
+def analyze_logs(args):
+    output_format = args.format
+    if output_format is None:
+        output_format = 'parquet' if pyarrow is not None else 'csv'
+    if output_format == 'parquet' and pyarrow is None:
+        raise RuntimeError('Install pyarrow to write Parquet files')
+
+    writer = PartWriter(args.output_dir, output_format, args.events)
+    metadata_store = get_metadata_store(args)
+
+    log_paths = LogIndex(args.replay_dir).log_paths
+    todo = [
+        (session_id, log_path) for session_id, log_path in sorted(log_paths.items())
+        if session_id not in writer.done
+    ]
+    print(f'Found {len(log_paths)} logs ({len(log_paths) - len(todo)} already analyzed)')
+
+    rows, event_rows, error_rows = [], [], []
+    num_workers = args.num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(todo)) as progress:
+        # Submit a few sessions per worker at a time so that finished results are not kept around
+        remaining = iter(todo)
+        pending = set()
+        while True:
+            for session_id, log_path in itertools.islice(remaining, num_workers * 4 - len(pending)):
+                pending.add(executor.submit(analyze_session_safely, session_id, log_path, args.events))
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                row, session_event_rows = future.result()
+                progress.update()
+                if 'error' in row:
+                    error_rows.append(row)
+                    continue
+                config = metadata_store.get(row['session_id']) if metadata_store else None
+                row.update(get_config_columns(config))
+                rows.append(row)
+                event_rows.extend(session_event_rows)
+
+                if len(rows) >= args.part_size:
+                    writer.write(rows, event_rows)
+                    rows, event_rows = [], []
+        writer.write(rows, event_rows)
+    writer.write_errors(error_rows)
+
+    if error_rows:
+        print(f'# Failed to analyze {len(error_rows)} logs (see {writer.error_path}); they are retried in the next run')
+    writer.merge(args.output_dir)
+    print(f'Analyzed {len(writer.done)} sessions in {args.output_dir}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--replay_dir', type=str, required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--metadata_path', type=str, default=None)
+    parser.add_argument('--metadata_db', type=str, default=None)
+    parser.add_argument('--events', action='store_true')  # Also write a row for each event
+    parser.add_argument('--format', type=str, choices=['csv', 'parquet'], default=None)
+    parser.add_argument('--num_workers', type=int, default=None)  # Number of CPUs by default
+    parser.add_argument('--part_size', type=int, default=1000)  # Sessions per part
+    args = parser.parse_args()
+
+    analyze_logs(args)
@@ -3,37 +3,59 @@ Starts a Flask server that handles API requests from the frontend.
 """
 
 import os
-import gc
+import json
+import itertools
+import collections
 import shutil
 import random
-import openai
 import warnings
 import numpy as np
-from time import time
+from time import time, perf_counter
 from argparse import ArgumentParser
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from reader import (
-    read_api_keys, read_log,
-    read_examples, read_prompts, read_blocklist,
-    read_access_codes, update_metadata,
-)
+from reader import read_api_key_pools, read_log, count_log_events, iter_log_lines
 from helper import (
     print_verbose, print_current_sessions,
-    get_uuid, retrieve_log_paths,
-    append_session_to_file, get_context_window_size,
-    save_log_to_jsonl, compute_stats, get_last_text_from_log, get_config_for_log,
+    get_uuid,
+    get_context_window_size,
+    compute_stats, get_last_text_from_log, get_config_for_log,
+)
+from cache import CompletionCache, DiskCompletionCache, get_cache_key
+from prefetch import PrefetchStore
+from log_writer import LogWriter
+from log_index import LogIndex
+from metadata_store import MetadataStore, SQLiteMetadataStore, create_metadata_db
+from config_registry import ConfigRegistry
+from document import get_replay_index
+from session_store import SessionStore, SQLiteSessionStore
+from singleflight import SingleFlight
+from providers import ProviderRouter
+from scheduler import Scheduler, SchedulerBusy, get_cost
+from fanout import LatencyTracker, split_n, fan_out
+from metrics import (
+    METRICS, CONTENT_TYPE, REQUEST_LATENCY, Callback,
+    start_request, set_request_labels, time_stage, track_provider_call, with_request_labels,
 )
+from streaming import ChoiceStream, SuggestionStream, format_event
+from tokenizer import preload_encodings
 from parsing import (
     parse_prompt, parse_suggestion, parse_probability,
     filter_suggestions
 )
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS, cross_origin
 
 warnings.filterwarnings("ignore", category=FutureWarning)  # noqa
 
-SESSIONS = dict()
+REPLAY_INDEXES = collections.OrderedDict()  # log_path -> (mtime, offset, replay index)
+REPLAY_INDEXES_LOCK = Lock()
+MAX_REPLAY_INDEXES = 32
+
+LOG_CHUNK_SIZE = 256  # Events sent at once by /api/stream_log
+
 app = Flask(__name__)
 CORS(app)  # For Access-Control-Allow-Origin
 
@@ -41,17 +63,44 @@ SUCCESS = True
 FAILURE = False
 
 
+@app.before_request
+def start_request_metrics():
+    g.metric_labels = start_request()
+    g.start_time = perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if request.method == 'OPTIONS' or request.endpoint in {None, 'metrics'}:
+        return response
+
+    # Record once the whole response is sent (including streamed ones)
+    endpoint, labels, start_time = request.endpoint, g.metric_labels, g.start_time
+    response.call_on_close(
+        lambda: REQUEST_LATENCY.observe(perf_counter() - start_time, endpoint=endpoint, **labels)
+    )
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(METRICS.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/api/start_session', methods=['POST'])
 @cross_origin(origin='*')
 def start_session():
-    content = request.json
+    return jsonify(handle_start_session(request.json))
+
+
+def handle_start_session(content):
     result = {}
 
-    # Read latest prompts, examples, and access codes
-    global examples, prompts
-    examples = read_examples(config_dir)
-    prompts = read_prompts(config_dir)
-    allowed_access_codes = read_access_codes(config_dir)
+    # Get latest prompts, examples, and access codes
+    configs = config_registry.get()
+    examples = configs.examples
+    prompts = configs.prompts
+    allowed_access_codes = configs.access_codes
 
     # Check access codes
     access_code = content['accessCode']
@@ -60,8 +109,8 @@ def start_session():
             access_code = '(not provided)'
         result['status'] = FAILURE
         result['message'] = f'Invalid access code: {access_code}. Please check your access code in URL.'
-        print_current_sessions(SESSIONS, 'Invalid access code')
-        return jsonify(result)
+        print_current_sessions(session_store, 'Invalid access code')
+        return result
 
     config = allowed_access_codes[access_code]
 
@@ -80,7 +129,7 @@ def start_session():
     result.update(config.convert_to_dict())
 
     # Information stored on the server
-    SESSIONS[session_id] = {
+    session = {
         'access_code': access_code,
         'session_id': session_id,
 
@@ -88,85 +137,362 @@ def start_session():
         'last_query_timestamp': time(),
         'verification_code': verification_code,
     }
-    SESSIONS[session_id].update(config.convert_to_dict())
+    session.update(config.convert_to_dict())
+    session_store.add(session)
+    set_request_labels(session)
 
     result['status'] = SUCCESS
 
-    session = SESSIONS[session_id]
     model_name = result['engine'].strip()
     domain = result['domain'] if 'domain' in result else ''
 
-    append_session_to_file(session, metadata_path)
+    metadata_store.append(session)
     print_verbose('New session created', session, verbose)
-    print_current_sessions(SESSIONS, f'Session {session_id} ({domain}: {model_name}) has been started successfully.')
-
-    gc.collect(generation=2)
-    return jsonify(result)
+    print_current_sessions(session_store, f'Session {session_id} ({domain}: {model_name}) has been started successfully.')
+    return result
 
 
 @app.route('/api/end_session', methods=['POST'])
 @cross_origin(origin='*')
 def end_session():
-    content = request.json
+    return jsonify(handle_end_session(request.json))
+
+
+def handle_end_session(content):
+    # NOTE: Somehow end_session is called twice;
+    # Save the log once for requests with the same content that arrive together
+    key = (content['sessionId'], get_cache_key(content))
+    return end_session_flight.do(key, save_session, content)
+
+
+def save_session(content):
     session_id = content['sessionId']
-    log = content['logs']
 
-    path = os.path.join(proj_dir, session_id) + '.jsonl'
+    path = get_log_path(session_id)
 
     results = {}
     results['path'] = path
     try:
-        save_log_to_jsonl(path, log)
+        if 'logs' in content:
+            # Save all logs at once
+            log = content['logs']
+            log_writer.overwrite(path, log)  # Under the same locks as appended logs
+            num_logs = log_writer.finalize(path)
+        else:
+            # Logs have been appended with /api/append_log
+            num_logs = log_writer.finalize(path)
+            if 'numLogs' in content and num_logs != int(content['numLogs']):
+                raise RuntimeError(f'Expected {content["numLogs"]} logs but found {num_logs} logs')
+        log_index.refresh()  # So that the log can be replayed right away (misses refresh less often)
         results['status'] = SUCCESS
     except Exception as e:
+        num_logs = None
         results['status'] = FAILURE
         results['message'] = str(e)
         print(e)
     print_verbose('Save log to file', {
         'session_id': session_id,
-        'len(log)': len(log),
+        'len(log)': num_logs,
         'status': results['status'],
     }, verbose)
 
-    # Remove a finished session
     try:
-        # NOTE: Somehow end_session is called twice;
-        # Do not pop session_id from SESSIONS to prevent exception
-        session = SESSIONS[session_id]
+        # Do not remove the session in case end_session is called again
+        # (it is evicted once idle)
+        session = session_store.get(session_id)
+        if session is None:
+            session = metadata_store.get(session_id)  # Evicted before saving
+        set_request_labels(session)
         results['verification_code'] = session['verification_code']
-        print_current_sessions(SESSIONS, f'Session {session_id} has been saved successfully.')
+        print_current_sessions(session_store, f'Session {session_id} has been saved successfully.')
     except Exception as e:
         print(e)
         print('# Error at the end of end_session; ignore')
         results['verification_code'] = 'SERVER_ERROR'
-        print_current_sessions(SESSIONS, f'Session {session_id} has not been saved.')
+        print_current_sessions(session_store, f'Session {session_id} has not been saved.')
+    return results
 
-    gc.collect(generation=2)
-    return jsonify(results)
+
+@app.route('/api/append_log', methods=['POST'])
+@cross_origin(origin='*')
+def append_log():
+    return jsonify(handle_append_log(request.json))
+
+
+def handle_append_log(content):
+    session_id = content['sessionId']
+    seq = int(content['seq'])  # Index of the first event in the batch
+    log = content['logs']
+
+    path = get_log_path(session_id)
+
+    results = {}
+    try:
+        results['next_seq'] = log_writer.append(path, seq, log)
+        results['status'] = SUCCESS
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        results['next_seq'] = log_writer.count(path)  # Resend from here
+        print(e)
+    return results
+
+
+def get_log_path(session_id):
+    # Use basename to prevent writing outside of the project directory
+    return os.path.join(proj_dir, os.path.basename(session_id)) + '.jsonl'
 
 
 @app.route('/api/query', methods=['POST'])
 @cross_origin(origin='*')
 def query():
-    content = request.json
+    results, params = prepare_query(request.json)
+    if params is None:
+        return jsonify(results)
+
+    # Query GPT-3 (or wait for the outputs prefetched for the same doc)
+    try:
+        response = get_prefetched(params)
+        if response is None and use_fanout(params):
+            return jsonify(fan_out_query(results, params))
+        if response is None:
+            response = get_completion_once(params)
+        suggestions = parse_choices(
+            response['choices'],
+            results['after_prompt'],
+            params['stop_rules'],
+            params['engine'],
+        )
+    except SchedulerBusy as e:
+        return get_busy_response(results, e)
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        print(e)
+        return jsonify(results)
+
+    results = build_query_results(results, params, suggestions)
+    with time_stage('serialize', params['engine']):
+        return jsonify(results)
+
+
+@app.route('/api/query_stream', methods=['POST'])
+@cross_origin(origin='*')
+def query_stream():
+    results, params = prepare_query(request.json)
+    if params is not None and scheduler.is_saturated():
+        return get_busy_response(results, SchedulerBusy(scheduler.get_retry_after()))
+    return Response(
+        stream_query(results, params),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'},
+    )
+
+
+def get_busy_response(results, error):
+    """Return 503 with Retry-After, so that users can retry later instead of waiting."""
+    results['status'] = FAILURE
+    results['message'] = str(error)
+    results['retry_after'] = error.retry_after
+    return jsonify(results), 503, {'Retry-After': str(error.retry_after)}
+
+
+def stream_query(results, params):
+    """Yield an event for each suggestion as soon as it is ready, then the results."""
+    if params is None:
+        yield format_event('done', results)
+        return
+
+    suggestion_stream = get_suggestion_stream(results, params)
+    try:
+        for choice in iter_choices(results, params):
+            suggestion_with_probability = suggestion_stream.add_choice(choice)
+            if suggestion_with_probability is not None:
+                yield format_event('suggestion', suggestion_with_probability)
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        print(e)
+        yield format_event('done', results)
+        return
+
+    results = build_stream_results(results, params, suggestion_stream)
+    yield format_event('done', results)
+
+
+def iter_choices(results, params):
+    """Yield choices in the order they are completed."""
+    response = get_prefetched(params)
+    if response is None and params['use_cache']:
+        response = completion_cache.get(params['cache_key'])
+    if response is not None:
+        yield from response['choices']
+        return
+
+    # Stream each choice separately to stop it early. Outputs cut off at the
+    # first sentence are not cached as they differ from complete ones.
+    futures = [
+        stream_executor.submit(with_request_labels(stream_choice), params, results['after_prompt'])
+        for _ in range(params['completion']['n'])
+    ]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def stream_choice(params, after_prompt):
+    """Stream a single choice from the API until its suggestion is complete."""
+    # One request per choice so that each can stop early, at the cost of sending the prompt n times
+    completion = dict(params['completion'], n=1, stream=True)
+
+    def stream(api_key):
+        choice_stream = ChoiceStream(after_prompt, params['stop_rules'])
+        chunks = providers.stream(completion, params['domain'], api_key)
+        try:
+            for chunk in chunks:
+                if choice_stream.feed(chunk['choices'][0]):
+                    break  # Stop generating the rest
+        finally:
+            chunks.close()
+        return choice_stream.get_choice()
+
+    return schedule(params, completion, stream)
+
+
+def use_fanout(params):
+    # Cached outputs are reused only for whole requests
+    return args.fanout and params['completion']['n'] > 1 and not params['use_cache']
+
+
+def fan_out_query(results, params):
+    """Query the n choices in parallel sub-requests and return once enough suggestions survive filtering."""
+    engine = params['engine']
+    parts = [
+        dict(params['completion'], n=size)
+        for size in split_n(params['completion']['n'], args.fanout_size)
+    ]
+
+    def create(part):
+        return schedule(
+            params,
+            part,
+            lambda api_key: providers.create(part, params['domain'], api_key),
+        )
+
+    suggestion_stream = get_suggestion_stream(results, params)
+    responses = fan_out(
+        stream_executor,
+        with_request_labels(create),
+        parts,
+        deadline=args.fanout_deadline,
+        hedge_delay=latency_tracker.get_percentile(engine, args.hedge_percentile),
+        on_latency=lambda latency: latency_tracker.add(engine, latency),
+    )
+    min_suggestions = min(args.fanout_min_suggestions or params['completion']['n'], params['completion']['n'])
+    try:
+        for response in responses:
+            for choice in response['choices']:
+                suggestion_stream.add_choice(choice)
+            if len(suggestion_stream.suggestions_with_probabilities) >= min_suggestions:
+                break
+    finally:
+        responses.close()
+
+    suggestion_stream.shuffle()  # Short suggestions tend to arrive first
+    return build_stream_results(results, params, suggestion_stream)
+
+
+@app.route('/api/prefetch', methods=['POST'])
+@cross_origin(origin='*')
+def prefetch():
+    results, params = prepare_query(request.json, is_prefetch=True)
+    if params is None:
+        return jsonify(results)
+
+    # Prefetches are optional, so skip them when the API is busy
+    if scheduler.is_saturated():
+        return jsonify({'status': FAILURE, 'message': 'The system is busy.'})
+
+    prefetch_store.add(
+        params['session_id'],
+        params['cache_key'],
+        lambda: prefetch_executor.submit(with_request_labels(get_completion_once), params),
+    )
+
+    return jsonify({'status': SUCCESS})
+
+
+def get_prefetched(params):
+    """Return outputs prefetched for the same query or None."""
+    future = prefetch_store.pop(params['session_id'], params['cache_key'])
+    if future is None:
+        return None
+    try:
+        return future.result()
+    except Exception as e:
+        print(f'# Ignoring a failed prefetch: {e}')
+        return None
+
+
+def get_completion_once(params):
+    """Share one API call among identical queries of a session that arrive together."""
+    key = (params['session_id'], params['cache_key'])
+    return query_flight.do(key, get_completion, params)
+
+
+def get_completion(params):
+    """Query the API, reusing cached outputs if the access code opts in."""
+    response = None
+    if params['use_cache']:
+        response = completion_cache.get(params['cache_key'])
+    if response is None:
+        response = schedule(
+            params,
+            params['completion'],
+            lambda api_key: providers.create(params['completion'], params['domain'], api_key),
+        )
+        if params['use_cache']:
+            completion_cache.set(params['cache_key'], response)
+    return response
+
+
+def schedule(params, completion, func):
+    """Call func(api_key) once the rate limits of the engine and an API key allow the completion."""
+    return scheduler.run(
+        lambda api_key: track_provider_call(completion['engine'], func, api_key),
+        completion['engine'],
+        providers.get_keys(completion['engine'], params['domain']),
+        get_cost(completion),
+        params['priority'],
+    )
+
+
+def prepare_query(content, is_prefetch=False):
+    """Parse a query request into a prompt and decoding parameters.
+
+    Return a tuple of (results, params). If the session is invalid, params is
+    None and results contains the failure message to return to the user.
+    Prefetches do not count as queries of the session.
+    """
     session_id = content['session_id']
     domain = content['domain']
     prev_suggestions = content['suggestions']
 
     results = {}
-    try:
-        SESSIONS[session_id]['last_query_timestamp'] = time()
-    except Exception as e:
-        print(f'# Ignoring an error in query: {e}')
 
     # Check if session ID is valid
-    if session_id not in SESSIONS:
+    session = session_store.get(session_id) if is_prefetch else session_store.touch(session_id)
+    if session is None:
         results['status'] = FAILURE
         results['message'] = f'Your session has not been established due to invalid access code. Please check your access code in URL.'
-        return jsonify(results)
+        return results, None
 
+    configs = config_registry.get()
     example = content['example']
-    example_text = examples[example]
+    example_text = configs.examples[example]
 
     # Overwrite example text if it is manually provided
     if 'example_text' in content:
@@ -182,6 +508,7 @@ def query():
 
     engine = content['engine'] if 'engine' in content else None
     context_window_size = get_context_window_size(engine)
+    set_request_labels(session, engine)
 
     stop = [sequence for sequence in content['stop'] if len(sequence) > 0]
     if 'DO_NOT_STOP' in stop:
@@ -195,54 +522,72 @@ def query():
 
     # Parse doc
     doc = content['doc']
-    results = parse_prompt(example_text + doc, max_tokens, context_window_size)
+    with time_stage('parse_prompt', engine):
+        results = parse_prompt(
+            example_text + doc,
+            max_tokens,
+            context_window_size,
+            engine=engine,
+            prefix=example_text,
+        )
     prompt = results['effective_prompt']
 
-    # Query GPT-3
-    try:
-        if "---" in prompt: # If the demarcation is there, then suggest an insertion
-            prompt, suffix = prompt.split("---")
-            response = openai.Completion.create(
-                engine=engine,
-                prompt=prompt,
-                suffix=suffix,
-                n=n,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                presence_penalty=presence_penalty,
-                frequency_penalty=frequency_penalty,
-                logprobs=10,
-                stop=stop_sequence,
-            )
-        else:
-            response = openai.Completion.create(
-                engine=engine,
-                prompt=prompt,
-                n=n,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                presence_penalty=presence_penalty,
-                frequency_penalty=frequency_penalty,
-                logprobs=10,
-                stop=stop_sequence,
-            )
-        suggestions = []
-        for choice in response['choices']:
+    completion = {
+        'engine': engine,
+        'prompt': prompt,
+        'n': n,
+        'max_tokens': max_tokens,
+        'temperature': temperature,
+        'top_p': top_p,
+        'presence_penalty': presence_penalty,
+        'frequency_penalty': frequency_penalty,
+        'logprobs': 10,
+        'stop': stop_sequence,
+    }
+    if "---" in prompt:  # If the demarcation is there, then suggest an insertion
+        prompt, suffix = prompt.split("---")
+        completion['prompt'] = prompt
+        completion['suffix'] = suffix
+
+    # Reuse model outputs only if the access code opts in (e.g. not for sampling studies)
+    use_cache = session.get('use_cache', False)
+
+    # Prioritize sessions that queried recently (i.e. users who are writing)
+    idle_time = time() - session.get('prev_query_timestamp', session['last_query_timestamp'])
+
+    params = {
+        'session_id': session_id,
+        'domain': domain,
+        'engine': engine,
+        'prev_suggestions': prev_suggestions,
+        'blocklist': configs.blocklist,
+        'stop': stop,
+        'stop_rules': stop_rules,
+        'completion': completion,
+        'use_cache': use_cache,
+        'cache_key': get_cache_key(completion),
+        'priority': scheduler.get_priority(idle_time, is_prefetch=is_prefetch),
+    }
+    return results, params
+
+
+def parse_choices(choices, after_prompt, stop_rules, engine):
+    """Return a list of (suggestion, probability, source) from model outputs."""
+    suggestions = []
+    with time_stage('parse_suggestion', engine):
+        for choice in choices:
             suggestion = parse_suggestion(
-                choice.text,
-                results['after_prompt'],
+                choice['text'],
+                after_prompt,
                 stop_rules
             )
-            probability = parse_probability(choice.logprobs)
+            probability = parse_probability(choice['logprobs'])
             suggestions.append((suggestion, probability, engine))
-    except Exception as e:
-        results['status'] = FAILURE
-        results['message'] = str(e)
-        print(e)
-        return jsonify(results)
+    return suggestions
+
 
+def build_query_results(results, params, suggestions):
+    """Filter suggestions and populate results returned to the user."""
     # Always return original model outputs
     original_suggestions = []
     for index, (suggestion, probability, source) in enumerate(suggestions):
@@ -254,11 +599,12 @@ def query():
         })
 
     # Filter out model outputs for safety
-    filtered_suggestions, counts = filter_suggestions(
-        suggestions,
-        prev_suggestions,
-        blocklist,
-    )
+    with time_stage('filter_suggestions', params['engine']):
+        filtered_suggestions, counts = filter_suggestions(
+            suggestions,
+            params['prev_suggestions'],
+            params['blocklist'],
+        )
 
     random.shuffle(filtered_suggestions)
 
@@ -275,37 +621,82 @@ def query():
     results['status'] = SUCCESS
     results['original_suggestions'] = original_suggestions
     results['suggestions_with_probabilities'] = suggestions_with_probabilities
-    results['ctrl'] = {
-        'n': n,
-        'max_tokens': max_tokens,
-        'temperature': temperature,
-        'top_p': top_p,
-        'presence_penalty': presence_penalty,
-        'frequency_penalty': frequency_penalty,
-        'stop': stop,
-    }
+    results['ctrl'] = get_ctrl(params)
     results['counts'] = counts
     print_verbose('Result', results, verbose)
-    return jsonify(results)
+    return results
+
+
+def get_suggestion_stream(results, params):
+    return SuggestionStream(
+        results['after_prompt'],
+        params['stop_rules'],
+        params['engine'],
+        params['prev_suggestions'],
+        params['blocklist'],
+    )
+
+
+def build_stream_results(results, params, suggestion_stream):
+    """Populate results returned to the user after all suggestions are streamed."""
+    results['status'] = SUCCESS
+    results['original_suggestions'] = suggestion_stream.original_suggestions
+    results['suggestions_with_probabilities'] = suggestion_stream.suggestions_with_probabilities
+    results['ctrl'] = get_ctrl(params)
+    results['counts'] = suggestion_stream.counts
+    print_verbose('Result', results, verbose)
+    return results
+
+
+def get_ctrl(params):
+    completion = params['completion']
+    return {
+        'n': completion['n'],
+        'max_tokens': completion['max_tokens'],
+        'temperature': completion['temperature'],
+        'top_p': completion['top_p'],
+        'presence_penalty': completion['presence_penalty'],
+        'frequency_penalty': completion['frequency_penalty'],
+        'stop': params['stop'],
+    }
+
+
+@app.route('/api/cache_stats', methods=['GET'])
+@cross_origin(origin='*')
+def cache_stats():
+    stats = completion_cache.get_stats()
+    stats['prefetch'] = prefetch_store.get_stats()
+    stats['coalesced'] = query_flight.get_stats()
+    stats['scheduler'] = scheduler.get_stats()
+    return jsonify(stats)
 
 
 @app.route('/api/get_log', methods=['POST'])
 @cross_origin(origin='*')
 def get_log():
+    return handle_get_log(request.json)
+
+
+def handle_get_log(content):
+    """Return events in [start, end) of a log (all by default).
+
+    Stats and the last text need the whole log, so they are only computed if
+    withStats is not false (see also /api/get_log_stats).
+    """
     results = dict()
 
-    content = request.json
     session_id = content['sessionId']
     domain = content['domain'] if 'domain' in content else None
-
-    # Retrieve the latest list of logs
-    log_paths = retrieve_log_paths(args.replay_dir)
+    with_stats = content.get('withStats', True)
 
     try:
-        log_path = log_paths[session_id]
-        log = read_log(log_path)
+        start, end = get_log_range(content)
+        log_path = log_index.get(session_id)
+        log = read_log(log_path, start, end)
         results['status'] = SUCCESS
         results['logs'] = log
+        results['start'] = start
+        results['num_events'] = count_log_events(log_path)
     except Exception as e:
         results['status'] = FAILURE
         results['message'] = str(e)
@@ -313,29 +704,176 @@ def get_log():
     if results['status'] == FAILURE:
         return results
 
-    # Populate metadata
+    if with_stats:
+        if start > 0 or end is not None:
+            log = read_log(log_path)
+        results.update(get_log_metadata(session_id, log))
+    else:
+        results['config'] = get_log_config(session_id)
+
+    print_verbose('Get log', results, verbose)
+    return results
+
+
+def get_log_range(content):
+    """Return (start, end) of events requested in content (end is None for all events)."""
+    try:
+        start = max(int(content.get('start') or 0), 0)
+        end = content.get('end')
+        end = None if end is None else int(end)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid range of events: {content.get("start")} to {content.get("end")}')
+    if end is not None and end < 0:
+        end = None  # As in the replay page
+    return start, end
+
+
+def get_log_config(session_id):
+    try:
+        config = get_config_for_log(session_id, metadata_store)
+        set_request_labels(config)
+    except Exception as e:
+        print(f'# Failed to retrieve metadata for the log: {e}')
+        config = None
+    return config
+
+
+def get_log_metadata(session_id, log):
+    """Return stats, config, and the last text of a whole log."""
     try:
         stats = compute_stats(log)
         last_text = get_last_text_from_log(log)
-        config = get_config_for_log(
-            session_id,
-            metadata,
-            metadata_path
-        )
     except Exception as e:
-        print(f'# Failed to retrieve metadata for the log: {e}')
+        print(f'# Failed to compute stats for the log: {e}')
         stats = None
         last_text = None
-        config = None
-    results['stats'] = stats
-    results['config'] = config
-    results['last_text'] = last_text
+    return {
+        'stats': stats,
+        'config': get_log_config(session_id),
+        'last_text': last_text,
+    }
 
-    print_verbose('Get log', results, verbose)
+
+@app.route('/api/get_log_stats', methods=['POST'])
+@cross_origin(origin='*')
+def get_log_stats():
+    return handle_get_log_stats(request.json)
+
+
+def handle_get_log_stats(content):
+    """Return stats, config, and the last text of a log without its events."""
+    results = dict()
+
+    session_id = content['sessionId']
+    try:
+        log_path = log_index.get(session_id)
+        log = read_log(log_path)
+        results['status'] = SUCCESS
+        results['num_events'] = len(log)
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        return results
+
+    results.update(get_log_metadata(session_id, log))
     return results
 
 
-if __name__ == '__main__':
+@app.route('/api/stream_log', methods=['POST'])
+@cross_origin(origin='*')
+def stream_log():
+    results, lines = prepare_stream_log(request.json)
+    return Response(get_log_chunks(results, lines), mimetype='application/x-ndjson')
+
+
+def prepare_stream_log(content):
+    """Return (results, iterator of events as JSON strings) for a streamed log.
+
+    The results are sent as the first line, followed by a line for each event
+    in [start, end), which are read from the file as they are sent.
+    """
+    results = dict()
+
+    session_id = content['sessionId']
+    try:
+        start, end = get_log_range(content)
+        log_path = log_index.get(session_id)
+        results['num_events'] = count_log_events(log_path)
+        results['start'] = start
+        results['status'] = SUCCESS
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        return results, None
+    return results, iter_log_lines(log_path, start, end)
+
+
+def get_log_chunks(results, lines):
+    """Yield the results and then chunks of up to LOG_CHUNK_SIZE events, one per line."""
+    yield json.dumps(results) + '\n'
+    if lines is None:
+        return
+    try:
+        while True:
+            chunk = list(itertools.islice(lines, LOG_CHUNK_SIZE))
+            if not chunk:
+                break
+            yield '\n'.join(chunk) + '\n'
+    finally:
+        lines.close()  # Close the log file if the client went away
+
+
+@app.route('/api/get_doc_at', methods=['POST'])
+@cross_origin(origin='*')
+def get_doc_at():
+    return jsonify(handle_get_doc_at(request.json))
+
+
+def handle_get_doc_at(content):
+    """Return the text and mask after applying events before eventIndex."""
+    results = dict()
+
+    session_id = content['sessionId']
+    event_index = int(content['eventIndex'])
+
+    try:
+        log_path = log_index.get(session_id)
+        offset, replay_index = load_replay_index(log_path)
+        text, mask = replay_index.get_text_and_mask(event_index - offset)
+        results['status'] = SUCCESS
+        results['text'] = text
+        results['mask'] = mask
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+    return results
+
+
+def load_replay_index(log_path):
+    """Return (offset, replay index) for a log, keeping recently used ones in memory."""
+    mtime = os.path.getmtime(log_path)
+    with REPLAY_INDEXES_LOCK:
+        if log_path in REPLAY_INDEXES and REPLAY_INDEXES[log_path][0] == mtime:
+            REPLAY_INDEXES.move_to_end(log_path)
+            return REPLAY_INDEXES[log_path][1:]
+
+    # Skip events before initialization as in get_last_text_from_log
+    log = read_log(log_path)
+    offset = 0
+    for i, event in enumerate(log):
+        if event['eventName'] == 'system-initialize':
+            offset = i
+            break
+    replay_index = get_replay_index(log_path, log[offset:])
+
+    with REPLAY_INDEXES_LOCK:
+        REPLAY_INDEXES[log_path] = (mtime, offset, replay_index)
+        while len(REPLAY_INDEXES) > MAX_REPLAY_INDEXES:
+            REPLAY_INDEXES.popitem(last=False)
+    return offset, replay_index
+
+
+def get_parser():
     parser = ArgumentParser()
 
     # Required arguments
@@ -352,8 +890,76 @@ if __name__ == '__main__':
 
     parser.add_argument('--use_blocklist', action='store_true')
 
+    parser.add_argument('--session_ttl', type=int, default=86400)  # Evict sessions idle for this long (in seconds)
+    parser.add_argument('--max_sessions', type=int, default=100000)
+    parser.add_argument('--session_db', type=str, default=None)  # Share sessions across processes with SQLite
+
+    parser.add_argument('--cache_size', type=int, default=1024)
+    parser.add_argument('--cache_ttl', type=int, default=3600)  # In seconds
+    parser.add_argument('--cache_dir', type=str, default=None)  # Keep cache on disk if provided
+    parser.add_argument('--cache_disk_size', type=int, default=100000)  # Files kept in --cache_dir
+
+    parser.add_argument('--metadata_db', type=str, default=None)  # Use SQLite instead of metadata.txt
+
+    parser.add_argument('--fsync_interval', type=int, default=5)  # In seconds
+
+    parser.add_argument('--prefetch_workers', type=int, default=8)
+    parser.add_argument('--prefetch_ttl', type=int, default=60)  # In seconds
+
+    parser.add_argument('--stream_workers', type=int, default=64)  # Choices streamed (or fanned out) at once
+
+    parser.add_argument('--pool_size', type=int, default=64)  # Keep-alive connections to each model API
+    parser.add_argument('--api_base', type=str, default=None)  # OpenAI-compatible API (e.g. mock_provider.py for load tests)
+
+    parser.add_argument('--key_tpm', type=int, default=250000)  # Tokens per minute for each API key
+    parser.add_argument('--engine_tpm', type=int, default=None)  # Tokens per minute for each engine
+    parser.add_argument('--max_queue', type=int, default=256)  # Queries waiting for the rate limits
+    parser.add_argument('--max_queue_wait', type=int, default=10)  # In seconds
+    parser.add_argument('--max_retries', type=int, default=3)  # Retries on 429
+
+    parser.add_argument('--fanout', action='store_true')  # Split n into parallel requests for /api/query
+    parser.add_argument('--fanout_size', type=int, default=1)  # Choices per request
+    parser.add_argument('--fanout_min_suggestions', type=int, default=None)  # Return once this many survive filtering (default: n)
+    parser.add_argument('--fanout_deadline', type=float, default=5.0)  # In seconds
+    parser.add_argument('--hedge_percentile', type=float, default=95)  # Resend requests slower than this
+    return parser
+
+
+def register_metrics():
+    METRICS.register(Callback(
+        'sessions', 'Sessions in the session store.',
+        lambda: len(session_store),
+    ))
+    METRICS.register(Callback(
+        'active_sessions', 'Sessions that queried in the last 15 minutes.',
+        session_store.count_active,
+    ))
+    METRICS.register(Callback(
+        'scheduler_queued', 'Requests waiting for the rate limits of model APIs.',
+        lambda: scheduler.get_stats()['queued'],
+    ))
+    METRICS.register(Callback(
+        'scheduler_rejected_total', 'Requests rejected with 503 as the queue was full or too slow.',
+        lambda: scheduler.num_rejected, 'counter',
+    ))
+    METRICS.register(Callback(
+        'scheduler_retried_total', 'Requests retried after 429 from model APIs.',
+        lambda: scheduler.num_retried, 'counter',
+    ))
+    METRICS.register(Callback(
+        'cache_hits_total', 'Model outputs reused from the cache.',
+        lambda: completion_cache.hits, 'counter',
+    ))
+    METRICS.register(Callback(
+        'prefetch_hits_total', 'Queries answered with prefetched outputs.',
+        lambda: prefetch_store.hits, 'counter',
+    ))
+
+
+def setup(_args):
+    """Read configurations and prepare directories shared by all requests."""
     global args
-    args = parser.parse_args()
+    args = _args
 
     # Create a project directory to store logs
     global config_dir, proj_dir
@@ -364,41 +970,106 @@ if __name__ == '__main__':
     if not os.path.exists(proj_dir):
         os.mkdir(proj_dir)
 
-    # Create a text file for storing metadata
-    global metadata_path
+    # Keep sessions in memory (or SQLite if provided) until they are idle for a while
+    global session_store
+    if args.session_db:
+        session_store = SQLiteSessionStore(args.session_db, ttl=args.session_ttl, max_sessions=args.max_sessions)
+    else:
+        session_store = SessionStore(ttl=args.session_ttl, max_sessions=args.max_sessions)
+
+    # Append logs to files while users are writing
+    global log_writer
+    log_writer = LogWriter(fsync_interval=args.fsync_interval, idle_ttl=args.session_ttl)
+
+    # Store metadata in a text file (or SQLite database if provided)
+    global metadata_store
     metadata_path = os.path.join(args.log_dir, 'metadata.txt')
-    if not os.path.exists(metadata_path):
-        with open(metadata_path, 'w') as f:
-            f.write('')
-
-    # Read and set API keys
-    global api_keys
-    api_keys = read_api_keys(config_dir)
-    openai.api_key = api_keys[('openai', 'default')]
-
-    # Read examples (hidden prompts), prompts, and a blocklist
-    global examples, prompts, blocklist
-    examples = read_examples(config_dir)
-    prompts = read_prompts(config_dir)
-    blocklist = []
-    if args.use_blocklist:
-        blocklist = read_blocklist(config_dir)
-        print(f' # Using a blocklist: {len(blocklist)}')
-
-    # Read access codes
-    global allowed_access_codes
-    allowed_access_codes = read_access_codes(config_dir)
-
-    global session_id_history
-    metadata = dict()
-    metadata = update_metadata(
-        metadata,
-        metadata_path
+    if args.metadata_db:
+        # Keep the metadata of earlier sessions when switching to SQLite
+        if not os.path.exists(args.metadata_db) and os.path.exists(metadata_path):
+            num_sessions = create_metadata_db(args.metadata_db, metadata_path)
+            print(f'Imported {num_sessions} lines from {metadata_path} to {args.metadata_db}')
+        metadata_store = SQLiteMetadataStore(args.metadata_db)
+    else:
+        metadata_store = MetadataStore(metadata_path)
+
+    # Route queries to model APIs by engine, using the API keys for each domain in turn
+    global providers
+    providers = ProviderRouter(
+        read_api_key_pools(config_dir),
+        pool_size=args.pool_size,
+        options={'openai': {'api_base': args.api_base}},
     )
 
+    # Queue queries within the rate limits of the APIs
+    global scheduler
+    scheduler = Scheduler(
+        key_tpm=args.key_tpm,
+        engine_tpm=args.engine_tpm,
+        max_queue=args.max_queue,
+        max_wait=args.max_queue_wait,
+        max_retries=args.max_retries,
+    )
+
+    # Read examples (hidden prompts), prompts, access codes, and a blocklist
+    # (reloaded when changed)
+    global config_registry
+    config_registry = ConfigRegistry(config_dir, use_blocklist=args.use_blocklist)
+
+    # Load (or download) tokenizers before serving requests rather than in the first query
+    engines = sorted(set(config.engine for config in config_registry.get().access_codes.values()))
+    print(f' # Tokenizers loaded for {preload_encodings(engines)} of {engines}')
+
+    # Create a cache for model outputs (used only by access codes with use_cache)
+    global completion_cache
+    if args.cache_dir:
+        completion_cache = DiskCompletionCache(
+            args.cache_dir,
+            max_size=args.cache_size,
+            ttl=args.cache_ttl,
+            max_disk_size=args.cache_disk_size,
+        )
+    else:
+        completion_cache = CompletionCache(
+            max_size=args.cache_size,
+            ttl=args.cache_ttl,
+        )
+
+    # Keep outputs requested in advance while users pause typing
+    global prefetch_store, prefetch_executor
+    prefetch_store = PrefetchStore(ttl=args.prefetch_ttl)
+    prefetch_executor = ThreadPoolExecutor(max_workers=args.prefetch_workers)
+
+    # Coalesce duplicate queries and saves in flight (e.g. on retries)
+    global query_flight, end_session_flight
+    query_flight = SingleFlight()
+    end_session_flight = SingleFlight()
+
+    # Stream choices in parallel for /api/query_stream (or send parts of
+    # queries in parallel with --fanout)
+    global stream_executor
+    stream_executor = ThreadPoolExecutor(max_workers=args.stream_workers)
+
+    # Resend parts of queries slower than most recent ones
+    global latency_tracker
+    latency_tracker = LatencyTracker()
+
+    # Expose the state of sessions, the scheduler, and the cache at /metrics
+    register_metrics()
+
+    # Index logs for replay (updated as new logs are saved)
+    global log_index
+    log_index = LogIndex(args.replay_dir)
+    print(f' # Indexed logs for replay: {len(log_index)}')
+
     global verbose
     verbose = args.verbose
 
+
+if __name__ == '__main__':
+    parser = get_parser()
+    setup(parser.parse_args())
+
     app.run(
         host='0.0.0.0',
         port=args.port,
@@ -0,0 +1,434 @@
+"""
+Starts an asyncio (aiohttp) server that handles the same API requests as
+api_server.py without pinning a worker thread to each in-flight completion.
+
+Run it with the same arguments as api_server.py, e.g.
+    python3 async_server.py --config_dir ../config --log_dir ../logs \
+        --port 5555 --proj_name pilot --max_concurrency 64
+"""
+
+import asyncio
+import functools
+import contextvars
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web, ClientSession, TCPConnector
+
+import api_server
+from api_server import (
+    SUCCESS, FAILURE,
+    get_parser, setup,
+    handle_start_session, handle_end_session, handle_append_log,
+    handle_get_log, handle_get_log_stats, handle_get_doc_at,
+    prepare_stream_log, get_log_chunks,
+    prepare_query, parse_choices, build_query_results, use_fanout,
+    get_suggestion_stream, build_stream_results,
+)
+from scheduler import SchedulerBusy, get_cost
+from fanout import split_n, afan_out
+from metrics import (
+    METRICS, CONTENT_TYPE, REQUEST_LATENCY,
+    start_request, time_stage, atrack_provider_call,
+)
+from streaming import ChoiceStream, format_event
+from singleflight import AsyncSingleFlight
+
+
+@web.middleware
+async def cors_middleware(request, handler):
+    """Equivalent of flask_cors with origin='*' (including preflight)."""
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    if not response.prepared:  # Streamed responses set them before sending
+        set_cors_headers(response)
+    return response
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Record the latency of each request (including streamed ones) as in api_server.py."""
+    # Label by route name like the endpoint in Flask, and skip unknown paths (e.g. 404s)
+    endpoint = request.match_info.route.name
+    if request.method == 'OPTIONS' or endpoint in {None, 'metrics'} or request.match_info.http_exception is not None:
+        return await handler(request)
+
+    labels = start_request()
+    start_time = perf_counter()
+    try:
+        return await handler(request)
+    finally:
+        REQUEST_LATENCY.observe(perf_counter() - start_time, endpoint=endpoint, **labels)
+
+
+def set_cors_headers(response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Accept'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+
+
+async def run_blocking(request, func, *func_args):
+    """Run a blocking function (file I/O, NLTK) in the worker pool."""
+    return await run_in_pool(request.app, func, *func_args)
+
+
+async def run_in_pool(app, func, *func_args):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()  # So that handlers can label metrics of the request
+    return await loop.run_in_executor(app['executor'], functools.partial(context.run, func, *func_args))
+
+
+async def start_session(request):
+    content = await request.json()
+    result = await run_blocking(request, handle_start_session, content)
+    return web.json_response(result)
+
+
+async def end_session(request):
+    content = await request.json()
+    results = await run_blocking(request, handle_end_session, content)
+    return web.json_response(results)
+
+
+async def append_log(request):
+    content = await request.json()
+    results = await run_blocking(request, handle_append_log, content)
+    return web.json_response(results)
+
+
+async def get_log(request):
+    content = await request.json()
+    results = await run_blocking(request, handle_get_log, content)
+    return web.json_response(results)
+
+
+async def get_log_stats(request):
+    content = await request.json()
+    results = await run_blocking(request, handle_get_log_stats, content)
+    return web.json_response(results)
+
+
+async def stream_log(request):
+    """Send a log in chunks as in api_server.py, reading each chunk in the worker pool."""
+    content = await request.json()
+    results, lines = await run_blocking(request, prepare_stream_log, content)
+    chunks = get_log_chunks(results, lines)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    set_cors_headers(response)
+    await response.prepare(request)
+    read = None
+    try:
+        while True:
+            # Shielded so that a read in progress can be waited for if the client goes away
+            read = asyncio.ensure_future(run_blocking(request, next, chunks, None))
+            chunk = await asyncio.shield(read)
+            if chunk is None:
+                break
+            await response.write(chunk.encode())
+    finally:
+        if read is not None and not read.done():
+            await asyncio.wait([read])  # A generator cannot be closed while it runs
+        chunks.close()  # Close the log file
+    return response
+
+
+async def prefetch(request):
+    content = await request.json()
+    results, params = await run_blocking(request, functools.partial(prepare_query, is_prefetch=True), content)
+    if params is None:
+        return web.json_response(results)
+
+    # Prefetches are optional, so skip them when the API is busy
+    if api_server.scheduler.is_saturated():
+        return web.json_response({'status': FAILURE, 'message': 'The system is busy.'})
+
+    api_server.prefetch_store.add(
+        params['session_id'],
+        params['cache_key'],
+        lambda: asyncio.ensure_future(get_completion_once(request.app, params)),
+    )
+
+    return web.json_response({'status': SUCCESS})
+
+
+async def get_completion_once(app, params):
+    """Share one API call among identical queries of a session that arrive together."""
+    key = (params['session_id'], params['cache_key'])
+    return await app['query_flight'].do(key, get_completion, app, params)
+
+
+async def get_completion(app, params):
+    """Query the API, reusing cached outputs if the access code opts in."""
+    response = None
+    if params['use_cache']:
+        # Cached outputs may be read from disk (--cache_dir)
+        response = await run_in_pool(app, api_server.completion_cache.get, params['cache_key'])
+    if response is None:
+        async def create(api_key):
+            async with app['semaphore']:
+                return await api_server.providers.acreate(
+                    params['completion'],
+                    app['client_session'],
+                    params['domain'],
+                    api_key,
+                )
+
+        response = await schedule(params, params['completion'], create)
+        if params['use_cache']:
+            await run_in_pool(app, api_server.completion_cache.set, params['cache_key'], response)
+    return response
+
+
+async def schedule(params, completion, func):
+    """Await func(api_key) once the rate limits of the engine and an API key allow the completion."""
+    return await api_server.scheduler.arun(
+        lambda api_key: atrack_provider_call(completion['engine'], func, api_key),
+        completion['engine'],
+        api_server.providers.get_keys(completion['engine'], params['domain']),
+        get_cost(completion),
+        params['priority'],
+    )
+
+
+def get_busy_response(results, error):
+    results['status'] = FAILURE
+    results['message'] = str(error)
+    results['retry_after'] = error.retry_after
+    return web.json_response(results, status=503, headers={'Retry-After': str(error.retry_after)})
+
+
+async def cache_stats(request):
+    stats = api_server.completion_cache.get_stats()
+    stats['prefetch'] = api_server.prefetch_store.get_stats()
+    stats['coalesced'] = request.app['query_flight'].get_stats()
+    stats['scheduler'] = api_server.scheduler.get_stats()
+    return web.json_response(stats)
+
+
+async def metrics(request):
+    return web.Response(body=METRICS.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def get_doc_at(request):
+    content = await request.json()
+    results = await run_blocking(request, handle_get_doc_at, content)
+    return web.json_response(results)
+
+
+async def query(request):
+    content = await request.json()
+    results, params = await run_blocking(request, prepare_query, content)
+    if params is None:
+        return web.json_response(results)
+
+    # Query GPT-3 (or wait for the outputs prefetched for the same doc)
+    try:
+        response = await get_prefetched(params)
+        if response is None and use_fanout(params):
+            return web.json_response(await fan_out_query(request, results, params))
+        if response is None:
+            response = await get_completion_once(request.app, params)
+        suggestions = await run_blocking(
+            request,
+            parse_choices,
+            response['choices'],
+            results['after_prompt'],
+            params['stop_rules'],
+            params['engine'],
+        )
+    except SchedulerBusy as e:
+        return get_busy_response(results, e)
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        print(e)
+        return web.json_response(results)
+
+    results = await run_blocking(request, build_query_results, results, params, suggestions)
+    with time_stage('serialize', params['engine']):
+        return web.json_response(results)
+
+
+async def fan_out_query(request, results, params):
+    """Query the n choices in parallel sub-requests and return once enough suggestions survive filtering."""
+    app = request.app
+    args = api_server.args
+    engine = params['engine']
+    latency_tracker = api_server.latency_tracker
+    parts = [
+        dict(params['completion'], n=size)
+        for size in split_n(params['completion']['n'], args.fanout_size)
+    ]
+
+    async def create(part):
+        async def create_with_key(api_key):
+            async with app['semaphore']:
+                return await api_server.providers.acreate(part, app['client_session'], params['domain'], api_key)
+        return await schedule(params, part, create_with_key)
+
+    suggestion_stream = get_suggestion_stream(results, params)
+    responses = afan_out(
+        create,
+        parts,
+        deadline=args.fanout_deadline,
+        hedge_delay=latency_tracker.get_percentile(engine, args.hedge_percentile),
+        on_latency=lambda latency: latency_tracker.add(engine, latency),
+    )
+    min_suggestions = min(args.fanout_min_suggestions or params['completion']['n'], params['completion']['n'])
+    try:
+        async for response in responses:
+            for choice in response['choices']:
+                await run_blocking(request, suggestion_stream.add_choice, choice)
+            if len(suggestion_stream.suggestions_with_probabilities) >= min_suggestions:
+                break
+    finally:
+        await responses.aclose()
+
+    suggestion_stream.shuffle()  # Short suggestions tend to arrive first
+    return await run_blocking(request, build_stream_results, results, params, suggestion_stream)
+
+
+async def query_stream(request):
+    content = await request.json()
+    results, params = await run_blocking(request, prepare_query, content)
+    if params is not None and api_server.scheduler.is_saturated():
+        return get_busy_response(results, SchedulerBusy(api_server.scheduler.get_retry_after()))
+
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+    set_cors_headers(response)
+    await response.prepare(request)
+
+    if params is None:
+        await response.write(format_event('done', results).encode())
+        return response
+
+    suggestion_stream = get_suggestion_stream(results, params)
+    try:
+        async for choice in iter_choices(request.app, results, params):
+            suggestion_with_probability = await run_blocking(
+                request,
+                suggestion_stream.add_choice,
+                choice,
+            )
+            if suggestion_with_probability is not None:
+                await response.write(format_event('suggestion', suggestion_with_probability).encode())
+    except Exception as e:
+        results['status'] = FAILURE
+        results['message'] = str(e)
+        print(e)
+        await response.write(format_event('done', results).encode())
+        return response
+
+    results = await run_blocking(request, build_stream_results, results, params, suggestion_stream)
+    await response.write(format_event('done', results).encode())
+    return response
+
+
+async def iter_choices(app, results, params):
+    """Yield choices in the order they are completed."""
+    response = await get_prefetched(params)
+    if response is None and params['use_cache']:
+        response = await run_in_pool(app, api_server.completion_cache.get, params['cache_key'])
+    if response is not None:
+        for choice in response['choices']:
+            yield choice
+        return
+
+    # Stream each choice separately to stop it early. Outputs cut off at the
+    # first sentence are not cached as they differ from complete ones.
+    tasks = [
+        asyncio.ensure_future(stream_choice(app, params, results['after_prompt']))
+        for _ in range(params['completion']['n'])
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def stream_choice(app, params, after_prompt):
+    """Stream a single choice from the API until its suggestion is complete."""
+    # One request per choice so that each can stop early, at the cost of sending the prompt n times
+    completion = dict(params['completion'], n=1, stream=True)
+
+    async def stream(api_key):
+        choice_stream = ChoiceStream(after_prompt, params['stop_rules'])
+        async with app['semaphore']:
+            chunks = api_server.providers.astream(completion, app['client_session'], params['domain'], api_key)
+            try:
+                async for chunk in chunks:
+                    if choice_stream.feed(chunk['choices'][0]):
+                        break  # Stop generating the rest
+            finally:
+                await chunks.aclose()
+        return choice_stream.get_choice()
+
+    return await schedule(params, completion, stream)
+
+
+async def get_prefetched(params):
+    """Return outputs prefetched for the same query or None."""
+    task = api_server.prefetch_store.pop(params['session_id'], params['cache_key'])
+    if task is None:
+        return None
+    try:
+        return await task
+    except Exception as e:
+        print(f'# Ignoring a failed prefetch: {e}')
+        return None
+
+
+async def on_startup(app):
+    # Reuse one connection pool for all requests to model APIs
+    connector = TCPConnector(limit=api_server.args.pool_size)
+    app['client_session'] = ClientSession(connector=connector)
+
+
+async def on_cleanup(app):
+    await app['client_session'].close()
+    app['executor'].shutdown(wait=False)
+
+
+def create_app(max_concurrency, num_workers):
+    app = web.Application(middlewares=[cors_middleware, metrics_middleware])
+
+    # Limit the number of concurrent requests to the API
+    app['semaphore'] = asyncio.Semaphore(max_concurrency)
+    app['executor'] = ThreadPoolExecutor(max_workers=num_workers)
+    app['query_flight'] = AsyncSingleFlight()
+
+    app.router.add_post('/api/start_session', start_session, name='start_session')
+    app.router.add_post('/api/end_session', end_session, name='end_session')
+    app.router.add_post('/api/append_log', append_log, name='append_log')
+    app.router.add_post('/api/query', query, name='query')
+    app.router.add_post('/api/query_stream', query_stream, name='query_stream')
+    app.router.add_post('/api/prefetch', prefetch, name='prefetch')
+    app.router.add_post('/api/get_log', get_log, name='get_log')
+    app.router.add_post('/api/get_log_stats', get_log_stats, name='get_log_stats')
+    app.router.add_post('/api/stream_log', stream_log, name='stream_log')
+    app.router.add_post('/api/get_doc_at', get_doc_at, name='get_doc_at')
+    app.router.add_get('/api/cache_stats', cache_stats, name='cache_stats')
+    app.router.add_get('/metrics', metrics, name='metrics')
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    parser = get_parser()
+    parser.add_argument('--max_concurrency', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+    setup(args)
+
+    app = create_app(args.max_concurrency, args.num_workers)
+    web.run_app(app, host='0.0.0.0', port=args.port)
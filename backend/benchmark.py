@@ -0,0 +1,435 @@
+"""
+Benchmarks hot paths in the backend.
+
+Each benchmark runs on synthetic inputs generated with fixed seeds (including
+a directory of logs and a metadata file in a temporary directory), so results
+are reproducible offline. The time per call is the best of --repeat runs.
+Run the following in ./backend:
+    python3 benchmark.py --output baseline.json
+    python3 benchmark.py --baseline baseline.json  # Exits with 1 on regressions
+
+Benchmarks can be selected by a prefix of their names (e.g. --only parse_).
+With --compare, the blocklist matcher and the first sentence detector are also
+compared with the implementations they replaced.
+"""
+
+import os
+import sys
+import json
+import random
+import timeit
+import platform
+import tempfile
+from argparse import ArgumentParser
+
+from nltk.tokenize import word_tokenize, sent_tokenize
+
+from reader import read_blocklist, update_metadata
+from blocklist import BlocklistMatcher
+from parsing import parse_prompt, parse_suggestion, filter_suggestions, FirstSentenceDetector
+from helper import apply_ops, get_text_and_mask, retrieve_log_paths, get_context_window_size
+from document import Document
+from log_index import LogIndex
+from tokenizer import get_encoding
+
+
+WORDS = (
+    'the a pig wolf house built out of straw sticks bricks and ran away to '
+    'find his brothers who were waiting by the river for him because it was late'
+).split()
+
+
+def generate_suggestions(num_suggestions, seed=0):
+    rng = random.Random(seed)
+    suggestions = []
+    for _ in range(num_suggestions):
+        num_words = rng.randint(5, 30)
+        suggestions.append(' ' + ' '.join(rng.choice(WORDS) for _ in range(num_words)) + '.')
+    return suggestions
+
+
+def generate_texts(num_texts, seed=0):
+    """Generate multi-sentence texts with abbreviations, quotes, and newlines."""
+    rng = random.Random(seed)
+    separators = ['. ', '. ', '? ', '! ', '.\n', '\n\n', ' Mr. ', ' e.g. ', '." ', '...', ' ']
+    texts = []
+    for _ in range(num_texts):
+        text = rng.choice(['', ' ', '  ', '\n'])
+        for _ in range(rng.randint(1, 8)):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(1, 12))]
+            if rng.random() < 0.5:
+                words[0] = words[0].capitalize()
+            text += ' '.join(words) + rng.choice(separators)
+        texts.append(text)
+    return texts
+
+
+def generate_blocklist(size, seed=0):
+    """Generate made-up words and a few phrases that do not appear in WORDS."""
+    rng = random.Random(seed)
+    blocklist = set()
+    while len(blocklist) < size:
+        word = ''.join(rng.choice('bcdfghjklmnpqrstvwxz') + rng.choice('aeiou') for _ in range(rng.randint(2, 4)))
+        if rng.random() < 0.1:
+            word += ' ' + rng.choice(WORDS)
+        blocklist.add(word)
+    return sorted(blocklist)
+
+
+def generate_session(num_events, seed=0):
+    """Generate events of a long session with edits at random positions, like a log."""
+    rng = random.Random(seed)
+    prompt = ' '.join(rng.choice(WORDS) for _ in range(50)) + '.'
+    events = [{
+        'eventName': 'system-initialize',
+        'eventSource': 'api',
+        'eventTimestamp': 0,
+        'textDelta': '',
+        'currentDoc': prompt,
+        'currentCursor': len(prompt),
+    }]
+    length = len(prompt)
+    for i in range(1, num_events):
+        position = length if rng.random() < 0.8 else rng.randint(0, length)  # Mostly at the end
+        ops = [{'retain': position}] if position else []
+        value = rng.random()
+        if value < 0.1 and position < length:
+            num_chars = min(rng.randint(1, 10), length - position)
+            ops.append({'delete': num_chars})
+            event_name, source = 'text-delete', 'user'
+            length -= num_chars
+        else:
+            if value < 0.15:  # An accepted suggestion
+                text = ' ' + ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 15))) + '.'
+                event_name, source = 'suggestion-select', 'api'
+            else:
+                text = rng.choice(WORDS + ['. ', ', ', '\n']) + ' '
+                event_name, source = 'text-insert', 'user'
+            ops.append({'insert': text})
+            length += len(text)
+        events.append({
+            'eventName': event_name,
+            'eventSource': source,
+            'eventTimestamp': i * 100,
+            'textDelta': {'ops': ops},
+            'currentDoc': '',
+            'currentCursor': position,
+        })
+    return events
+
+
+def generate_session_id(rng):
+    return '%032x' % rng.getrandbits(128)
+
+
+def generate_log_dir(log_dir, num_logs, seed=0):
+    """Write small logs in nested directories like a replay directory (with some .json duplicates)."""
+    rng = random.Random(seed)
+    line = json.dumps(generate_session(1)[0]) + '\n'
+    for i in range(num_logs):
+        dir_path = os.path.join(log_dir, f'study_{i % 10}', f'part_{i % 100}')
+        os.makedirs(dir_path, exist_ok=True)
+        session_id = generate_session_id(rng)
+        with open(os.path.join(dir_path, session_id + '.jsonl'), 'w') as f:
+            f.write(line)
+        if i % 10 == 0:
+            with open(os.path.join(dir_path, session_id + '.json'), 'w') as f:
+                f.write('[' + line + ']')
+
+
+def generate_metadata_file(path, num_sessions, seed=0):
+    """Write a metadata file in which some sessions have more than one line."""
+    rng = random.Random(seed)
+    session_ids = [generate_session_id(rng) for _ in range(num_sessions)]
+    with open(path, 'w') as f:
+        for i in range(num_sessions + num_sessions // 10):
+            session_id = session_ids[i % num_sessions]
+            history = {
+                'session_id': session_id,
+                'access_code': 'demo',
+                'domain': 'story',
+                'example': 'na',
+                'prompt': 'na',
+                'n': 5,
+                'max_tokens': 50,
+                'temperature': 0.95,
+                'top_p': 1,
+                'presence_penalty': 0.5,
+                'frequency_penalty': 0.5,
+                'stop': ['.'],
+                'engine': 'text-davinci-003',
+                'start_timestamp': 1680000000 + i,
+                'last_query_timestamp': 1680000000 + i,
+                'verification_code': session_id,
+            }
+            f.write(json.dumps(history) + '\n')
+
+
+def measure(func, number=None, repeat=3):
+    """Return the time per call in milliseconds (best of repeat).
+
+    By default, func is called enough times for each run to take at least 0.2 seconds.
+    """
+    if number is None:
+        number, _ = timeit.Timer(func).autorange()
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1000
+
+
+def is_blocked_by_list(suggestion, blocklist):
+    """Check a suggestion as filter_suggestions did before BlocklistMatcher."""
+    words = word_tokenize(suggestion.lower())
+    return any([word in words for word in blocklist])
+
+
+def benchmark_blocklist(blocklist, suggestions, number):
+    blocklist = list(blocklist)
+    matcher = BlocklistMatcher(blocklist)
+
+    # Single-word entries must give the same matches as before
+    single_words = [word for word in blocklist if not any(char.isspace() for char in word)]
+    single_word_matcher = BlocklistMatcher(single_words)
+    for suggestion in suggestions:
+        assert single_word_matcher.matches(suggestion) == is_blocked_by_list(suggestion, single_words)
+
+    list_time = measure(lambda: [is_blocked_by_list(s, blocklist) for s in suggestions], number)
+    matcher_time = measure(lambda: [matcher.matches(s) for s in suggestions], number)
+    return {
+        'blocklist_size': len(blocklist),
+        'num_suggestions': len(suggestions),
+        'list (ms)': round(list_time, 3),
+        'matcher (ms)': round(matcher_time, 3),
+        'speedup': round(list_time / matcher_time, 2),
+    }
+
+
+def parse_suggestion_with_sent_tokenize(suggestion, after_prompt, stop_rules):
+    """Parse a suggestion as parse_suggestion did before get_first_sentence."""
+    processed_suggestion = suggestion
+    if suggestion.startswith(after_prompt):
+        processed_suggestion = suggestion[len(after_prompt):]
+
+    if '.' in stop_rules:
+        sentences = sent_tokenize(processed_suggestion)
+        if not sentences:
+            return ''
+        first_sentence = sentences[0].strip().split('\n')[0]
+        start = processed_suggestion.index(first_sentence)
+        end = start + len(first_sentence)
+        processed_suggestion = processed_suggestion[:end]
+    return processed_suggestion
+
+
+def benchmark_first_sentence(texts, number):
+    after_prompt = ' '
+    stop_rules = ['.']
+
+    # Both must give the same suggestions
+    for text in texts:
+        expected = parse_suggestion_with_sent_tokenize(text, after_prompt, stop_rules)
+        assert parse_suggestion(text, after_prompt, stop_rules) == expected, text
+
+        # Streaming can stop as soon as the first sentence is complete
+        detector = FirstSentenceDetector(after_prompt)
+        for i in range(len(text)):
+            if detector.feed(text[i]):
+                assert parse_suggestion(detector.text, after_prompt, stop_rules) == expected, text
+                break
+
+    sent_tokenize_time = measure(
+        lambda: [parse_suggestion_with_sent_tokenize(t, after_prompt, stop_rules) for t in texts], number
+    )
+    first_sentence_time = measure(lambda: [parse_suggestion(t, after_prompt, stop_rules) for t in texts], number)
+    return {
+        'num_texts': len(texts),
+        'sent_tokenize (ms)': round(sent_tokenize_time, 3),
+        'first_sentence (ms)': round(first_sentence_time, 3),
+        'speedup': round(sent_tokenize_time / first_sentence_time, 2),
+    }
+
+
+def replay_with_apply_ops(events):
+    doc = events[0]['currentDoc'].strip()
+    mask = 'P' * len(doc)
+    for event in events:
+        if 'ops' in event['textDelta']:
+            doc, mask = apply_ops(doc, mask, event['textDelta']['ops'], event['eventSource'])
+    return doc, mask
+
+
+def replay_with_document(events):
+    document = Document(events[0]['currentDoc'].strip(), 'P')
+    for event in events:
+        if 'ops' in event['textDelta']:
+            document.apply_ops(event['textDelta']['ops'], event['eventSource'])
+    return document.get_text_and_mask()
+
+
+def get_benchmarks(args, tmp_dir):
+    """Return (name, setup) for each benchmark.
+
+    setup() prepares inputs and returns the function to time, so that only
+    the selected benchmarks generate their inputs.
+    """
+    engine = args.engine
+    context_window_size = get_context_window_size(engine)
+    example = ' '.join(generate_suggestions(20, seed=1))
+
+    def setup_parse_prompt(num_words):
+        rng = random.Random(num_words)
+        doc = ' '.join(rng.choice(WORDS) for _ in range(num_words)) + '. The pig '
+        return lambda: parse_prompt(example + doc, 50, context_window_size, engine=engine, prefix=example)
+
+    def setup_parse_suggestion(stop_rules):
+        texts = generate_texts(1000)
+        return lambda: [parse_suggestion(text, ' ', stop_rules) for text in texts]
+
+    def setup_filter_suggestions(blocklist_size):
+        matcher = BlocklistMatcher(generate_blocklist(blocklist_size))
+        suggestions = [(suggestion, 50.0, engine) for suggestion in generate_suggestions(100)]
+        prev_suggestions = [{'original': suggestion} for suggestion, _, _ in suggestions[:10]]
+        return lambda: filter_suggestions(suggestions, prev_suggestions, matcher)
+
+    def setup_apply_ops():
+        events = generate_session(args.num_events)
+        assert replay_with_apply_ops(events) == replay_with_document(events)
+        return lambda: replay_with_apply_ops(events)
+
+    def setup_document_apply_ops():
+        events = generate_session(args.num_events)
+        return lambda: replay_with_document(events)
+
+    def setup_get_text_and_mask():
+        events = generate_session(args.num_events)
+        return lambda: get_text_and_mask(events, len(events), remove_prompt=True)
+
+    def setup_log_dir():
+        log_dir = os.path.join(tmp_dir, 'logs')
+        if not os.path.exists(log_dir):
+            generate_log_dir(log_dir, args.num_logs)
+        return log_dir
+
+    def setup_retrieve_log_paths():
+        log_dir = setup_log_dir()
+        assert len(retrieve_log_paths(log_dir)) == args.num_logs
+        return lambda: retrieve_log_paths(log_dir)
+
+    def setup_log_index():
+        log_dir = setup_log_dir()
+        return lambda: LogIndex(log_dir)
+
+    def setup_update_metadata():
+        metadata_path = os.path.join(tmp_dir, 'metadata.txt')
+        generate_metadata_file(metadata_path, args.num_sessions)
+        return lambda: update_metadata(dict(), metadata_path)
+
+    return [
+        ('parse_prompt/short', lambda: setup_parse_prompt(100)),
+        ('parse_prompt/truncated', lambda: setup_parse_prompt(5000)),
+        ('parse_suggestion/no_stop', lambda: setup_parse_suggestion([])),
+        ('parse_suggestion/first_sentence', lambda: setup_parse_suggestion(['.'])),
+        ('filter_suggestions/blocklist_100', lambda: setup_filter_suggestions(100)),
+        ('filter_suggestions/blocklist_10000', lambda: setup_filter_suggestions(10000)),
+        (f'apply_ops/events_{args.num_events}', setup_apply_ops),
+        (f'document_apply_ops/events_{args.num_events}', setup_document_apply_ops),
+        (f'get_text_and_mask/events_{args.num_events}', setup_get_text_and_mask),
+        (f'retrieve_log_paths/logs_{args.num_logs}', setup_retrieve_log_paths),
+        (f'log_index/logs_{args.num_logs}', setup_log_index),
+        (f'update_metadata/sessions_{args.num_sessions}', setup_update_metadata),
+    ]
+
+
+def get_environment(args):
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'tokenizer': get_encoding(args.engine) is not None,  # Prompts are truncated by characters otherwise
+    }
+
+
+def run_benchmarks(args):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, setup in get_benchmarks(args, tmp_dir):
+            if args.only and not any(name.startswith(prefix) for prefix in args.only):
+                continue
+            func = setup()
+            results[name] = round(measure(func, repeat=args.repeat), 6)
+            print(f'{name:45} {results[name]:10.3f} ms')
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Print changes from a baseline and return the names of benchmarks that got slower."""
+    regressions = []
+    print(f'# Compared to the baseline (regression if more than {tolerance:.0%} slower)')
+    for name, value in results.items():
+        if name not in baseline['results']:
+            print(f'{name:45} {value:10.3f} ms  (new)')
+            continue
+        baseline_value = baseline['results'][name]
+        change = value / baseline_value - 1 if baseline_value else 0
+        is_regression = change > tolerance
+        if is_regression:
+            regressions.append(name)
+        print(f'{name:45} {value:10.3f} ms  {baseline_value:10.3f} ms  {change:+7.1%}'
+              + ('  REGRESSION' if is_regression else ''))
+    return regressions
+
+
+def run_comparisons(args):
+    blocklist = read_blocklist(args.config_dir)
+    suggestions = generate_suggestions(args.num_suggestions)
+    # Plant blocked words so that both paths find matches
+    suggestions[0] += ' ' + sorted(blocklist)[-1]
+
+    print('# filter_suggestions (blocklist)')
+    for size in [100, len(blocklist)]:
+        results = benchmark_blocklist(sorted(blocklist)[-size:], suggestions, args.number)
+        print(results)
+
+    print('# parse_suggestion (first sentence)')
+    results = benchmark_first_sentence(generate_texts(1000), args.number)
+    print(results)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--output', type=str, default=None)  # Save results as a JSON baseline
+    parser.add_argument('--baseline', type=str, default=None)  # Flag regressions from a JSON baseline
+    parser.add_argument('--tolerance', type=float, default=0.2)  # Slowdown allowed before flagging
+    parser.add_argument('--only', type=str, nargs='*', default=None)  # Prefixes of benchmark names
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--engine', type=str, default='text-davinci-003')
+    parser.add_argument('--num_events', type=int, default=5000)  # Events in a synthetic session
+    parser.add_argument('--num_logs', type=int, default=10000)
+    parser.add_argument('--num_sessions', type=int, default=50000)  # Sessions in a metadata file
+    parser.add_argument('--compare', action='store_true')  # Compare with replaced implementations
+    parser.add_argument('--config_dir', type=str, default='../config')  # Blocklist for --compare
+    parser.add_argument('--num_suggestions', type=int, default=5)  # For --compare
+    parser.add_argument('--number', type=int, default=20)  # For --compare
+    args = parser.parse_args()
+
+    environment = get_environment(args)
+    print(f'# {environment}')
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'Saved results to {args.output}')
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != environment:
+            print(f'# The baseline was recorded in another environment: {baseline.get("environment")}')
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+
+    if args.compare:
+        run_comparisons(args)
+
+    if regressions:
+        print(f'# {len(regressions)} regressions: {", ".join(regressions)}')
+        sys.exit(1)
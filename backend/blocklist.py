@@ -0,0 +1,52 @@
+"""
+Matches suggestions against a blocklist of words and phrases.
+"""
+
+from nltk.tokenize import word_tokenize
+
+
+class BlocklistMatcher:
+    """Blocklist compiled once into a set of words and an index of phrases.
+
+    A suggestion is tokenized with word_tokenize after lowercasing. An entry
+    without whitespace matches if it equals one of the tokens, which is the
+    same as checking `word in words` for every entry but with a single set
+    lookup per token. An entry with whitespace is tokenized the same way and
+    matches if its tokens appear contiguously in the suggestion.
+    """
+
+    def __init__(self, blocklist):
+        self.words = set()
+        self.phrases = dict()  # first token -> list of token tuples
+
+        for entry in blocklist:
+            if not entry:
+                continue
+            if any(char.isspace() for char in entry):
+                tokens = tuple(word_tokenize(entry))
+                if tokens:
+                    self.phrases.setdefault(tokens[0], []).append(tokens)
+            else:
+                self.words.add(entry)
+
+    def __len__(self):
+        return len(self.words) + sum(len(phrases) for phrases in self.phrases.values())
+
+    def __bool__(self):
+        return bool(self.words) or bool(self.phrases)
+
+    def matches(self, suggestion):
+        """Return True if the suggestion contains any blocked word or phrase."""
+        if not self:
+            return False
+
+        tokens = word_tokenize(suggestion.lower())
+        if not self.words.isdisjoint(tokens):
+            return True
+
+        if self.phrases:
+            for i, token in enumerate(tokens):
+                for phrase in self.phrases.get(token, []):
+                    if tuple(tokens[i:i + len(phrase)]) == phrase:
+                        return True
+        return False
@@ -0,0 +1,200 @@
+"""
+Caches model outputs keyed on the effective prompt and decoding parameters.
+"""
+
+import os
+import json
+import hashlib
+import collections
+from threading import Lock, get_ident
+from time import time
+
+
+def get_cache_key(completion):
+    """Hash all arguments of a completion request (engine, prompt, suffix, n, etc.)."""
+    serialized = json.dumps(completion, sort_keys=True)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """In-memory LRU cache with a time-to-live (TTL) and a size bound."""
+
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl  # In seconds
+
+        self.entries = collections.OrderedDict()  # key -> (timestamp, response)
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return a cached response or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.evictions += 1
+                entry = None
+
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        # Do not block other lookups while loading from the secondary backend
+        entry = self.load(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.insert(key, entry)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, response):
+        entry = (time(), response)
+        with self.lock:
+            self.insert(key, entry)
+        self.store(key, entry)
+
+    def insert(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        # Evict least recently used entries
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def load(self, key):
+        """Load an entry from a secondary backend (none for in-memory cache)."""
+        return None
+
+    def store(self, key, entry):
+        """Store an entry in a secondary backend (none for in-memory cache)."""
+        pass
+
+    def get_stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class DiskCompletionCache(CompletionCache):
+    """LRU cache in memory backed by one JSON file per entry on disk.
+
+    Entries on disk survive restarts. Files are touched when they are read,
+    and every sweep_interval seconds, expired files are removed and the least
+    recently used ones beyond max_disk_size are evicted. Files are read and
+    written without holding the lock of the in-memory cache.
+    """
+
+    def __init__(self, cache_dir, max_size=1024, ttl=3600, max_disk_size=100000, sweep_interval=60):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.cache_dir = cache_dir
+        self.max_disk_size = max_disk_size  # Number of files
+        self.sweep_interval = sweep_interval  # In seconds
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.disk_size = 0  # As of the last sweep
+        self.last_sweep = 0
+        self.sweep_lock = Lock()
+        self.sweep()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.json')
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'# Ignoring a broken cache entry ({path}): {e}')
+            return None
+
+        timestamp = entry['timestamp']
+        if time() - timestamp > self.ttl:
+            remove_file(path)
+            with self.lock:
+                self.evictions += 1
+            return None
+
+        try:
+            os.utime(path)  # Keep the file from being evicted as least recently used
+        except OSError:
+            pass
+        return (timestamp, entry['response'])
+
+    def store(self, key, entry):
+        path = self.get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{get_ident()}.tmp'  # Unique for each writer
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'timestamp': entry[0], 'response': entry[1]}, f)
+            os.replace(tmp_path, path)  # Atomic so that readers never see partial files
+        except Exception as e:
+            print(f'# Failed to write a cache entry ({path}): {e}')
+            remove_file(tmp_path)
+
+        if time() - self.last_sweep > self.sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """Remove expired files and evict least recently used files beyond max_disk_size."""
+        if not self.sweep_lock.acquire(blocking=False):
+            return  # Another thread is sweeping
+        try:
+            self.last_sweep = time()
+            files = []
+            try:
+                with os.scandir(self.cache_dir) as entries:
+                    for entry in entries:
+                        try:
+                            files.append((entry.stat().st_mtime, entry.path))
+                        except OSError:
+                            pass  # Removed by another process
+            except OSError as e:
+                print(f'# Failed to sweep the cache ({self.cache_dir}): {e}')
+                return
+
+            # Files are written (or touched) after their timestamp, so they have expired if older than ttl
+            removed = [path for mtime, path in files if self.last_sweep - mtime > self.ttl]
+            files = [(mtime, path) for mtime, path in files if self.last_sweep - mtime <= self.ttl]
+            if len(files) > self.max_disk_size:
+                files.sort()
+                removed += [path for _, path in files[:len(files) - self.max_disk_size]]
+                files = files[len(files) - self.max_disk_size:]
+
+            for path in removed:
+                remove_file(path)
+            with self.lock:
+                self.evictions += len(removed)
+            self.disk_size = len(files)
+        finally:
+            self.sweep_lock.release()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['disk_size'] = self.disk_size
+        stats['max_disk_size'] = self.max_disk_size
+        return stats
+
+
+def remove_file(path):
+    """Remove a file unless another process has removed it already."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,110 @@
+"""
+Keeps examples, prompts, and access codes from config_dir in memory.
+"""
+
+import os
+import collections
+from threading import Lock
+from time import time
+
+from reader import (
+    get_example_paths, read_example,
+    read_prompts,
+    get_access_code_paths, read_access_code_file,
+    read_blocklist,
+)
+from blocklist import BlocklistMatcher
+
+
+ConfigSnapshot = collections.namedtuple(
+    'ConfigSnapshot',
+    ['examples', 'prompts', 'access_codes', 'blocklist']
+)
+
+
+class ConfigRegistry:
+    """Parsed configurations that are reloaded only when their files change.
+
+    Files are checked at most once every check_interval seconds, and only the
+    files whose modification time or size has changed are parsed again. Each
+    reload builds a new snapshot and replaces the previous one at once, so a
+    request that holds a snapshot always sees a consistent set of configs.
+    If use_blocklist is set, blocklist.txt is also compiled into a matcher
+    (otherwise the blocklist is empty).
+    """
+
+    def __init__(self, config_dir, use_blocklist=False, check_interval=1):
+        self.config_dir = config_dir
+        self.use_blocklist = use_blocklist
+        self.check_interval = check_interval  # In seconds
+
+        self.files = dict()  # path -> (mtime, size, parsed content)
+        self.snapshot = None
+        self.last_check = 0
+        self.lock = Lock()
+
+        self.reload()
+
+    def get(self):
+        """Return the latest snapshot of configs."""
+        if time() - self.last_check > self.check_interval:
+            with self.lock:
+                if time() - self.last_check > self.check_interval:
+                    self.reload()
+        return self.snapshot
+
+    def reload(self):
+        files = dict()
+        changed = self.snapshot is None
+
+        example_paths = get_example_paths(self.config_dir)
+        prompt_path = os.path.join(self.config_dir, 'prompts.tsv')
+        access_code_paths = get_access_code_paths(self.config_dir)
+        blocklist_paths = []
+        if self.use_blocklist:
+            blocklist_paths.append(os.path.join(self.config_dir, 'blocklist.txt'))
+
+        for path in example_paths + [prompt_path] + access_code_paths + blocklist_paths:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime, stat.st_size)
+            if path in self.files and self.files[path][:2] == stamp:
+                files[path] = self.files[path]
+                continue
+
+            if path in example_paths:
+                parsed = read_example(path)
+            elif path == prompt_path:
+                parsed = read_prompts(self.config_dir)
+            elif path in blocklist_paths:
+                parsed = BlocklistMatcher(read_blocklist(self.config_dir))
+                print(f' # Using a blocklist: {len(parsed)}')
+            else:
+                parsed = read_access_code_file(path)
+            files[path] = stamp + (parsed,)
+            changed = True
+
+        if set(files.keys()) != set(self.files.keys()):
+            changed = True  # Files have been added or removed
+
+        if changed:
+            examples = {'na': ''}
+            for path in example_paths:
+                name = os.path.basename(path)[:-4]
+                examples[name] = files[path][2]
+
+            access_codes = dict()
+            for path in access_code_paths:
+                access_codes.update(files[path][2])
+
+            blocklist = BlocklistMatcher([])
+            for path in blocklist_paths:
+                blocklist = files[path][2]
+
+            self.files = files
+            self.snapshot = ConfigSnapshot(
+                examples=examples,
+                prompts=files[prompt_path][2],
+                access_codes=access_codes,
+                blocklist=blocklist,
+            )
+        self.last_check = time()
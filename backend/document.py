@@ -0,0 +1,298 @@
+"""
+Reconstructs documents and their authorship masks from Quill deltas in logs.
+
+A document is stored as a list of blocks of at most MAX_BLOCK_LENGTH
+characters, each with its text and its mask ('P' for prompt, 'U' for user,
+'A' for API). Applying an op only copies the block around the edit, instead
+of copying the whole text and mask as helper.apply_ops does. Blocks are
+located by bisecting the positions where they end, which are only recomputed
+from the first block that changed (and not at all when typing at the end).
+"""
+
+import os
+import re
+import json
+import bisect
+import itertools
+
+RUN_PATTERN = re.compile(r'(.)\1*', re.DOTALL)
+
+
+class Document:
+    # Split a block in half when it grows longer than this
+    MAX_BLOCK_LENGTH = 2048
+
+    def __init__(self, text='', mask_char='P'):
+        self.texts = []
+        self.masks = []
+        self.lengths = []
+        self.length = 0
+
+        # Positions where blocks end, valid for blocks before self.dirty
+        self.ends = []
+        self.dirty = 0
+
+        self.set_text_and_mask(text, mask_char * len(text))
+
+    def __len__(self):
+        return self.length
+
+    @classmethod
+    def from_runs(cls, text, runs):
+        """Create a document from a text and a mask as a list of (mask_char, length)."""
+        return cls.from_text_and_mask(text, ''.join(mask_char * length for mask_char, length in runs))
+
+    @classmethod
+    def from_text_and_mask(cls, text, mask):
+        """Create a document from a text and a mask of the same length."""
+        document = cls()
+        document.set_text_and_mask(text, mask)
+        return document
+
+    def set_text_and_mask(self, text, mask):
+        size = self.MAX_BLOCK_LENGTH // 2
+        self.texts = [text[i:i + size] for i in range(0, len(text), size)]
+        self.masks = [mask[i:i + size] for i in range(0, len(mask), size)]
+        self.lengths = [len(block) for block in self.texts]
+        self.length = len(text)
+        self.ends = []
+        self.dirty = 0
+
+    def get_text(self):
+        return ''.join(self.texts)
+
+    def get_mask(self):
+        return ''.join(self.masks)
+
+    def get_runs(self):
+        """Return the mask as a list of [mask_char, length]."""
+        return [[match.group(1), match.end() - match.start()] for match in RUN_PATTERN.finditer(self.get_mask())]
+
+    def get_text_and_mask(self):
+        return self.get_text(), self.get_mask()
+
+    def get_ends(self):
+        if self.dirty < len(self.lengths):
+            start = self.ends[self.dirty - 1] if self.dirty > 0 else 0
+            self.ends[self.dirty:] = itertools.accumulate(self.lengths[self.dirty:], initial=start)
+            del self.ends[self.dirty]  # The initial value
+            self.dirty = len(self.lengths)
+        return self.ends
+
+    def changed(self, index):
+        """Mark the ends of blocks from index on as outdated."""
+        self.dirty = min(self.dirty, index)
+
+    def locate(self, position):
+        """Return (index, offset) of the block that contains a position.
+
+        If the position is at the end of the document, it is at the end of the last block.
+        """
+        if position >= self.length:
+            index = len(self.lengths) - 1
+            return index, self.lengths[index]
+
+        ends = self.get_ends()
+        index = bisect.bisect_right(ends, position)
+        return index, position - (ends[index - 1] if index > 0 else 0)
+
+    def insert(self, position, text, mask_char):
+        if not text:
+            return
+        if not self.texts:
+            self.set_text_and_mask(text, mask_char * len(text))
+            return
+
+        if position >= self.length:
+            # Typing at the end only changes the last block
+            index = len(self.texts) - 1
+            self.texts[index] += text
+            self.masks[index] += mask_char * len(text)
+        else:
+            index, offset = self.locate(position)
+            block = self.texts[index]
+            mask = self.masks[index]
+            self.texts[index] = block[:offset] + text + block[offset:]
+            self.masks[index] = mask[:offset] + mask_char * len(text) + mask[offset:]
+        self.lengths[index] += len(text)
+        self.length += len(text)
+        self.changed(index)
+
+        if self.lengths[index] > self.MAX_BLOCK_LENGTH:
+            self.split_block(index)
+
+    def split_block(self, index):
+        """Split a long block into blocks of MAX_BLOCK_LENGTH / 2 characters."""
+        size = self.MAX_BLOCK_LENGTH // 2
+        block = self.texts[index]
+        mask = self.masks[index]
+        starts = range(0, len(block), size)
+        self.texts[index:index + 1] = [block[i:i + size] for i in starts]
+        self.masks[index:index + 1] = [mask[i:i + size] for i in starts]
+        self.lengths[index:index + 1] = [min(size, len(block) - i) for i in starts]
+        self.changed(index)
+
+    def delete(self, start, end):
+        start = max(start, 0)
+        end = min(end, self.length)
+        if start >= end:
+            return
+
+        index, offset = self.locate(start)
+        self.changed(index)
+        self.length -= end - start
+        remaining = end - start
+        while remaining > 0:
+            num_chars = min(self.lengths[index] - offset, remaining)
+            if num_chars == self.lengths[index]:
+                del self.texts[index], self.masks[index], self.lengths[index]
+            else:
+                block = self.texts[index]
+                mask = self.masks[index]
+                self.texts[index] = block[:offset] + block[offset + num_chars:]
+                self.masks[index] = mask[:offset] + mask[offset + num_chars:]
+                self.lengths[index] -= num_chars
+                index += 1
+            remaining -= num_chars
+            offset = 0
+
+    def apply_ops(self, ops, source):
+        """Apply ops in a Quill delta, identical to helper.apply_ops."""
+        position = 0  # Length of the new part of the doc (before the cursor)
+
+        for op in ops:
+
+            # Handle retain operation
+            if 'retain' in op:
+                num_char = op['retain']
+                position = min(position + num_char, self.length)
+
+            # Handle insert operation
+            elif 'insert' in op:
+                insert_doc = op['insert']
+
+                mask_char = 'U'  # User
+                if source == 'api':
+                    mask_char = 'A'  # API
+
+                if isinstance(insert_doc, dict):
+                    if 'image' in insert_doc:
+                        print('Skipping invalid object insertion (image)')
+                    else:
+                        print('Ignore invalid insertions:', op)
+                        # Ignore other invalid insertions
+                        # Debug if necessary
+                        pass
+                else:
+                    self.insert(position, insert_doc, mask_char)
+                    position += len(insert_doc)
+
+            # Handle delete operation
+            elif 'delete' in op:
+                num_char = op['delete']
+
+                if position < self.length:
+                    self.delete(position, position + num_char)
+                else:
+                    # Deleting past the end removes characters before the cursor
+                    # (note that deleting 0 characters removes all of them)
+                    start = position - num_char if num_char else 0
+                    self.delete(start, position)
+                    position = max(start, 0)
+
+            else:
+                # Ignore other operations
+                # Debug if necessary
+                print('Ignore other operations:', op)
+                pass
+
+
+class ReplayIndex:
+    """Snapshots of a document every `interval` events for random access.
+
+    The text and mask after any number of events are reconstructed from the
+    closest preceding snapshot, so each lookup replays at most `interval`
+    events. Snapshots are built lazily up to the requested event and can be
+    saved next to the log file to be reused later.
+    """
+
+    def __init__(self, events, interval=100):
+        self.events = events
+        self.interval = interval
+
+        prompt = events[0]['currentDoc'].strip() if events else ''
+        self.snapshots = [(prompt, [['P', len(prompt)]])]  # (text, runs) before events[0]
+
+    def get_document(self, event_id):
+        """Return a document after applying events[:event_id]."""
+        event_id = max(0, min(event_id, len(self.events)))
+        index = event_id // self.interval
+
+        # Build snapshots up to the requested event
+        while len(self.snapshots) <= index:
+            start = (len(self.snapshots) - 1) * self.interval
+            document = Document.from_runs(*self.snapshots[-1])
+            self.replay(document, start, start + self.interval)
+            self.snapshots.append((document.get_text(), document.get_runs()))
+
+        document = Document.from_runs(*self.snapshots[index])
+        self.replay(document, index * self.interval, event_id)
+        return document
+
+    def get_text_and_mask(self, event_id):
+        """Return the text and mask after applying events[:event_id]."""
+        return self.get_document(event_id).get_text_and_mask()
+
+    def replay(self, document, start, end):
+        for event in self.events[start:end]:
+            if 'ops' not in event['textDelta']:
+                continue
+            document.apply_ops(event['textDelta']['ops'], event['eventSource'])
+
+    def save(self, path, log_path):
+        """Save snapshots along with the state of the log file they are built from."""
+        stat = os.stat(log_path)
+        data = {
+            'log_mtime': stat.st_mtime,
+            'log_size': stat.st_size,
+            'interval': self.interval,
+            'snapshots': self.snapshots,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path, log_path):
+        """Load snapshots if they are built from the current log file."""
+        with open(path, 'r') as f:
+            data = json.load(f)
+
+        stat = os.stat(log_path)
+        if (data['log_mtime'] != stat.st_mtime or data['log_size'] != stat.st_size
+                or data['interval'] != self.interval):
+            return False
+
+        self.snapshots = [(text, runs) for text, runs in data['snapshots']]
+        return True
+
+
+def get_replay_index(log_path, events, interval=100):
+    """Return a replay index for a log, reusing snapshots saved next to it."""
+    replay_index = ReplayIndex(events, interval)
+
+    snapshot_path = log_path + '.snapshots'
+    if os.path.exists(snapshot_path):
+        try:
+            if replay_index.load(snapshot_path, log_path):
+                return replay_index
+        except Exception as e:
+            print(f'# Ignoring broken snapshots ({snapshot_path}): {e}')
+
+    # Build all snapshots at once so that they can be saved
+    replay_index.get_document(len(events))
+    try:
+        replay_index.save(snapshot_path, log_path)
+    except Exception as e:
+        print(f'# Failed to save snapshots ({snapshot_path}): {e}')
+    return replay_index
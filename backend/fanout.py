@@ -0,0 +1,187 @@
+"""
+Splits a completion request into parallel sub-requests and hedges slow ones.
+
+Instead of waiting for all n choices of one request (i.e. for the slowest
+choice), n is split into smaller requests that are sent at once, and their
+results are used as soon as they arrive. A sub-request that takes longer than
+a percentile of recent latencies is sent again (hedged), and whichever copy
+finishes first is used. The latency of every copy is recorded, including
+copies that lose to the other copy or are discarded at the deadline (as the
+time they ran until then), so that slow copies are not left out of the
+percentile.
+"""
+
+import time
+import asyncio
+import collections
+from threading import Lock
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+
+
+def split_n(n, size):
+    """Split n choices into sub-requests of at most size choices each."""
+    size = max(size, 1)
+    return [min(size, n - start) for start in range(0, n, size)]
+
+
+class LatencyTracker:
+    """Latencies of the most recent sub-requests for each engine."""
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples  # No hedging until there are enough samples
+
+        self.latencies = dict()  # engine -> deque of latencies (in seconds)
+        self.lock = Lock()
+
+    def add(self, engine, latency):
+        with self.lock:
+            if engine not in self.latencies:
+                self.latencies[engine] = collections.deque(maxlen=self.window)
+            self.latencies[engine].append(latency)
+
+    def get_percentile(self, engine, percentile):
+        """Return a percentile of recent latencies or None if there are too few."""
+        with self.lock:
+            latencies = list(self.latencies.get(engine, []))
+        if len(latencies) < self.min_samples:
+            return None
+        return float(np.percentile(latencies, percentile))
+
+
+class FanOut:
+    """Bookkeeping of sub-requests shared by fan_out and afan_out.
+
+    Each part may have up to two copies in flight (the original and a hedge).
+    A part is done when its first copy succeeds or when all of its copies
+    fail. Results are collected until all parts are done or the deadline
+    passes (but at least one result is always waited for unless all fail).
+    """
+
+    def __init__(self, num_parts, deadline, hedge_delay=None, on_latency=None):
+        self.num_parts = num_parts
+        self.hedge_delay = hedge_delay  # In seconds (no hedging if None)
+        self.on_latency = on_latency
+
+        self.start = time.time()
+        self.deadline = self.start + deadline
+        self.pending = dict()  # future or task -> (part index, send timestamp)
+        self.done = set()
+        self.hedged = set()
+        self.num_results = 0
+        self.error = None
+
+    def is_finished(self):
+        if len(self.done) == self.num_parts:
+            return True
+        return self.num_results > 0 and time.time() >= self.deadline
+
+    def get_timeout(self):
+        """Return seconds until the deadline or the next hedge, or None to wait for a result."""
+        current_timestamp = time.time()
+        times = []
+        if self.num_results > 0:
+            times.append(self.deadline)
+        if self.hedge_delay is not None:
+            for index, timestamp in self.pending.values():
+                if index not in self.hedged:
+                    times.append(timestamp + self.hedge_delay)
+        if not times:
+            return None
+        return max(min(times) - current_timestamp, 0)
+
+    def add(self, future, index):
+        self.pending[future] = (index, time.time())
+
+    def pop(self, future):
+        """Return (True, result) for the first successful copy of a part, or (False, None)."""
+        index, timestamp = self.pending.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            if index not in self.done:
+                self.error = e
+                if index not in [other_index for other_index, _ in self.pending.values()]:
+                    self.done.add(index)  # No other copy left
+            return False, None
+
+        if self.on_latency is not None:
+            self.on_latency(time.time() - timestamp)
+        if index in self.done:
+            return False, None  # The other copy of a hedged part finished first
+
+        self.done.add(index)
+        self.num_results += 1
+        return True, result
+
+    def discard(self):
+        """Return copies still in flight and record how long they ran as their latency."""
+        current_timestamp = time.time()
+        if self.on_latency is not None:
+            for _, timestamp in self.pending.values():
+                self.on_latency(current_timestamp - timestamp)  # At least this long
+        futures = list(self.pending)
+        self.pending.clear()
+        return futures
+
+    def get_parts_to_hedge(self):
+        if self.hedge_delay is None:
+            return []
+        current_timestamp = time.time()
+        parts = []
+        for index, timestamp in list(self.pending.values()):
+            if index in self.hedged or index in self.done:
+                continue
+            if current_timestamp - timestamp >= self.hedge_delay:
+                self.hedged.add(index)
+                parts.append(index)
+        return parts
+
+    def raise_if_failed(self):
+        if self.num_results == 0 and self.error is not None:
+            raise self.error
+
+
+def fan_out(executor, func, parts, deadline, hedge_delay=None, on_latency=None):
+    """Yield func(part) for parts as they complete (stop early by closing the generator)."""
+    state = FanOut(len(parts), deadline, hedge_delay, on_latency)
+    for index, part in enumerate(parts):
+        state.add(executor.submit(func, part), index)
+
+    try:
+        while state.pending and not state.is_finished():
+            done, _ = wait(list(state.pending), timeout=state.get_timeout(), return_when=FIRST_COMPLETED)
+            for future in done:
+                is_result, result = state.pop(future)
+                if is_result:
+                    yield result
+            for index in state.get_parts_to_hedge():
+                state.add(executor.submit(func, parts[index]), index)
+    finally:
+        # Results of sub-requests that already started are discarded
+        for future in state.discard():
+            future.cancel()
+    state.raise_if_failed()
+
+
+async def afan_out(func, parts, deadline, hedge_delay=None, on_latency=None):
+    """Yield await func(part) for parts as they complete (in an event loop)."""
+    state = FanOut(len(parts), deadline, hedge_delay, on_latency)
+    for index, part in enumerate(parts):
+        state.add(asyncio.ensure_future(func(part)), index)
+
+    try:
+        while state.pending and not state.is_finished():
+            done, _ = await asyncio.wait(list(state.pending), timeout=state.get_timeout(), return_when=FIRST_COMPLETED)
+            for task in done:
+                is_result, result = state.pop(task)
+                if is_result:
+                    yield result
+            for index in state.get_parts_to_hedge():
+                state.add(asyncio.ensure_future(func(parts[index])), index)
+    finally:
+        for task in state.discard():
+            task.cancel()
+    state.raise_if_failed()
@@ -10,7 +10,7 @@ from pathlib import Path
 from datetime import date, datetime
 from time import time, ctime
 
-from reader import update_metadata
+from document import Document
 
 
 def get_uuid():
@@ -29,15 +29,17 @@ def print_verbose(title, arg_dict, verbose, force=False):
         print('\n')
 
 
-def print_current_sessions(sessions, message=''):
+def print_current_sessions(session_store, message='', max_sessions=10):
     if message:
         print(f'\n{message}\n')
 
     current_timestamp = time()
     print('=' * 40)
     print(f'Most recent sessions ({ctime(current_timestamp)})')
+    print(f'Active: {session_store.count_active()} / Total: {len(session_store)}')
     print('=' * 40)
-    for session_id, session in sessions.items():
+    for session in session_store.get_recent(max_sessions):
+        session_id = session['session_id']
         start_timestamp = session['start_timestamp']
         elapsed_from_start = current_timestamp - start_timestamp  # Elapsed time in seconds
         elapsed_from_start = round(elapsed_from_start / 60, 2)  # Elapsed time in minutes
@@ -189,14 +191,14 @@ def apply_ops(doc, mask, ops, source):
 def get_text_and_mask(events, event_id, remove_prompt=True):
     prompt = events[0]['currentDoc'].strip()
 
-    text = prompt
-    mask = 'P' * len(prompt)  # Prompt
+    document = Document(prompt, 'P')  # Prompt
     for event in events[:event_id]:
         if 'ops' not in event['textDelta']:
             continue
         ops = event['textDelta']['ops']
         source = event['eventSource']
-        text, mask = apply_ops(text, mask, ops, source)
+        document.apply_ops(ops, source)
+    text, mask = document.get_text_and_mask()
 
     if remove_prompt:
         if 'P' not in mask:
@@ -224,15 +226,11 @@ def get_last_text_from_log(log):
     return text
 
 
-def get_config_for_log(session_id, metadata, metadata_path):
-    metadata = update_metadata(
-        metadata,
-        metadata_path
-    )
-    if session_id not in metadata:
+def get_config_for_log(session_id, metadata_store):
+    config = metadata_store.get(session_id)
+    if config is None:
         print(f'Could not find session history for session ID: {session_id}')
         return ''
-    config = metadata[session_id]
     return config
 
 def get_context_window_size(engine):
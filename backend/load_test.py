@@ -0,0 +1,244 @@
+"""
+Measures the throughput of a running backend with concurrent writers.
+
+Each simulated writer starts a session, sends logs in batches, requests the
+log back, and ends the session, like the frontend with incremental logging.
+Model outputs are not requested unless --num_queries is set, as they would be
+limited by the API rather than the backend. Run the following in ./backend:
+    python3 load_test.py --server_url http://127.0.0.1:5555 --access_code demo
+
+With --replay_dir, each writer replays a recorded log instead: it starts a
+session, requests suggestions with the document at each suggestion-get event
+at the recorded times (see --speedup and --max_gap), and ends the session with
+the log. To plan capacity without calling the API, run the backend against a
+mock API (see mock_provider.py) and test several levels of concurrency:
+    python3 mock_provider.py --port 5600 --latency 0.5
+    python3 api_server.py --api_base http://127.0.0.1:5600/v1 ...
+    python3 load_test.py --replay_dir ../logs --concurrency 1,8,32 --speedup 10
+"""
+
+import random
+from time import time, sleep
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from reader import read_log
+from document import Document
+from log_index import LogIndex
+
+
+def generate_events(num_events, seed=0):
+    rng = random.Random(seed)
+    events = [{
+        'eventName': 'system-initialize',
+        'eventSource': 'api',
+        'eventTimestamp': 0,
+        'textDelta': '',
+        'currentDoc': '',
+        'currentCursor': 0,
+    }]
+    for i in range(1, num_events):
+        events.append({
+            'eventName': 'text-insert',
+            'eventSource': 'user',
+            'eventTimestamp': i * 100,
+            'textDelta': {'ops': [{'retain': i - 1}, {'insert': rng.choice('abcdefg ')}]},
+            'currentDoc': '',
+            'currentCursor': i,
+        })
+    return events
+
+
+def get_replay_script(log_path, max_gap):
+    """Return the events of a log and (seconds from the start, document) for each suggestion request.
+
+    Gaps between events longer than max_gap seconds are shortened to max_gap.
+    """
+    events = read_log(log_path)
+    for i, event in enumerate(events):
+        if event['eventName'] == 'system-initialize':
+            break
+    events = events[i:]
+    if not events:
+        return events, []
+
+    document = Document(events[0]['currentDoc'].strip(), 'P')
+    queries = []
+    offset = 0
+    prev_timestamp = events[0]['eventTimestamp']
+    for event in events:
+        offset += min(max(event['eventTimestamp'] - prev_timestamp, 0) / 1000, max_gap)
+        prev_timestamp = event['eventTimestamp']
+        if isinstance(event['textDelta'], dict) and 'ops' in event['textDelta']:
+            document.apply_ops(event['textDelta']['ops'], event['eventSource'])
+        if event['eventName'] == 'suggestion-get':
+            queries.append((offset, document.get_text()))
+    return events, queries
+
+
+def get_query(session, doc):
+    return {
+        'session_id': session['session_id'],
+        'domain': session['domain'],
+        'example': session['example'],
+        'doc': doc,
+        'n': session['n'],
+        'max_tokens': session['max_tokens'],
+        'temperature': session['temperature'],
+        'top_p': session['top_p'],
+        'presence_penalty': session['presence_penalty'],
+        'frequency_penalty': session['frequency_penalty'],
+        'stop': session['stop'],
+        'engine': session['engine'],
+        'suggestions': [],
+    }
+
+
+class Client:
+    """Sends requests to the backend and records (API method, latency, error) for each."""
+
+    def __init__(self, server_url, records):
+        self.server_url = server_url
+        self.records = records
+        self.http = requests.Session()
+
+    def post(self, api_method, data, check=True):
+        """Return the results of a request, or None if it failed (raise if check is set)."""
+        start = time()
+        try:
+            response = self.http.post(f'{self.server_url}/api/{api_method}', json=data)
+            response.raise_for_status()
+            results = response.json()
+            error = None if results.get('status', True) else results.get('message')
+        except Exception as e:
+            results, error = None, str(e)
+        self.records.append((api_method, time() - start, error is not None))
+
+        if error is not None:
+            if check:
+                raise RuntimeError(f'{api_method} failed: {error}')
+            return None
+        return results
+
+    def start_session(self, access_code):
+        return self.post('start_session', {'domain': '', 'accessCode': access_code})
+
+
+def run_writer(args, writer_id, records):
+    client = Client(args.server_url, records)
+    session = client.start_session(args.access_code)
+    session_id = session['session_id']
+
+    events = generate_events(args.num_events, seed=writer_id)
+    for seq in range(0, len(events), args.batch_size):
+        client.post('append_log', {'sessionId': session_id, 'seq': seq, 'logs': events[seq:seq + args.batch_size]})
+
+    for _ in range(args.num_queries):
+        client.post('query', get_query(session, 'Once upon a time,'), check=False)
+
+    client.post('end_session', {'sessionId': session_id, 'numLogs': len(events)})
+    client.post('get_log', {'sessionId': session_id})
+
+
+def run_replay(args, script, records):
+    events, queries = script
+    client = Client(args.server_url, records)
+    session = client.start_session(args.access_code)
+
+    start = time()
+    for offset, doc in queries:
+        sleep(max(start + offset / args.speedup - time(), 0))
+        # Keep going like users do when suggestions fail
+        client.post('query', get_query(session, doc), check=False)
+
+    client.post('end_session', {'sessionId': session['session_id'], 'logs': events})
+
+
+def run_level(args, concurrency, scripts):
+    """Run all writers with the given concurrency and return (records, number of failed writers, elapsed time)."""
+    records = []
+    start = time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if scripts:
+            futures = [
+                executor.submit(run_replay, args, scripts[i % len(scripts)], records)
+                for i in range(args.num_writers)
+            ]
+        else:
+            futures = [executor.submit(run_writer, args, i, records) for i in range(args.num_writers)]
+
+        num_failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                num_failed += 1
+                print(f'# Writer failed: {e}')
+    return records, num_failed, time() - start
+
+
+def get_summary(records, elapsed):
+    """Return (throughput, p50, p95, p99 in ms, error rate) of the records."""
+    if not records:
+        return 0, 0, 0, 0, 0
+    values = np.array([latency for _, latency, _ in records]) * 1000
+    num_errors = sum(is_error for _, _, is_error in records)
+    return (
+        len(records) / elapsed,
+        np.percentile(values, 50),
+        np.percentile(values, 95),
+        np.percentile(values, 99),
+        num_errors / len(records),
+    )
+
+
+def print_level(args, concurrency, records, num_failed, elapsed):
+    num_errors = sum(is_error for _, _, is_error in records)
+    print(f'Writers: {args.num_writers} ({num_failed} failed), concurrency: {concurrency}')
+    print(f'Requests: {len(records)} in {elapsed:.2f} s ({len(records) / elapsed:.1f} requests/s, {num_errors} errors)')
+    for api_method in sorted(set(api_method for api_method, _, _ in records)):
+        _, p50, p95, p99, error_rate = get_summary([record for record in records if record[0] == api_method], elapsed)
+        print(f'  {api_method:15} p50 {p50:8.1f} ms  p95 {p95:8.1f} ms  p99 {p99:8.1f} ms  errors {error_rate:6.1%}')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--server_url', type=str, default='http://127.0.0.1:5555')
+    parser.add_argument('--access_code', type=str, default='demo')
+    parser.add_argument('--num_writers', type=int, default=200)
+    parser.add_argument('--concurrency', type=str, default='32')  # Comma-separated levels, e.g. 1,8,32
+    parser.add_argument('--num_events', type=int, default=200)
+    parser.add_argument('--batch_size', type=int, default=20)
+    parser.add_argument('--num_queries', type=int, default=0)
+    parser.add_argument('--replay_dir', type=str, default=None)  # Replay logs instead of generating events
+    parser.add_argument('--speedup', type=float, default=1.0)  # Replay logs faster than recorded
+    parser.add_argument('--max_gap', type=float, default=30.0)  # Longest pause between events in seconds
+    args = parser.parse_args()
+
+    scripts = []
+    if args.replay_dir:
+        for log_path in sorted(LogIndex(args.replay_dir).log_paths.values()):
+            try:
+                scripts.append(get_replay_script(log_path, args.max_gap))
+            except Exception as e:
+                print(f'# Failed to read {log_path}: {e}')
+        if not scripts:
+            raise RuntimeError(f'Cannot find logs to replay in {args.replay_dir}')
+        num_queries = sum(len(queries) for _, queries in scripts)
+        print(f'Replaying {len(scripts)} logs with {num_queries} suggestion requests')
+
+    summaries = []
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        records, num_failed, elapsed = run_level(args, concurrency, scripts)
+        print_level(args, concurrency, records, num_failed, elapsed)
+        query_records = [record for record in records if record[0] == 'query']
+        summaries.append((concurrency, get_summary(query_records, elapsed)))
+
+    if len(summaries) > 1 and any(summary[0] for _, summary in summaries):
+        print('Queries by concurrency:')
+        for concurrency, (throughput, p50, p95, p99, error_rate) in summaries:
+            print(f'  {concurrency:4}  {throughput:7.1f} queries/s  p50 {p50:8.1f} ms  '
+                  f'p95 {p95:8.1f} ms  p99 {p99:8.1f} ms  errors {error_rate:6.1%}')
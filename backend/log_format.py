@@ -0,0 +1,235 @@
+"""
+Stores session logs in a compact columnar format (.clog).
+
+Events are grouped in blocks, and each key (column) of the events in a block
+is stored as a separate zlib-compressed chunk, so that the same keys are not
+repeated for every event and only the columns and blocks that are needed are
+decompressed. Integer columns (e.g. eventTimestamp) are delta-encoded.
+
+Layout of a file:
+    b'CLOG' + version (1 byte)
+    column chunks of block 0, block 1, ...
+    footer (zlib-compressed JSON with keys and offsets of chunks)
+    footer length (8 bytes) + b'CLOG'
+
+To convert existing .json/.jsonl logs, run the following in ./backend:
+    python3 log_format.py --log_dir ../logs
+"""
+
+import os
+import json
+import zlib
+import mmap
+import struct
+from argparse import ArgumentParser
+from pathlib import Path
+
+MAGIC = b'CLOG'
+VERSION = 1
+HEADER_SIZE = len(MAGIC) + 1
+TRAILER = struct.Struct('<Q4s')  # Footer length, magic
+
+DEFAULT_BLOCK_SIZE = 256  # Events per block
+
+
+def encode_column(values, missing):
+    """Return a compressed chunk for the values of a key in a block."""
+    chunk = {'missing': missing}
+    missing = set(missing)
+    present_values = [value for i, value in enumerate(values) if i not in missing]
+    if present_values and all(type(value) is int for value in present_values):
+        chunk['deltas'] = [present_values[0]] + [
+            value - prev_value for prev_value, value in zip(present_values, present_values[1:])
+        ]
+    else:
+        chunk['values'] = present_values
+    return zlib.compress(json.dumps(chunk, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_column(data, num_events):
+    """Return values of a key in a block and a set of indices where it is missing."""
+    chunk = json.loads(zlib.decompress(data))
+    missing = set(chunk['missing'])
+    if 'deltas' in chunk:
+        present_values = []
+        value = 0
+        for delta in chunk['deltas']:
+            value += delta
+            present_values.append(value)
+    else:
+        present_values = chunk['values']
+
+    values = []
+    present_values = iter(present_values)
+    for i in range(num_events):
+        values.append(None if i in missing else next(present_values))
+    return values, missing
+
+
+def write_compact_log(path, events, block_size=DEFAULT_BLOCK_SIZE):
+    """Write events to a compact log file at once."""
+    keys = []
+    key_ids = dict()
+    blocks = []
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + bytes([VERSION]))
+
+        for start in range(0, len(events), block_size):
+            block_events = events[start:start + block_size]
+
+            # Keys in the order they first appear
+            block_keys = dict()
+            for event in block_events:
+                for key in event:
+                    block_keys[key] = None
+
+            columns = dict()
+            for key in block_keys:
+                if key not in key_ids:
+                    key_ids[key] = len(keys)
+                    keys.append(key)
+
+                values = [event.get(key) for event in block_events]
+                missing = [i for i, event in enumerate(block_events) if key not in event]
+                chunk = encode_column(values, missing)
+                columns[key_ids[key]] = (f.tell(), len(chunk))
+                f.write(chunk)
+
+            blocks.append({
+                'num_events': len(block_events),
+                'columns': columns,
+            })
+
+        footer = zlib.compress(json.dumps({
+            'keys': keys,
+            'num_events': len(events),
+            'blocks': blocks,
+        }).encode('utf-8'))
+        f.write(footer)
+        f.write(TRAILER.pack(len(footer), MAGIC))
+    os.replace(tmp_path, path)
+
+
+class CompactLogReader:
+    """Memory-mapped reader that decodes only the requested events and keys."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.mmap[:len(MAGIC)] != MAGIC or len(self.mmap) < HEADER_SIZE + TRAILER.size:
+            self.close()
+            raise ValueError(f'Not a compact log: {path}')
+        if self.mmap[len(MAGIC)] != VERSION:
+            self.close()
+            raise ValueError(f'Unsupported version of a compact log: {path}')
+
+        footer_length, _ = TRAILER.unpack(self.mmap[-TRAILER.size:])
+        footer_end = len(self.mmap) - TRAILER.size
+        footer = json.loads(zlib.decompress(self.mmap[footer_end - footer_length:footer_end]))
+
+        self.keys = footer['keys']
+        self.num_events = footer['num_events']
+        self.blocks = footer['blocks']
+
+        # Index of the first event in each block
+        self.block_starts = []
+        num_events = 0
+        for block in self.blocks:
+            self.block_starts.append(num_events)
+            num_events += block['num_events']
+
+    def __len__(self):
+        return self.num_events
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.mmap.close()
+
+    def read(self, start=0, end=None, columns=None):
+        """Return events[start:end] with only the given keys (all keys if None)."""
+        start = max(start, 0)
+        end = self.num_events if end is None else min(end, self.num_events)
+
+        events = []
+        for block_index, block in enumerate(self.blocks):
+            block_start = self.block_starts[block_index]
+            block_end = block_start + block['num_events']
+            if block_end <= start or block_start >= end:
+                continue
+
+            block_events = [dict() for _ in range(block['num_events'])]
+            for key_id, (offset, length) in block['columns'].items():
+                key = self.keys[int(key_id)]
+                if columns is not None and key not in columns:
+                    continue
+                values, missing = decode_column(self.mmap[offset:offset + length], block['num_events'])
+                for i, value in enumerate(values):
+                    if i not in missing:
+                        block_events[i][key] = value
+
+            events.extend(block_events[max(start - block_start, 0):end - block_start])
+        return events
+
+
+def read_compact_log(path, start=0, end=None, columns=None):
+    with CompactLogReader(path) as reader:
+        return reader.read(start, end, columns)
+
+
+def convert_log(log_path, block_size=DEFAULT_BLOCK_SIZE):
+    """Convert a .json or .jsonl log into a compact log next to it and return its path."""
+    from reader import read_log  # Avoid a circular import
+
+    events = read_log(log_path)
+    compact_path = os.path.splitext(log_path)[0] + '.clog'
+    write_compact_log(compact_path, events, block_size)
+
+    # Make sure that the conversion is lossless before using it
+    if read_compact_log(compact_path) != events:
+        os.remove(compact_path)
+        raise ValueError(f'Events changed after conversion: {log_path}')
+    return compact_path
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--log_dir', type=str, required=True)
+    parser.add_argument('--block_size', type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument('--remove_originals', action='store_true')
+    args = parser.parse_args()
+
+    # Prioritize jsonl version as in retrieve_log_paths
+    log_paths = dict()
+    for path in sorted(Path(args.log_dir).rglob('*.json')) + sorted(Path(args.log_dir).rglob('*.jsonl')):
+        log_paths[os.path.splitext(str(path))[0]] = str(path)
+
+    num_converted = 0
+    original_size = 0
+    compact_size = 0
+    for path in log_paths.values():
+        compact_path = os.path.splitext(path)[0] + '.clog'
+        if os.path.exists(compact_path) and os.path.getmtime(compact_path) >= os.path.getmtime(path):
+            continue  # Already converted
+
+        try:
+            convert_log(path, args.block_size)
+        except Exception as e:
+            print(f'# Failed to convert {path}: {e}')
+            continue
+
+        num_converted += 1
+        original_size += os.path.getsize(path)
+        compact_size += os.path.getsize(compact_path)
+        if args.remove_originals:
+            os.remove(path)
+
+    print(f'Converted {num_converted} logs ({original_size:,} bytes -> {compact_size:,} bytes)')
@@ -0,0 +1,134 @@
+"""
+Maintains an index from session IDs to log paths in a replay directory.
+"""
+
+import os
+from threading import Lock
+from time import time
+
+
+class LogIndex:
+    """Session ID -> log path index that is updated incrementally.
+
+    It follows the same rules as retrieve_log_paths: .jsonl files take priority
+    over .json files, and the most recent file is used if a session ID appears
+    more than once. Compact logs (.clog) have the same priority as .jsonl files,
+    so a log converted after it was saved is used. Instead of walking all files on every lookup, it only
+    rescans directories whose modification time has changed (i.e. files have
+    been added, removed, or renamed in them). Modification times of files and
+    subdirectories are recorded when their directory is scanned, so unchanged
+    directories are only checked with stat. Lookups of unknown session IDs
+    refresh the index at most once every miss_refresh_interval seconds.
+    """
+
+    # Rescan directories modified within this window, as mtime can be coarse
+    MTIME_SLACK = 2  # In seconds
+
+    def __init__(self, log_dir, refresh_interval=5, miss_refresh_interval=1):
+        self.log_dir = log_dir
+        self.refresh_interval = refresh_interval  # In seconds
+        self.miss_refresh_interval = miss_refresh_interval  # In seconds
+
+        self.dir_mtimes = dict()  # dir -> (mtime, scan timestamp)
+        self.dir_files = dict()  # dir -> {path: (session_id, mtime)}
+        self.dir_subdirs = dict()  # dir -> [subdir]
+        self.candidates = dict()  # session_id -> {path: mtime}
+        self.log_paths = dict()  # session_id -> path
+        self.last_refresh = 0
+        self.lock = Lock()
+
+        self.refresh()
+
+    def __len__(self):
+        return len(self.log_paths)
+
+    def __getitem__(self, session_id):
+        return self.get(session_id)
+
+    def get(self, session_id):
+        """Return a log path for the session ID or raise KeyError."""
+        if time() - self.last_refresh > self.refresh_interval:
+            self.refresh(self.refresh_interval)
+
+        if session_id not in self.log_paths:
+            # A new log may have been saved since the last refresh
+            self.refresh(self.miss_refresh_interval)
+        return self.log_paths[session_id]
+
+    def refresh(self, min_interval=0):
+        """Rescan modified directories unless the index was refreshed within min_interval seconds."""
+        with self.lock:
+            # Other threads may have refreshed while waiting for the lock
+            if time() - self.last_refresh < min_interval:
+                return
+
+            seen_dirs = set()
+            stack = [self.log_dir]
+            while stack:
+                dir_path = stack.pop()
+                try:
+                    mtime = os.stat(dir_path).st_mtime
+                except OSError:
+                    continue
+                seen_dirs.add(dir_path)
+
+                if self.is_modified(dir_path, mtime):
+                    self.scan_dir(dir_path, mtime)
+
+                stack.extend(self.dir_subdirs[dir_path])
+
+            for dir_path in list(self.dir_mtimes.keys()):
+                if dir_path not in seen_dirs:
+                    self.remove_dir(dir_path)
+            self.last_refresh = time()
+
+    def is_modified(self, dir_path, mtime):
+        if dir_path not in self.dir_mtimes:
+            return True
+        prev_mtime, scan_timestamp = self.dir_mtimes[dir_path]
+        return prev_mtime != mtime or scan_timestamp - mtime < self.MTIME_SLACK
+
+    def scan_dir(self, dir_path, mtime):
+        files = dict()
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                        continue
+                    session_id, ext = os.path.splitext(entry.name)
+                    if ext not in {'.json', '.jsonl', '.clog'} or not entry.is_file():
+                        continue
+                    files[entry.path] = (session_id, entry.stat().st_mtime)
+        except OSError:
+            pass
+
+        self.remove_dir(dir_path)
+        self.dir_mtimes[dir_path] = (mtime, time())
+        self.dir_files[dir_path] = files
+        self.dir_subdirs[dir_path] = subdirs
+        for path, (session_id, file_mtime) in files.items():
+            self.candidates.setdefault(session_id, dict())[path] = file_mtime
+            self.resolve(session_id)
+
+    def remove_dir(self, dir_path):
+        self.dir_mtimes.pop(dir_path, None)
+        self.dir_subdirs.pop(dir_path, None)
+        files = self.dir_files.pop(dir_path, dict())
+        for path, (session_id, _) in files.items():
+            self.candidates[session_id].pop(path, None)
+            self.resolve(session_id)
+
+    def resolve(self, session_id):
+        """Select a log path for a session ID among all candidates."""
+        candidates = self.candidates.get(session_id)
+        if not candidates:
+            self.candidates.pop(session_id, None)
+            self.log_paths.pop(session_id, None)
+            return
+
+        # Prioritize jsonl (or compact) version, and select the most recent version if multiple
+        jsonl_paths = [path for path in candidates if path.endswith(('.jsonl', '.clog'))]
+        paths = jsonl_paths if jsonl_paths else list(candidates.keys())
+        self.log_paths[session_id] = max(paths, key=lambda path: candidates[path])
@@ -0,0 +1,181 @@
+"""
+Appends batches of events to session logs while users are writing.
+"""
+
+import os
+import json
+from contextlib import contextmanager
+from threading import Lock
+from time import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows (only a single process can write)
+
+
+class LogWriter:
+    """Append-only writer for session logs (.jsonl) with deduplication.
+
+    Each batch comes with a sequence number, which is the index of its first
+    event in the session. Events that have already been written (e.g. when the
+    frontend retries a batch) are skipped, and batches that would leave a gap
+    are rejected so that the frontend can resend from the expected index.
+    Instead of syncing every batch to disk, files are synced when at least
+    fsync_interval seconds have passed since the last sync or when the session
+    is finalized. Files are also locked while being written, and only lines
+    appended since the last write are counted, so that multiple processes can
+    append to the same log. A log can also be replaced as a whole (e.g. when
+    the frontend sends all events at the end) under the same locks.
+    The state of a log is kept until it is finalized or idle for idle_ttl
+    seconds, and is never forgotten while a thread holds or waits for its lock.
+    """
+
+    def __init__(self, fsync_interval=5, idle_ttl=86400):
+        self.fsync_interval = fsync_interval  # In seconds
+        self.idle_ttl = idle_ttl  # In seconds
+
+        self.counts = dict()  # path -> (file size, number of events) when last counted
+        self.last_fsync = dict()  # path -> timestamp of the last fsync
+        self.locks = dict()  # path -> lock
+        self.users = dict()  # path -> number of threads holding or waiting for the lock
+        self.last_used = dict()  # path -> timestamp of the last release of the lock
+        self.finalized = set()  # Paths to forget once the lock is released
+        self.last_evicted = time()
+        self.lock = Lock()
+
+    @contextmanager
+    def using(self, path):
+        """Hold the lock of a log, keeping its state until the lock is released."""
+        with self.lock:
+            if time() - self.last_evicted > self.idle_ttl:
+                self.evict_idle()
+            if path not in self.locks:
+                self.locks[path] = Lock()
+            lock = self.locks[path]
+            self.users[path] = self.users.get(path, 0) + 1
+        try:
+            with lock:
+                yield
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                self.last_used[path] = time()
+                if self.users[path] == 0 and path in self.finalized:
+                    self.forget(path)
+
+    def forget(self, path):
+        """Drop the state of a log; counts are recovered from the file if needed."""
+        for states in [self.counts, self.last_fsync, self.locks, self.users, self.last_used]:
+            states.pop(path, None)
+        self.finalized.discard(path)
+
+    def evict_idle(self):
+        """Forget logs that no thread has used for idle_ttl seconds (under self.lock)."""
+        now = time()
+        for path in list(self.locks):
+            if self.users.get(path, 0) == 0 and now - self.last_used.get(path, 0) > self.idle_ttl:
+                self.forget(path)
+        self.last_evicted = now
+
+    def count(self, path):
+        """Return the number of events written (e.g. to resend a rejected batch from)."""
+        with self.using(path):
+            return self.get_count(path)
+
+    def get_count(self, path):
+        """Return the number of events written (count new lines if the file has changed)."""
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        prev_size, count = self.counts.get(path, (0, 0))
+        if size != prev_size:
+            if size < prev_size:
+                prev_size, count = 0, 0  # The file has been replaced
+            with open(path, 'rb') as f:
+                f.seek(prev_size)
+                count += sum(1 for line in f if line.strip())
+            self.counts[path] = (size, count)
+        return count
+
+    def append(self, path, seq, events):
+        """Append events starting at index seq and return the next expected index."""
+        with self.using(path), open_locked(path) as f:
+            count = self.get_count(path)
+            if seq > count:
+                raise ValueError(f'Missing events between {count} and {seq}')
+
+            # Skip events that have already been written
+            events = events[count - seq:]
+            if not events:
+                return count
+
+            for event in events:
+                json.dump(event, f)
+                f.write('\n')
+
+            f.flush()
+            if time() - self.last_fsync.get(path, 0) > self.fsync_interval:
+                os.fsync(f.fileno())
+                self.last_fsync[path] = time()
+
+            count += len(events)
+            self.counts[path] = (os.fstat(f.fileno()).st_size, count)
+            return count
+
+    def overwrite(self, path, events):
+        """Replace a session log with the given events and return the number of events."""
+        with self.using(path), open_locked(path) as f:
+            # Write a temporary file so that readers never see a partial log
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_path, 'w') as tmp:
+                    for event in events:
+                        json.dump(event, tmp)
+                        tmp.write('\n')
+                    tmp.flush()
+                    os.fsync(tmp.fileno())
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            self.counts[path] = (os.path.getsize(path), len(events))
+            self.last_fsync[path] = time()
+            return len(events)
+
+    def finalize(self, path):
+        """Sync a session log to disk and return the number of events in it."""
+        with self.using(path):
+            if os.path.exists(path):
+                with open_locked(path) as f:
+                    count = self.get_count(path)
+                    os.fsync(f.fileno())
+            else:
+                count = 0
+
+            # Forget the session once no other thread uses the log
+            with self.lock:
+                self.finalized.add(path)
+        return count
+
+
+def lock_file(f):
+    """Lock a file against other processes until it is closed."""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def open_locked(path):
+    """Open a log for appending and lock it.
+
+    If another process replaced the log while waiting for the lock, the
+    replaced file is reopened so that no events are appended to it.
+    """
+    while True:
+        f = open(path, 'a')
+        lock_file(f)  # Released when the file is closed
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
@@ -0,0 +1,265 @@
+"""
+Stores session metadata (access code and configurations for each session).
+
+MetadataStore keeps metadata.txt as is and reads only new lines, while
+SQLiteMetadataStore keeps metadata in an SQLite database. To import an existing
+metadata.txt into a database, run:
+    python3 metadata_store.py --metadata_path ../logs/metadata.txt --db_path ../logs/metadata.db
+The backend also imports metadata.txt when it creates a database.
+"""
+
+import os
+import json
+import sqlite3
+import atexit
+import collections
+from threading import Lock, Timer
+from argparse import ArgumentParser
+
+
+class MetadataStore:
+    """Metadata in a JSON lines file indexed by session ID and access code.
+
+    The file is read incrementally from the byte offset where the previous read
+    stopped, so each lookup only parses sessions appended since then. New
+    sessions are buffered and written in batches.
+    """
+
+    def __init__(self, path, flush_interval=1, max_buffer_size=100):
+        self.path = path
+        self.flush_interval = flush_interval  # In seconds
+        self.max_buffer_size = max_buffer_size
+
+        self.sessions = dict()  # session_id -> metadata
+        self.access_codes = collections.defaultdict(list)  # access_code -> [session_id]
+        self.offset = 0
+
+        self.buffer = []
+        self.timer = None
+        self.lock = Lock()
+
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write('')
+        self.update()
+        atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        """Return metadata for a session ID or None."""
+        self.update()
+        return self.sessions.get(session_id)
+
+    def get_by_access_code(self, access_code):
+        """Return metadata for all sessions with an access code."""
+        self.update()
+        return [self.sessions[session_id] for session_id in self.access_codes[access_code]]
+
+    def update(self):
+        """Read sessions appended to the file since the last read."""
+        with self.lock:
+            if os.path.getsize(self.path) < self.offset:
+                # The file has been truncated or replaced; read from scratch
+                self.sessions = dict()
+                self.access_codes = collections.defaultdict(list)
+                self.offset = 0
+
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break  # Partially written line; read it next time
+                    self.offset += len(line)
+
+                    line = line.strip()
+                    if not line:  # Skip empty line at the end
+                        continue
+                    self.index(json.loads(line))
+
+    def index(self, session):
+        session_id = session['session_id']
+
+        # Overwrite with the most recent history
+        if session_id not in self.sessions:
+            self.access_codes[session.get('access_code')].append(session_id)
+        self.sessions[session_id] = session
+
+    def append(self, session):
+        with self.lock:
+            self.index(session)
+            self.buffer.append(session)
+            if len(self.buffer) >= self.max_buffer_size:
+                self.write()
+            elif self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+
+        try:
+            # Write all lines at once so that lines from other processes are not interleaved
+            data = ''.join(json.dumps(session) + '\n' for session in self.buffer)
+            with open(self.path, 'ab', buffering=0) as f:
+                f.write(data.encode('utf-8'))
+            self.buffer = []
+        except Exception as e:
+            print('Failed to write access code history')
+            print(e)
+
+
+class SQLiteMetadataStore:
+    """Metadata in an SQLite database indexed by session ID and access code."""
+
+    def __init__(self, db_path, flush_interval=1, max_buffer_size=100):
+        self.db_path = db_path
+        self.flush_interval = flush_interval  # In seconds
+        self.max_buffer_size = max_buffer_size
+
+        self.buffer = collections.OrderedDict()  # session_id -> metadata
+        self.timer = None
+        self.lock = Lock()
+
+        # Wait for other processes writing to the same database
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS metadata ('
+                'session_id TEXT PRIMARY KEY, access_code TEXT, data TEXT)'
+            )
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS metadata_access_code ON metadata (access_code)'
+            )
+        atexit.register(self.flush)
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM metadata').fetchone()[0] + len(self.buffer)
+
+    def get(self, session_id):
+        """Return metadata for a session ID or None."""
+        with self.lock:
+            if session_id in self.buffer:
+                return self.buffer[session_id]
+            row = self.conn.execute(
+                'SELECT data FROM metadata WHERE session_id = ?', (session_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_access_code(self, access_code):
+        """Return metadata for all sessions with an access code."""
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT data FROM metadata WHERE access_code = ?', (access_code,)
+            ).fetchall()
+            sessions = [json.loads(row[0]) for row in rows]
+            sessions.extend(
+                session for session in self.buffer.values()
+                if session.get('access_code') == access_code
+            )
+        return sessions
+
+    def append(self, session):
+        with self.lock:
+            self.buffer[session['session_id']] = session
+            if len(self.buffer) >= self.max_buffer_size:
+                self.write()
+            elif self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def extend(self, sessions):
+        with self.lock:
+            for session in sessions:
+                self.buffer[session['session_id']] = session
+            self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def close(self):
+        with self.lock:
+            self.write()
+            self.conn.close()
+
+    def write(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.buffer:
+            return
+
+        rows = [
+            (session_id, session.get('access_code'), json.dumps(session))
+            for session_id, session in self.buffer.items()
+        ]
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO metadata (session_id, access_code, data) VALUES (?, ?, ?)',
+                    rows
+                )
+            self.buffer = collections.OrderedDict()
+        except Exception as e:
+            print('Failed to write access code history')
+            print(e)
+
+
+def import_metadata(metadata_path, db_path):
+    """Import an existing metadata.txt into an SQLite database."""
+    store = SQLiteMetadataStore(db_path)
+
+    sessions = []
+    with open(metadata_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            sessions.append(json.loads(line))
+    store.extend(sessions)  # The most recent history overwrites older ones
+    store.close()
+    return len(sessions)
+
+
+def create_metadata_db(db_path, metadata_path):
+    """Create a database with the sessions in metadata.txt and return the number imported.
+
+    The database is imported under a temporary name and then linked into
+    place, so that other processes (e.g. gunicorn workers starting at once)
+    either see the complete database or create it themselves.
+    """
+    tmp_path = f'{db_path}.{os.getpid()}.tmp'
+    try:
+        num_sessions = import_metadata(metadata_path, tmp_path)
+        os.link(tmp_path, db_path)
+    except FileExistsError:
+        num_sessions = 0  # Created by another process
+    finally:
+        for path in [tmp_path, tmp_path + '-wal', tmp_path + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
+    return num_sessions
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--metadata_path', type=str, required=True)
+    parser.add_argument('--db_path', type=str, required=True)
+    args = parser.parse_args()
+
+    num_sessions = import_metadata(args.metadata_path, args.db_path)
+    print(f'Imported {num_sessions} lines from {args.metadata_path} to {args.db_path}')
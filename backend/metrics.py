@@ -0,0 +1,259 @@
+"""
+Records latencies and counts of the backend and exposes them for Prometheus.
+
+Metrics are kept in memory and rendered in the Prometheus text format at
+/metrics. Recording a value takes a lock and a binary search, so it can be
+done on every request. Each process keeps its own metrics (e.g. each gunicorn
+worker), so scrape each worker or aggregate them in Prometheus.
+"""
+
+import bisect
+import contextvars
+from threading import Lock
+from time import perf_counter
+
+from providers import ProviderError
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]  # In seconds
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label_names, label_values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.lock = Lock()
+
+    def get_key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.render_samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self.values = dict()  # label values -> value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            f'{self.name}{format_labels(self.label_names, key)} {format_value(value)}'
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = list(buckets)
+        self.values = dict()  # label values -> [counts per bucket (not cumulative), sum, count]
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts_sum_count = self.values[key]
+            counts_sum_count[0][index] += 1
+            counts_sum_count[1] += value
+            counts_sum_count[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def render_samples(self):
+        with self.lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+
+        lines = []
+        for key, (counts, total, count) in values:
+            cumulative_count = 0
+            for bound, bucket_count in zip(self.buckets + [float('inf')], counts):
+                cumulative_count += bucket_count
+                le = format_labels(self.label_names, key, f'le="{format_value(bound)}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative_count}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, key)} {count}')
+        return lines
+
+
+class Callback(Metric):
+    """A gauge or counter whose value is read from a function when rendered."""
+
+    def __init__(self, name, help_text, func, metric_type='gauge'):
+        super().__init__(name, help_text)
+        self.func = func
+        self.type = metric_type
+
+    def render_samples(self):
+        try:
+            return [f'{self.name} {format_value(self.func())}']
+        except Exception as e:
+            print(f'# Failed to read metric {self.name}: {e}')
+            return []
+
+
+class Timer:
+    """Context manager that observes the elapsed time in a histogram."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = dict()  # name -> Metric
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric  # Replace a callback registered again (e.g. by setup)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Registry()
+
+REQUEST_LATENCY = METRICS.register(Histogram(
+    'api_request_duration_seconds',
+    'Time to handle a request to the backend (until the whole response is sent).',
+    ['endpoint', 'engine', 'access_code'],
+))
+STAGE_LATENCY = METRICS.register(Histogram(
+    'api_stage_duration_seconds',
+    'Time spent in each stage of a query.',
+    ['stage', 'engine', 'access_code'],
+))
+PROVIDER_REQUESTS = METRICS.register(Counter(
+    'provider_requests_total',
+    'Requests to model APIs by HTTP status (429 if rate-limited, error if no response).',
+    ['engine', 'status'],
+))
+PROVIDER_TOKENS = METRICS.register(Counter(
+    'provider_tokens_total',
+    'Tokens used by model APIs (completion tokens only for streamed choices).',
+    ['engine', 'type'],
+))
+
+# Labels of the request being handled, filled in by handlers once the session is known
+REQUEST_LABELS = contextvars.ContextVar('request_labels', default=None)
+
+
+def start_request():
+    """Start collecting labels for a request and return them."""
+    labels = {'engine': '', 'access_code': ''}
+    REQUEST_LABELS.set(labels)
+    return labels
+
+
+def set_request_labels(config, engine=None):
+    """Label the current request with the engine and access code of a session (or metadata)."""
+    labels = REQUEST_LABELS.get()
+    if labels is None or not config:
+        return
+    labels['engine'] = engine or config.get('engine') or ''
+    labels['access_code'] = config.get('access_code') or ''
+
+
+def with_request_labels(func):
+    """Wrap func to label metrics with the current request when it is run in another thread."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)  # A copy for each call, as calls may overlap
+    return run
+
+
+def get_access_code():
+    labels = REQUEST_LABELS.get()
+    return labels['access_code'] if labels else ''
+
+
+def time_stage(stage, engine):
+    return STAGE_LATENCY.time(stage=stage, engine=engine or '', access_code=get_access_code())
+
+
+def record_provider_call(engine, start, response=None, error=None):
+    """Count a call to a model API and the tokens it used."""
+    engine = engine or ''
+    if error is not None:
+        status = getattr(error, 'status', None) if isinstance(error, ProviderError) else None
+        PROVIDER_REQUESTS.inc(engine=engine, status=str(status) if status else 'error')
+        return
+
+    STAGE_LATENCY.observe(perf_counter() - start, stage='provider', engine=engine, access_code=get_access_code())
+    PROVIDER_REQUESTS.inc(engine=engine, status='200')
+    if isinstance(response, dict) and 'usage' in response:
+        for token_type in ['prompt_tokens', 'completion_tokens']:
+            PROVIDER_TOKENS.inc(response['usage'].get(token_type, 0), engine=engine, type=token_type)
+    elif isinstance(response, dict) and 'logprobs' in response:  # A streamed choice
+        PROVIDER_TOKENS.inc(len(response['logprobs']['tokens']), engine=engine, type='completion_tokens')
+
+
+def track_provider_call(engine, func, api_key):
+    """Call func(api_key) and record its latency, status, and token usage."""
+    start = perf_counter()
+    try:
+        response = func(api_key)
+    except Exception as e:
+        record_provider_call(engine, start, error=e)
+        raise
+    record_provider_call(engine, start, response)
+    return response
+
+
+async def atrack_provider_call(engine, func, api_key):
+    """Await func(api_key) and record its latency, status, and token usage."""
+    start = perf_counter()
+    try:
+        response = await func(api_key)
+    except Exception as e:
+        record_provider_call(engine, start, error=e)
+        raise
+    record_provider_call(engine, start, response)
+    return response
@@ -0,0 +1,127 @@
+"""
+Serves a local mock of the OpenAI Completions API for load tests.
+
+Outputs are generated like FakeProvider (random sentences with logprobs and
+usage), and each request waits for a time to first token sampled from a
+latency distribution plus the time to generate its tokens at a fixed
+throughput. A fraction of requests can fail with 500 or be rate-limited with
+429. Run the following in ./backend and point the backend to it:
+    python3 mock_provider.py --port 5600 --latency 0.5 --latency_dist lognormal
+    python3 api_server.py --api_base http://127.0.0.1:5600/v1 ...
+"""
+
+import json
+import math
+import random
+import time
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from providers import FakeProvider
+
+
+def sample_latency(args):
+    """Return a time to first token (in seconds) from the latency distribution."""
+    if args.latency_dist == 'constant':
+        return args.latency
+    elif args.latency_dist == 'uniform':
+        return random.uniform(args.latency * (1 - args.latency_spread), args.latency * (1 + args.latency_spread))
+    elif args.latency_dist == 'lognormal':
+        return args.latency * math.exp(random.gauss(0, args.latency_spread))  # latency is the median
+    elif args.latency_dist == 'exponential':
+        return random.expovariate(1 / args.latency) if args.latency > 0 else 0
+    raise ValueError(f'Unknown latency distribution: {args.latency_dist}')
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive like the API
+    args = None
+    provider = FakeProvider()
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/completions'):
+            self.send_json(404, {'error': {'message': f'Unknown path: {self.path}'}})
+            return
+
+        try:
+            completion = json.loads(body)
+            completion['engine'] = completion.pop('model')
+        except Exception as e:
+            self.send_json(400, {'error': {'message': f'Invalid request: {e}'}})
+            return
+
+        value = random.random()
+        if value < self.args.rate_limit_rate:
+            self.send_json(429, {'error': {'message': 'Rate limit reached'}}, {'Retry-After': '1'})
+            return
+        if value < self.args.rate_limit_rate + self.args.error_rate:
+            self.send_json(500, {'error': {'message': 'The server had an error'}})
+            return
+
+        time.sleep(sample_latency(self.args))
+        if completion.get('stream'):
+            self.stream(completion)
+        else:
+            response = self.provider.get_response(completion)
+            # Choices are generated in parallel
+            num_tokens = max(len(choice['logprobs']['tokens']) for choice in response['choices'])
+            time.sleep(num_tokens / self.args.tokens_per_second)
+            self.send_json(200, response)
+
+    def stream(self, completion):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')  # The end of the stream is the end of the response
+        self.end_headers()
+
+        chunk_latency = 1 / (self.args.tokens_per_second * max(completion.get('n', 1), 1))
+        try:
+            for chunk in self.provider.get_chunks(completion):
+                time.sleep(chunk_latency)
+                self.wfile.write(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The backend stopped the stream early
+        self.close_connection = True
+
+
+def get_parser():
+    parser = ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5600)
+    parser.add_argument('--latency', type=float, default=0.5)  # Time to first token in seconds (median for lognormal)
+    parser.add_argument('--latency_dist', type=str, choices=['constant', 'uniform', 'lognormal', 'exponential'], default='lognormal')
+    parser.add_argument('--latency_spread', type=float, default=0.5)  # Sigma for lognormal, relative half-width for uniform
+    parser.add_argument('--tokens_per_second', type=float, default=50)  # For each choice
+    parser.add_argument('--error_rate', type=float, default=0.0)  # Fraction of requests that fail with 500
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0)  # Fraction of requests that fail with 429
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    MockHandler.args = args
+
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f'Mock completions API at http://{args.host}:{server.server_port}/v1 '
+          f'({args.latency_dist} latency of {args.latency} s, {args.tokens_per_second} tokens/s)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -2,21 +2,33 @@
 Parse user prompts and responses from the OpenAI API.
 """
 
-from nltk.tokenize import sent_tokenize, word_tokenize
+import re
+import functools
+
+import nltk
 import numpy as np
 
+from blocklist import BlocklistMatcher
+from tokenizer import get_truncation_start, snap_to_boundary
+
 
-def parse_prompt(text, max_tokens, context_window_size):
-    """Separate prompt and whitespace at the end while retaining newlines."""
+def parse_prompt(text, max_tokens, context_window_size, engine=None, prefix=''):
+    """Separate prompt and whitespace at the end while retaining newlines.
+
+    If the prompt does not fit in the context window with max_tokens, the
+    beginning of it is removed up to a line or sentence boundary. Tokens are
+    counted with the tokenizer of the engine if available, reusing the tokens
+    of a prefix of the text (e.g. an example) across queries.
+    """
 
     # Check the number of tokens in a prompt
-    max_prompt_len = (context_window_size - max_tokens) * 4
+    max_prompt_tokens = context_window_size - max_tokens
+    start = get_truncation_start(text, max_prompt_tokens, engine, prefix)
+    if start > 0:
+        start = snap_to_boundary(text, start)
 
-    before_prompt = ''
-    prompt = text
-    if len(text) > max_prompt_len:
-        before_prompt = text[:-max_prompt_len]
-        prompt = text[-max_prompt_len:]
+    before_prompt = text[:start]
+    prompt = text[start:]
 
     lines = prompt.split('\n')
     removed = lines[-1].rstrip()
@@ -88,6 +100,29 @@ def parse_probability(
     return prob * 100
 
 
+@functools.lru_cache(maxsize=None)
+def get_sentence_tokenizer(language='english'):
+    """Load the Punkt model used by sent_tokenize once."""
+    try:
+        from nltk.tokenize import _get_punkt_tokenizer  # NLTK >= 3.8.2
+        return _get_punkt_tokenizer(language)
+    except ImportError:
+        return nltk.data.load(f'tokenizers/punkt/{language}.pickle')
+
+
+def get_first_sentence(text):
+    """Return sent_tokenize(text)[0] (or None) without tokenizing the rest.
+
+    Punkt yields sentence spans lazily, so this stops right after the
+    boundary of the first sentence is confirmed by the next sentence.
+    """
+    tokenizer = get_sentence_tokenizer()
+    span = next(iter(tokenizer.span_tokenize(text)), None)
+    if span is None:
+        return None
+    return text[span[0]:span[1]]
+
+
 def parse_suggestion(
     suggestion,
     after_prompt,
@@ -101,11 +136,11 @@ def parse_suggestion(
 
     # Return the first sentence and discard the rest
     if '.' in stop_rules:
-        sentences = sent_tokenize(processed_suggestion)
-        if not sentences:
+        first_sentence = get_first_sentence(processed_suggestion)
+        if first_sentence is None:
             return ''
 
-        first_sentence = sentences[0].strip().split('\n')[0]
+        first_sentence = first_sentence.strip().split('\n')[0]
 
         # Retain the preceeding whitespace
         start = processed_suggestion.index(first_sentence)
@@ -114,6 +149,45 @@ def parse_suggestion(
     return processed_suggestion
 
 
+class FirstSentenceDetector:
+    """Detect when the first sentence of a streamed suggestion is complete.
+
+    Once feed() returns True, parse_suggestion on the text received so far
+    gives the same result as on the full suggestion with the '.' stop rule,
+    so the rest of the generation can be discarded.
+    """
+
+    def __init__(self, after_prompt):
+        self.after_prompt = after_prompt
+        self.text = ''
+        self.is_complete = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if not self.is_complete:
+            self.is_complete = self.check()
+        return self.is_complete
+
+    def check(self):
+        text = self.text
+        if text.startswith(self.after_prompt):
+            text = text[len(self.after_prompt):]
+
+        # The first sentence is cut at the first newline after it begins
+        if '\n' in text.lstrip():
+            return True
+
+        # Punkt decides on a boundary from the token that follows it, so the
+        # first sentence is final once the next one has a complete token
+        tokenizer = get_sentence_tokenizer()
+        spans = tokenizer.span_tokenize(text)
+        next(spans, None)
+        second_span = next(spans, None)
+        if second_span is None:
+            return False
+        return re.search(r'\S\s', text[second_span[0]:]) is not None
+
+
 def filter_suggestions(
     suggestions,
     prev_suggestions,
@@ -125,8 +199,11 @@ def filter_suggestions(
     """
     Parameters:
         suggestions: a list of (suggestion, probability)
-        blocklist: a set of strings
+        blocklist: a BlocklistMatcher (or a set of strings to compile)
     """
+    if not isinstance(blocklist, BlocklistMatcher):
+        blocklist = BlocklistMatcher(blocklist)
+
     filtered_suggestions = []
     duplicates = set([prev_sugg['original'] for prev_sugg in prev_suggestions])
 
@@ -149,8 +226,7 @@ def filter_suggestions(
 
         # Filter out potentially offensive language
         if use_blocklist:
-            words = word_tokenize(suggestion.lower())
-            if any([word in words for word in blocklist]):
+            if blocklist.matches(suggestion):
                 bad_cnt += 1
                 print(f'bad_cnt: {suggestion}')
                 continue
@@ -0,0 +1,100 @@
+"""
+Stores model outputs that are requested in advance while users pause typing.
+"""
+
+import collections
+from threading import Lock
+from time import time
+
+
+class PrefetchStore:
+    """Bounded store of pending or finished completions per session.
+
+    Each entry is a future (concurrent.futures.Future or asyncio.Task) keyed on
+    a hash of the effective prompt and decoding parameters for the current doc.
+    Only the most recent entries are kept for each session, and entries older
+    than the time-to-live (TTL) are evicted and cancelled.
+    """
+
+    def __init__(self, max_per_session=2, max_sessions=1024, ttl=60):
+        self.max_per_session = max_per_session
+        self.max_sessions = max_sessions
+        self.ttl = ttl  # In seconds
+
+        self.sessions = collections.OrderedDict()  # session_id -> OrderedDict(key -> (timestamp, future))
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, session_id, key, start):
+        """Return the future stored for the key, or store and return start() if there is none.
+
+        The check and the insertion are done at once, so identical prefetches
+        that arrive together start only one request.
+        """
+        with self.lock:
+            self.evict_stale()
+
+            entries = self.sessions.setdefault(session_id, collections.OrderedDict())
+            self.sessions.move_to_end(session_id)
+            if key in entries:
+                return entries[key][1]
+
+            future = start()
+            entries[key] = (time(), future)
+
+            # Keep only the most recent prefetches for the session
+            while len(entries) > self.max_per_session:
+                _, (_, old_future) = entries.popitem(last=False)
+                self.cancel(old_future)
+
+            # Keep only the most recently active sessions
+            while len(self.sessions) > self.max_sessions:
+                _, old_entries = self.sessions.popitem(last=False)
+                for _, old_future in old_entries.values():
+                    self.cancel(old_future)
+            return future
+
+    def pop(self, session_id, key):
+        """Return a prefetched future for the doc (and remove it) or None."""
+        with self.lock:
+            self.evict_stale()
+
+            entries = self.sessions.get(session_id)
+            if not entries or key not in entries:
+                self.misses += 1
+                return None
+
+            _, future = entries.pop(key)
+            if not entries:
+                del self.sessions[session_id]
+            self.hits += 1
+            return future
+
+    def evict_stale(self):
+        current_timestamp = time()
+        for session_id in list(self.sessions.keys()):
+            entries = self.sessions[session_id]
+            for key in list(entries.keys()):
+                timestamp, future = entries[key]
+                if current_timestamp - timestamp > self.ttl:
+                    del entries[key]
+                    self.cancel(future)
+            if not entries:
+                del self.sessions[session_id]
+
+    def cancel(self, future):
+        future.cancel()
+        self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            size = sum(len(entries) for entries in self.sessions.values())
+        return {
+            'size': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,357 @@
+"""
+Sends completion requests to model APIs (hosts in api_keys.csv).
+
+Each host has a provider that keeps connections alive in a pool shared by all
+requests and rotates through the keys of a domain (falling back to the
+'default' domain). Engines are routed to hosts by a prefix, e.g. 'fake/echo'
+goes to FakeProvider, and engines without a prefix go to OpenAI. To add a
+host, subclass Provider and register it in PROVIDER_CLASSES.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import itertools
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HOST = 'openai'
+DEFAULT_DOMAIN = 'default'
+
+DONE = object()  # End of a stream
+
+
+class ProviderError(RuntimeError):
+    """An error returned by a model API (with its HTTP status if any)."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after  # In seconds
+
+
+def split_engine(engine):
+    """Return (host, model) for an engine such as 'openai/text-davinci-003' or 'davinci'."""
+    if engine and '/' in engine:
+        host, model = engine.split('/', 1)
+        if host in PROVIDER_CLASSES:
+            return host, model
+    return DEFAULT_HOST, engine
+
+
+class KeyPool:
+    """API keys of a domain used in turn (round-robin)."""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.cycle = itertools.cycle(self.keys)
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def next(self):
+        with self.lock:
+            return next(self.cycle)
+
+
+class Provider:
+    """Base class of model APIs.
+
+    Subclasses implement create and stream for threads and acreate and astream
+    for asyncio. They take the arguments of a completion request with a model
+    name in 'engine' and return outputs in the format of the OpenAI API.
+    """
+
+    requires_key = True
+
+    def __init__(self, api_keys, pool_size=64, request_timeout=600):
+        self.key_pools = {
+            domain: KeyPool(keys) for domain, keys in api_keys.items()
+        }  # domain -> KeyPool
+        self.pool_size = pool_size
+        self.request_timeout = request_timeout  # In seconds
+
+    def get_key_pool(self, domain):
+        key_pool = self.key_pools.get(domain) or self.key_pools.get(DEFAULT_DOMAIN)
+        if key_pool is None:
+            raise ProviderError(f'Cannot find an API key for {type(self).__name__} (domain: {domain})')
+        return key_pool
+
+    def get_key(self, domain):
+        return self.get_key_pool(domain).next()
+
+    def get_keys(self, domain):
+        """Return all API keys that can be used for a domain ([None] if keys are not needed)."""
+        if not self.requires_key:
+            return [None]
+        return self.get_key_pool(domain).keys
+
+    def create(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        raise NotImplementedError
+
+    def stream(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        """Yield chunks of a completion; close the generator to stop generating."""
+        raise NotImplementedError
+
+    async def acreate(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        raise NotImplementedError
+
+    async def astream(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        raise NotImplementedError
+        yield
+
+
+class OpenAIProvider(Provider):
+    """OpenAI Completions API over a pooled keep-alive HTTP session."""
+
+    def __init__(self, api_keys, pool_size=64, request_timeout=600, api_base=None):
+        super().__init__(api_keys, pool_size, request_timeout)
+        self.api_base = api_base or os.environ.get('OPENAI_API_BASE', 'https://api.openai.com/v1')
+
+        # Share connections across threads instead of one session per thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=2)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_request(self, completion, domain, api_key=None, stream=False):
+        """Return (url, headers, body) for a completion request."""
+        body = {key: value for key, value in completion.items() if value is not None and key != 'engine'}
+        body['model'] = split_engine(completion['engine'])[1]
+        if stream:
+            body['stream'] = True
+        headers = {'Authorization': f'Bearer {api_key or self.get_key(domain)}'}
+        return f'{self.api_base}/completions', headers, body
+
+    def create(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        url, headers, body = self.get_request(completion, domain, api_key)
+        response = self.session.post(url, headers=headers, json=body, timeout=self.request_timeout)
+        if response.status_code != 200:
+            raise get_error(response.status_code, response.text, response.headers)
+        return response.json()
+
+    def stream(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        url, headers, body = self.get_request(completion, domain, api_key, stream=True)
+        response = self.session.post(url, headers=headers, json=body, timeout=self.request_timeout, stream=True)
+        try:
+            if response.status_code != 200:
+                raise get_error(response.status_code, response.text, response.headers)
+            for line in response.iter_lines():
+                chunk = parse_event_line(line)
+                if chunk is None:
+                    continue
+                if chunk is DONE:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    async def acreate(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        url, headers, body = self.get_request(completion, domain, api_key)
+        async with client_session.post(url, headers=headers, json=body, timeout=self.request_timeout) as response:
+            if response.status != 200:
+                raise get_error(response.status, await response.text(), response.headers)
+            return await response.json()
+
+    async def astream(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        url, headers, body = self.get_request(completion, domain, api_key, stream=True)
+        response = await client_session.post(url, headers=headers, json=body, timeout=self.request_timeout)
+        try:
+            if response.status != 200:
+                raise get_error(response.status, await response.text(), response.headers)
+            async for line in response.content:
+                chunk = parse_event_line(line.strip())
+                if chunk is None:
+                    continue
+                if chunk is DONE:
+                    break
+                yield chunk
+        finally:
+            # Closes the connection if the completion is cut off, so that the API stops generating
+            response.release()
+
+
+def parse_event_line(line):
+    """Return a chunk from a line of Server-Sent Events, DONE at the end, or None."""
+    if not line.startswith(b'data:'):
+        return None
+    data = line[len(b'data:'):].strip()
+    if data == b'[DONE]':
+        return DONE
+    return json.loads(data)
+
+
+def get_error(status, text, headers):
+    try:
+        message = json.loads(text)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        message = text
+    retry_after = headers.get('Retry-After')
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    return ProviderError(f'API error ({status}): {message}', status=status, retry_after=retry_after)
+
+
+FAKE_WORDS = [
+    'the', 'a', 'pig', 'farmer', 'village', 'river', 'walked', 'found', 'saw',
+    'quietly', 'old', 'little', 'house', 'morning', 'and', 'then', 'to', 'of',
+]
+
+
+class FakeProvider(Provider):
+    """Offline completions for tests and load tests (no API key needed).
+
+    Outputs are random sentences, sampled for each request like the API with
+    a positive temperature (and the same for the same request otherwise), and
+    each completion takes latency seconds.
+    """
+
+    requires_key = False
+
+    def __init__(self, api_keys=None, pool_size=64, request_timeout=600, latency=0.0):
+        super().__init__(api_keys or dict(), pool_size, request_timeout)
+        self.latency = latency  # In seconds
+
+    def generate_tokens(self, completion, index):
+        # Same outputs whether they are streamed or not
+        request = {key: value for key, value in completion.items() if key not in {'n', 'stream'}}
+        nonce = random.random() if completion.get('temperature') else None
+        seed = hashlib.sha256(json.dumps([request, index, nonce], sort_keys=True).encode('utf-8')).hexdigest()
+        rng = random.Random(seed)
+
+        tokens = []
+        while len(tokens) < completion.get('max_tokens', 16):
+            sentence = [rng.choice(FAKE_WORDS) for _ in range(rng.randint(3, 8))]
+            sentence[0] = sentence[0].capitalize()
+            sentence[-1] += '.'
+            tokens.extend(' ' + word for word in sentence)
+        tokens = tokens[:completion.get('max_tokens', 16)]
+        token_logprobs = [-rng.random() * 2 for _ in tokens]
+        return tokens, token_logprobs
+
+    def get_choice(self, tokens, token_logprobs, index, offset=0):
+        text_offset = []
+        for token in tokens:
+            text_offset.append(offset)
+            offset += len(token)
+        return {
+            'text': ''.join(tokens),
+            'index': index,
+            'logprobs': {
+                'tokens': tokens,
+                'token_logprobs': token_logprobs,
+                'top_logprobs': [{token: logprob} for token, logprob in zip(tokens, token_logprobs)],
+                'text_offset': text_offset,
+            },
+            'finish_reason': 'length',
+        }
+
+    def get_response(self, completion):
+        choices = []
+        for index in range(completion.get('n', 1)):
+            tokens, token_logprobs = self.generate_tokens(completion, index)
+            choices.append(self.get_choice(tokens, token_logprobs, index))
+        prompt_tokens = len((completion['prompt'] + (completion.get('suffix') or '')).split())
+        completion_tokens = sum(len(choice['logprobs']['tokens']) for choice in choices)
+        return {
+            'object': 'text_completion',
+            'model': split_engine(completion['engine'])[1],
+            'choices': choices,
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        }
+
+    def get_chunks(self, completion):
+        choices = [self.generate_tokens(completion, index) for index in range(completion.get('n', 1))]
+        offsets = [0] * len(choices)
+        for i in range(max(len(tokens) for tokens, _ in choices)):
+            for index, (tokens, token_logprobs) in enumerate(choices):
+                if i >= len(tokens):
+                    continue
+                yield {'choices': [self.get_choice([tokens[i]], [token_logprobs[i]], index, offsets[index])]}
+                offsets[index] += len(tokens[i])
+
+    def get_chunk_latency(self, completion):
+        return self.latency / max(completion.get('max_tokens', 16), 1)
+
+    def create(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        time.sleep(self.latency)
+        return self.get_response(completion)
+
+    def stream(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        for chunk in self.get_chunks(completion):
+            time.sleep(self.get_chunk_latency(completion))
+            yield chunk
+
+    async def acreate(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        await asyncio.sleep(self.latency)
+        return self.get_response(completion)
+
+    async def astream(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        for chunk in self.get_chunks(completion):
+            await asyncio.sleep(self.get_chunk_latency(completion))
+            yield chunk
+
+
+PROVIDER_CLASSES = {
+    'openai': OpenAIProvider,
+    'fake': FakeProvider,
+}
+
+
+class ProviderRouter:
+    """Routes completion requests to providers by engine and domain."""
+
+    def __init__(self, api_keys, pool_size=64, request_timeout=600, options=None):
+        options = options or dict()  # host -> keyword arguments (e.g. {'fake': {'latency': 1.0}})
+
+        # (host, domain) -> keys to host -> domain -> keys
+        keys_by_host = dict()
+        for (host, domain), keys in api_keys.items():
+            keys_by_host.setdefault(host, dict())[domain] = keys
+
+        self.providers = dict()  # host -> Provider
+        for host, provider_class in PROVIDER_CLASSES.items():
+            if host in keys_by_host or not provider_class.requires_key:
+                self.providers[host] = provider_class(
+                    keys_by_host.get(host),
+                    pool_size=pool_size,
+                    request_timeout=request_timeout,
+                    **options.get(host, dict())
+                )
+        for host in keys_by_host:
+            if host not in PROVIDER_CLASSES:
+                print(f'# No provider for API keys of {host}; ignore')
+
+    def get(self, engine):
+        host, _ = split_engine(engine)
+        if host not in self.providers:
+            raise ProviderError(f'Cannot find API keys for {host} (engine: {engine})')
+        return self.providers[host]
+
+    def get_keys(self, engine, domain=DEFAULT_DOMAIN):
+        return self.get(engine).get_keys(domain or DEFAULT_DOMAIN)
+
+    def create(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        return self.get(completion['engine']).create(completion, domain or DEFAULT_DOMAIN, api_key)
+
+    def stream(self, completion, domain=DEFAULT_DOMAIN, api_key=None):
+        return self.get(completion['engine']).stream(completion, domain or DEFAULT_DOMAIN, api_key)
+
+    async def acreate(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        provider = self.get(completion['engine'])
+        return await provider.acreate(completion, client_session, domain or DEFAULT_DOMAIN, api_key)
+
+    def astream(self, completion, client_session, domain=DEFAULT_DOMAIN, api_key=None):
+        return self.get(completion['engine']).astream(completion, client_session, domain or DEFAULT_DOMAIN, api_key)
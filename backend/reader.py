@@ -1,13 +1,25 @@
 import os
 import csv
 import json
+import itertools
 import collections
 
 from access_code import AccessCodeConfig
+from log_format import read_compact_log, CompactLogReader
 
 
 def read_api_keys(config_dir):
-    """Read API keys from a CSV file."""
+    """Read API keys from a CSV file (the last key for each host and domain)."""
+    api_key_pools = read_api_key_pools(config_dir)
+    return {host_domain: keys[-1] for host_domain, keys in api_key_pools.items()}
+
+
+def read_api_key_pools(config_dir):
+    """Read all API keys from a CSV file.
+
+    Return a dictionary with (host, domain) as keys and lists of API keys as
+    values, so that requests can be spread across multiple keys.
+    """
     path = os.path.join(config_dir, 'api_keys.csv')
 
     api_keys = dict()
@@ -20,46 +32,105 @@ def read_api_keys(config_dir):
             host = row['host']  # 'openai', 'ai21labs', 'anthropic', 'eleutherai', etc.
             domain = row['domain']  # 'default', 'story', 'essay', etc.
             
-            api_keys[(host, domain)] = row['key']
+            api_keys.setdefault((host, domain), []).append(row['key'])
     return api_keys
 
 
-def read_log(log_path):
-    """Read a log file."""
+def read_log(log_path, start=0, end=None, columns=None):
+    """Read a log file.
+
+    Optionally, only events in [start, end) with the given keys are returned.
+    Compact logs (.clog) decode only those events and keys.
+    """
     log = []
-    if log_path.endswith('.json'):
+    if log_path.endswith('.clog'):
+        return read_compact_log(log_path, start, end, columns)
+    elif log_path.endswith('.json'):
         with open(log_path, 'r') as f:
             log = json.load(f)
+        log = log[start:end]
     elif log_path.endswith('.jsonl'):
         with open(log_path, 'r') as f:
-            for line in f:
+            for line in itertools.islice(f, start, end):
                 log.append(json.loads(line))
     else:
         print('# Unknown file extension:', log_path)
+
+    if columns is not None:
+        log = [{key: event[key] for key in columns if key in event} for event in log]
     return log
 
 
+def count_log_events(log_path):
+    """Return the number of events in a log without decoding them (except for .json logs)."""
+    if log_path.endswith('.clog'):
+        with CompactLogReader(log_path) as reader:
+            return len(reader)
+    elif log_path.endswith('.jsonl'):
+        num_events = 0
+        last_char = b'\n'
+        with open(log_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                num_events += chunk.count(b'\n')
+                last_char = chunk[-1:]
+        return num_events + (last_char != b'\n')  # The last line may not end with a newline
+    return len(read_log(log_path))
+
+
+def iter_log_lines(log_path, start=0, end=None):
+    """Yield events in [start, end) of a log as JSON strings.
+
+    Lines of .jsonl files are read lazily and passed on without decoding.
+    Compact logs are decoded one block at a time.
+    """
+    if log_path.endswith('.jsonl'):
+        with open(log_path, 'r') as f:
+            for line in itertools.islice(f, start, end):
+                line = line.rstrip('\n')
+                if line:
+                    yield line
+    elif log_path.endswith('.clog'):
+        with CompactLogReader(log_path) as reader:
+            end = len(reader) if end is None else min(end, len(reader))
+            block_ends = reader.block_starts[1:] + [len(reader)]
+            for block_start, block_end in zip(reader.block_starts, block_ends):
+                if block_end <= start or block_start >= end:
+                    continue
+                for event in reader.read(max(block_start, start), min(block_end, end)):
+                    yield json.dumps(event)
+    else:
+        for event in read_log(log_path, start, end):
+            yield json.dumps(event)
+
+
 def read_examples(config_dir):
     """Read all examples from config_dir."""
-    path = os.path.join(config_dir, 'examples')
     examples = {'na': ''}
+    for path in get_example_paths(config_dir):
+        name = os.path.basename(path)[:-4]
+        examples[name] = read_example(path)
+    return examples
+
 
+def get_example_paths(config_dir):
+    path = os.path.join(config_dir, 'examples')
     if not os.path.exists(path):
         print(f'# Path does not exist: {path}')
-        return examples
+        return []
 
     paths = []
     for filename in os.listdir(path):
         if filename.endswith('txt'):
             paths.append(os.path.join(path, filename))
+    return paths
 
-    for path in paths:
-        name = os.path.basename(path)[:-4]
-        with open(path, 'r') as f:
-            text = f.read().replace('\\n', '\n')
-            text = text + ' '
-        examples[name] = text
-    return examples
+
+def read_example(path):
+    """Read an example from a text file."""
+    with open(path, 'r') as f:
+        text = f.read().replace('\\n', '\n')
+        text = text + ' '
+    return text
 
 
 def read_prompts(config_dir):
@@ -85,8 +156,13 @@ def read_access_codes(config_dir):
     Return a dictionary with access codes as keys and configs as values.
     """
     access_codes = dict()
+    for path in get_access_code_paths(config_dir):
+        access_codes.update(read_access_code_file(path))
+    return access_codes
 
-    # Retrieve all file names that contain 'access_code'
+
+def get_access_code_paths(config_dir):
+    """Retrieve all file names that contain 'access_code'."""
     if not os.path.exists(config_dir):
         raise RuntimeError(f'Cannot find access code at {config_dir}')
 
@@ -94,20 +170,23 @@ def read_access_codes(config_dir):
     for filename in os.listdir(config_dir):
         if 'access_code' in filename and filename.endswith('csv'):
             paths.append(os.path.join(config_dir, filename))
+    return paths
 
-    # Read access codes with configs
-    for path in paths:
-        with open(path, 'r') as f:
-            input_file = csv.DictReader(f)
 
-            for row in input_file:
-                if 'access_code' not in row:
-                    print(f'# Could not find access_code in {path}:\n{row}')
-                    continue
+def read_access_code_file(path):
+    """Read access codes with configs from a CSV file."""
+    access_codes = dict()
+    with open(path, 'r') as f:
+        input_file = csv.DictReader(f)
+
+        for row in input_file:
+            if 'access_code' not in row:
+                print(f'# Could not find access_code in {path}:\n{row}')
+                continue
 
-                access_code = row['access_code']
-                config = AccessCodeConfig(row)
-                access_codes[access_code] = config
+            access_code = row['access_code']
+            config = AccessCodeConfig(row)
+            access_codes[access_code] = config
     return access_codes
 
 
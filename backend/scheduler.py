@@ -0,0 +1,323 @@
+"""
+Schedules requests to model APIs within their rate limits.
+
+Requests wait in a bounded priority queue until the token buckets of their
+engine and of one of their API keys have room for their estimated cost (the
+prompt plus max_tokens for each of n completions). Sessions that queried
+recently go first, then other sessions, then prefetches. If the queue is full
+or a request waits too long, SchedulerBusy is raised with the number of seconds
+after which to retry (returned as 503 with Retry-After). Requests rejected by
+the API with 429 are retried with jittered exponential backoff, and their key
+is not used until the API allows it again. Their tokens are returned to the
+buckets, as the API did not use them.
+"""
+
+import math
+import heapq
+import random
+import asyncio
+import itertools
+from threading import Lock, Event
+from time import time, sleep
+
+from providers import ProviderError
+from tokenizer import CHARS_PER_TOKEN
+
+PRIORITY_RECENT = 0  # Sessions that queried within recent_window seconds
+PRIORITY_IDLE = 1
+PRIORITY_PREFETCH = 2
+
+
+class SchedulerBusy(RuntimeError):
+    """Too many requests are waiting for the rate limits of the API."""
+
+    def __init__(self, retry_after):
+        unit = 'second' if retry_after == 1 else 'seconds'
+        super().__init__(f'The system is busy. Please try again in {retry_after} {unit}.')
+        self.retry_after = retry_after  # In seconds
+
+
+def get_cost(completion):
+    """Estimate the number of tokens of a completion request (prompt and outputs)."""
+    prompt = completion['prompt'] + (completion.get('suffix') or '')
+    return math.ceil(len(prompt) / CHARS_PER_TOKEN) + completion['max_tokens'] * completion.get('n', 1)
+
+
+class TokenBucket:
+    """Tokens refilled at a constant rate up to one minute's worth.
+
+    Not thread-safe by itself; the scheduler only uses it under its lock.
+    """
+
+    def __init__(self, tokens_per_minute):
+        self.rate = tokens_per_minute / 60  # Tokens per second
+        self.capacity = tokens_per_minute
+        self.tokens = self.capacity
+        self.timestamp = time()
+        self.paused_until = 0
+
+    def get_wait(self, amount, current_timestamp):
+        """Return seconds until amount tokens are available (0 if they are available now)."""
+        self.tokens = min(self.capacity, self.tokens + (current_timestamp - self.timestamp) * self.rate)
+        self.timestamp = current_timestamp
+
+        # Requests larger than the capacity only need a full bucket
+        amount = min(amount, self.capacity)
+        wait = max(self.paused_until - current_timestamp, 0)
+        if self.tokens < amount:
+            wait = max(wait, (amount - self.tokens) / self.rate)
+        return wait
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def give(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time() + seconds)
+
+
+class Ticket:
+    """A request waiting in the queue."""
+
+    def __init__(self, priority, seq, engine, api_keys, cost, event):
+        self.priority = priority
+        self.seq = seq  # First come, first served within a priority
+        self.engine = engine
+        self.api_keys = api_keys
+        self.cost = cost
+        self.event = event  # Set when the ticket may be at the front of the queue
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Scheduler:
+    """Admits requests to model APIs in priority order within token buckets per key and engine.
+
+    Callers in threads use run and callers in an event loop use arun (one or
+    the other in a process). Limits of None are not enforced.
+    """
+
+    def __init__(
+        self,
+        key_tpm=250000,
+        engine_tpm=None,
+        max_queue=256,
+        max_wait=10,
+        max_retries=3,
+        backoff=1,
+        recent_window=60,
+    ):
+        self.key_tpm = key_tpm  # Tokens per minute for each API key
+        self.engine_tpm = engine_tpm  # Tokens per minute for each engine (across keys)
+        self.max_queue = max_queue
+        self.max_wait = max_wait  # In seconds
+        self.max_retries = max_retries
+        self.backoff = backoff  # In seconds (doubled for each retry)
+        self.recent_window = recent_window  # In seconds
+
+        self.key_buckets = dict()  # API key -> TokenBucket
+        self.engine_buckets = dict()  # engine -> TokenBucket
+        self.queue = []  # Heap of tickets
+        self.seq = itertools.count()
+        self.key_offset = itertools.count()
+        self.lock = Lock()
+
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.num_retried = 0
+
+    def get_priority(self, idle_time, is_prefetch=False):
+        """Return the priority of a request from a session idle for idle_time seconds."""
+        if is_prefetch:
+            return PRIORITY_PREFETCH
+        return PRIORITY_RECENT if idle_time <= self.recent_window else PRIORITY_IDLE
+
+    def is_saturated(self):
+        with self.lock:
+            return len(self.queue) >= self.max_queue
+
+    def get_buckets(self, engine, api_key):
+        buckets = []
+        if self.engine_tpm:
+            if engine not in self.engine_buckets:
+                self.engine_buckets[engine] = TokenBucket(self.engine_tpm)
+            buckets.append(self.engine_buckets[engine])
+        if self.key_tpm and api_key is not None:
+            if api_key not in self.key_buckets:
+                self.key_buckets[api_key] = TokenBucket(self.key_tpm)
+            buckets.append(self.key_buckets[api_key])
+        return buckets
+
+    def get_retry_after(self):
+        """Estimate seconds until the queue is drained (at least 1)."""
+        rates = []
+        if self.engine_tpm:
+            rates.append(self.engine_tpm / 60)
+        if self.key_tpm:
+            rates.append(self.key_tpm / 60 * max(len(self.key_buckets), 1))
+        if not rates:
+            return 1
+        queued_cost = sum(ticket.cost for ticket in self.queue)
+        return max(math.ceil(queued_cost / min(rates)), 1)
+
+    def reject(self):
+        self.num_rejected += 1
+        return SchedulerBusy(self.get_retry_after())
+
+    def enqueue(self, ticket):
+        with self.lock:
+            if len(self.queue) >= self.max_queue:
+                raise self.reject()
+            heapq.heappush(self.queue, ticket)
+            self.wake_front()
+
+    def remove(self, ticket):
+        """Remove a ticket that is no longer waiting (e.g. waited too long or cancelled)."""
+        with self.lock:
+            if ticket in self.queue:
+                self.queue.remove(ticket)
+                heapq.heapify(self.queue)
+                self.wake_front()
+
+    def wake_front(self):
+        if self.queue:
+            self.queue[0].event.set()
+
+    def try_admit(self, ticket):
+        """Return (True, API key) if the ticket is admitted, or (False, seconds to wait or None)."""
+        with self.lock:
+            if self.queue[0] is not ticket:
+                return False, None  # Wait until it is at the front
+
+            # Try keys in turn, so that requests are spread across keys
+            current_timestamp = time()
+            offset = next(self.key_offset)
+            min_wait = None
+            for i in range(len(ticket.api_keys)):
+                api_key = ticket.api_keys[(offset + i) % len(ticket.api_keys)]
+                buckets = self.get_buckets(ticket.engine, api_key)
+                wait = max([bucket.get_wait(ticket.cost, current_timestamp) for bucket in buckets] + [0])
+                if wait == 0:
+                    for bucket in buckets:
+                        bucket.take(ticket.cost)
+                    heapq.heappop(self.queue)
+                    self.wake_front()
+                    self.num_admitted += 1
+                    return True, api_key
+                min_wait = wait if min_wait is None else min(min_wait, wait)
+            return False, min_wait
+
+    def acquire(self, engine, api_keys, cost, priority):
+        """Wait until a request can be sent and return the API key to use."""
+        ticket = Ticket(priority, next(self.seq), engine, api_keys, cost, Event())
+        deadline = time() + self.max_wait
+        self.enqueue(ticket)
+        try:
+            while True:
+                ticket.event.clear()
+                admitted, result = self.try_admit(ticket)
+                if admitted:
+                    return result
+                timeout = deadline - time()
+                if timeout <= 0:
+                    with self.lock:
+                        raise self.reject()
+                ticket.event.wait(timeout if result is None else min(result, timeout))
+        finally:
+            self.remove(ticket)  # Unless admitted
+
+    async def aacquire(self, engine, api_keys, cost, priority):
+        """Wait until a request can be sent and return the API key to use (in an event loop)."""
+        ticket = Ticket(priority, next(self.seq), engine, api_keys, cost, asyncio.Event())
+        deadline = time() + self.max_wait
+        self.enqueue(ticket)
+        try:
+            while True:
+                ticket.event.clear()
+                admitted, result = self.try_admit(ticket)
+                if admitted:
+                    return result
+                timeout = deadline - time()
+                if timeout <= 0:
+                    with self.lock:
+                        raise self.reject()
+                try:
+                    await asyncio.wait_for(ticket.event.wait(), timeout if result is None else min(result, timeout))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.remove(ticket)  # Unless admitted
+
+    def settle(self, engine, api_key, cost, response):
+        """Return tokens that were estimated but not used to the buckets."""
+        if not isinstance(response, dict) or 'usage' not in response:
+            return
+        self.refund(engine, api_key, cost - response['usage'].get('total_tokens', cost))
+
+    def refund(self, engine, api_key, amount):
+        if amount <= 0:
+            return
+        with self.lock:
+            for bucket in self.get_buckets(engine, api_key):
+                bucket.give(amount)
+            self.wake_front()
+
+    def get_delay(self, api_key, attempt, error):
+        """Stop using a rate-limited key for a while and return a jittered delay before retrying."""
+        delay = self.backoff * 2 ** attempt
+        if error.retry_after:
+            delay = max(delay, error.retry_after)
+        with self.lock:
+            if api_key in self.key_buckets:
+                self.key_buckets[api_key].pause(delay)
+            self.num_retried += 1
+        return random.uniform(delay / 2, delay)
+
+    def run(self, func, engine, api_keys, cost, priority):
+        """Call func(api_key) within the rate limits, retrying if the API returns 429."""
+        for attempt in range(self.max_retries + 1):
+            api_key = self.acquire(engine, api_keys, cost, priority)
+            try:
+                response = func(api_key)
+            except ProviderError as e:
+                if e.status != 429:
+                    raise
+                self.refund(engine, api_key, cost)  # Rejected requests use no tokens
+                delay = self.get_delay(api_key, attempt, e)
+                if attempt == self.max_retries:
+                    raise SchedulerBusy(math.ceil(delay))
+                sleep(delay)
+                continue
+            self.settle(engine, api_key, cost, response)
+            return response
+
+    async def arun(self, func, engine, api_keys, cost, priority):
+        """Await func(api_key) within the rate limits, retrying if the API returns 429."""
+        for attempt in range(self.max_retries + 1):
+            api_key = await self.aacquire(engine, api_keys, cost, priority)
+            try:
+                response = await func(api_key)
+            except ProviderError as e:
+                if e.status != 429:
+                    raise
+                self.refund(engine, api_key, cost)  # Rejected requests use no tokens
+                delay = self.get_delay(api_key, attempt, e)
+                if attempt == self.max_retries:
+                    raise SchedulerBusy(math.ceil(delay))
+                await asyncio.sleep(delay)
+                continue
+            self.settle(engine, api_key, cost, response)
+            return response
+
+    def get_stats(self):
+        with self.lock:
+            queued = len(self.queue)
+        return {
+            'queued': queued,
+            'admitted': self.num_admitted,
+            'rejected': self.num_rejected,
+            'retried': self.num_retried,
+        }
@@ -0,0 +1,226 @@
+"""
+Keeps sessions while users are writing, in memory (SessionStore) or in an
+SQLite database shared by multiple processes (SQLiteSessionStore).
+"""
+
+import json
+import sqlite3
+import collections
+from threading import Lock, local
+from time import time
+
+
+class SessionStore:
+    """Sessions that are evicted after being idle for ttl seconds.
+
+    Sessions are split into active ones (queried within active_window seconds)
+    and idle ones, each ordered by the last query. Sessions only move from the
+    front of one to the other, so expiring sessions and counting active ones
+    take amortized constant time instead of a scan over all sessions. At most
+    max_sessions are kept, evicting the least recently queried ones first.
+    """
+
+    def __init__(self, ttl=86400, max_sessions=100000, active_window=900):
+        self.ttl = ttl  # In seconds
+        self.max_sessions = max_sessions
+        self.active_window = active_window  # In seconds
+
+        self.active = collections.OrderedDict()  # session_id -> session
+        self.idle = collections.OrderedDict()  # session_id -> session
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.active) + len(self.idle)
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id):
+        """Return a session or None."""
+        with self.lock:
+            self.expire()
+            if session_id in self.active:
+                return self.active[session_id]
+            return self.idle.get(session_id)
+
+    def add(self, session):
+        with self.lock:
+            session_id = session['session_id']
+            self.idle.pop(session_id, None)
+            self.active.pop(session_id, None)
+            self.active[session_id] = session
+
+            self.expire()
+            while len(self) > self.max_sessions:
+                if self.idle:
+                    self.idle.popitem(last=False)
+                else:
+                    self.active.popitem(last=False)
+
+    def touch(self, session_id):
+        """Record a query for a session and return it (or None if not found)."""
+        with self.lock:
+            self.expire()
+            session = self.active.pop(session_id, None)
+            if session is None:
+                session = self.idle.pop(session_id, None)
+            if session is None:
+                return None
+
+            session['prev_query_timestamp'] = session['last_query_timestamp']
+            session['last_query_timestamp'] = time()
+            self.active[session_id] = session
+            return session
+
+    def expire(self):
+        current_timestamp = time()
+        while self.active:
+            session_id, session = next(iter(self.active.items()))
+            if current_timestamp - session['last_query_timestamp'] < self.active_window:
+                break
+            self.active.popitem(last=False)
+            self.idle[session_id] = session
+
+        while self.idle:
+            session_id, session = next(iter(self.idle.items()))
+            if current_timestamp - session['last_query_timestamp'] < self.ttl:
+                break
+            self.idle.popitem(last=False)
+
+    def count_active(self):
+        with self.lock:
+            self.expire()
+            return len(self.active)
+
+    def get_recent(self, num_sessions):
+        """Return up to num_sessions sessions, most recently queried first."""
+        with self.lock:
+            sessions = []
+            for sessions_by_time in [self.active, self.idle]:
+                for session_id in reversed(sessions_by_time):
+                    if len(sessions) >= num_sessions:
+                        return sessions
+                    sessions.append(sessions_by_time[session_id])
+            return sessions
+
+
+class SQLiteSessionStore:
+    """Sessions in an SQLite database, with the same interface as SessionStore.
+
+    Any worker process can look up a session started by another one. Sessions
+    idle for ttl seconds are ignored and deleted at most once every
+    expire_interval seconds, along with the least recently queried ones beyond
+    max_sessions. Sessions are returned as copies, so changes to them are not
+    saved (except for the last query recorded by touch).
+    """
+
+    def __init__(self, db_path, ttl=86400, max_sessions=100000, active_window=900, expire_interval=60):
+        self.db_path = db_path
+        self.ttl = ttl  # In seconds
+        self.max_sessions = max_sessions
+        self.active_window = active_window  # In seconds
+        self.expire_interval = expire_interval  # In seconds
+
+        self.local = local()  # A connection for each thread
+        self.last_expire = 0
+
+        conn = self.get_conn()
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'session_id TEXT PRIMARY KEY, last_query_timestamp REAL, data TEXT)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS sessions_last_query_timestamp '
+                'ON sessions (last_query_timestamp)'
+            )
+
+    def get_conn(self):
+        if not hasattr(self.local, 'conn'):
+            # Wait for other processes writing to the same database
+            self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+        return self.local.conn
+
+    def __len__(self):
+        row = self.get_conn().execute(
+            'SELECT COUNT(*) FROM sessions WHERE last_query_timestamp >= ?', (time() - self.ttl,)
+        ).fetchone()
+        return row[0]
+
+    def __contains__(self, session_id):
+        return self.get(session_id) is not None
+
+    def get(self, session_id):
+        """Return a session or None."""
+        row = self.get_conn().execute(
+            'SELECT data, last_query_timestamp FROM sessions '
+            'WHERE session_id = ? AND last_query_timestamp >= ?',
+            (session_id, time() - self.ttl)
+        ).fetchone()
+        if row is None:
+            return None
+        session = json.loads(row[0])
+        session['last_query_timestamp'] = row[1]
+        return session
+
+    def add(self, session):
+        conn = self.get_conn()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, last_query_timestamp, data) VALUES (?, ?, ?)',
+                (session['session_id'], session['last_query_timestamp'], json.dumps(session))
+            )
+        self.expire()
+
+    def touch(self, session_id):
+        """Record a query for a session and return it (or None if not found)."""
+        conn = self.get_conn()
+        current_timestamp = time()
+        with conn:
+            cursor = conn.execute(
+                'UPDATE sessions SET last_query_timestamp = ?, '
+                "data = json_set(data, '$.prev_query_timestamp', last_query_timestamp) "
+                'WHERE session_id = ? AND last_query_timestamp >= ?',
+                (current_timestamp, session_id, current_timestamp - self.ttl)
+            )
+        if cursor.rowcount == 0:
+            return None
+        return self.get(session_id)
+
+    def expire(self):
+        current_timestamp = time()
+        if current_timestamp - self.last_expire < self.expire_interval:
+            return
+        self.last_expire = current_timestamp
+
+        conn = self.get_conn()
+        with conn:
+            conn.execute(
+                'DELETE FROM sessions WHERE last_query_timestamp < ?', (current_timestamp - self.ttl,)
+            )
+            conn.execute(
+                'DELETE FROM sessions WHERE session_id IN ('
+                'SELECT session_id FROM sessions ORDER BY last_query_timestamp DESC LIMIT -1 OFFSET ?)',
+                (self.max_sessions,)
+            )
+
+    def count_active(self):
+        row = self.get_conn().execute(
+            'SELECT COUNT(*) FROM sessions WHERE last_query_timestamp >= ?', (time() - self.active_window,)
+        ).fetchone()
+        return row[0]
+
+    def get_recent(self, num_sessions):
+        """Return up to num_sessions sessions, most recently queried first."""
+        rows = self.get_conn().execute(
+            'SELECT data, last_query_timestamp FROM sessions '
+            'WHERE last_query_timestamp >= ? ORDER BY last_query_timestamp DESC LIMIT ?',
+            (time() - self.ttl, num_sessions)
+        ).fetchall()
+        sessions = []
+        for data, last_query_timestamp in rows:
+            session = json.loads(data)
+            session['last_query_timestamp'] = last_query_timestamp
+            sessions.append(session)
+        return sessions
@@ -0,0 +1,90 @@
+"""
+Coalesces concurrent identical calls so that only one of them does the work.
+"""
+
+import asyncio
+from concurrent.futures import Future
+from threading import Lock
+
+
+class SingleFlight:
+    """Runs a function once for concurrent calls with the same key (across threads).
+
+    The first caller runs the function, and callers arriving while it is in
+    flight wait for it and receive the same result (or exception). Once the
+    call finishes, the key is forgotten, so later calls run the function again.
+    """
+
+    def __init__(self):
+        self.calls = dict()  # key -> Future
+        self.lock = Lock()
+
+        self.num_calls = 0
+        self.num_shared = 0
+
+    def do(self, key, func, *args):
+        with self.lock:
+            future = self.calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self.calls[key] = future
+                self.num_calls += 1
+            else:
+                self.num_shared += 1
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            self.forget(key)
+            future.set_exception(e)
+            raise
+        self.forget(key)
+        future.set_result(result)
+        return result
+
+    def forget(self, key):
+        with self.lock:
+            del self.calls[key]
+
+    def get_stats(self):
+        with self.lock:
+            in_flight = len(self.calls)
+        return {
+            'in_flight': in_flight,
+            'calls': self.num_calls,
+            'shared': self.num_shared,
+        }
+
+
+class AsyncSingleFlight:
+    """Runs a coroutine function once for concurrent calls with the same key (in one event loop)."""
+
+    def __init__(self):
+        self.tasks = dict()  # key -> asyncio.Task
+
+        self.num_calls = 0
+        self.num_shared = 0
+
+    async def do(self, key, func, *args):
+        task = self.tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self.tasks[key] = task
+            task.add_done_callback(lambda _: self.tasks.pop(key, None))
+            self.num_calls += 1
+        else:
+            self.num_shared += 1
+
+        # Do not cancel the call for others if this caller is cancelled
+        return await asyncio.shield(task)
+
+    def get_stats(self):
+        return {
+            'in_flight': len(self.tasks),
+            'calls': self.num_calls,
+            'shared': self.num_shared,
+        }
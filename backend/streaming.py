@@ -0,0 +1,120 @@
+"""
+Streams suggestions to the frontend as Server-Sent Events.
+
+Each choice is streamed from the API separately, so that its generation can be
+stopped as soon as parse_suggestion would discard the rest of it, and each
+suggestion is filtered and sent as soon as its choice is complete.
+"""
+
+import json
+import random
+
+from parsing import (
+    parse_suggestion, parse_probability,
+    filter_suggestions,
+    FirstSentenceDetector,
+)
+from metrics import time_stage
+
+
+class ChoiceStream:
+    """Text and log probabilities of a choice received in chunks."""
+
+    def __init__(self, after_prompt, stop_rules):
+        self.texts = []
+        self.logprobs = {
+            'tokens': [],
+            'token_logprobs': [],
+            'top_logprobs': [],
+            'text_offset': [],
+        }
+
+        # Without the '.' stop rule, the whole generation is used
+        self.detector = None
+        if '.' in stop_rules:
+            self.detector = FirstSentenceDetector(after_prompt)
+
+    def feed(self, choice):
+        """Add a chunk and return True if the rest of the choice can be discarded."""
+        self.texts.append(choice['text'])
+        if choice.get('logprobs'):
+            for key, values in self.logprobs.items():
+                values.extend(choice['logprobs'].get(key) or [])
+
+        if self.detector is None:
+            return False
+        return self.detector.feed(choice['text'])
+
+    def get_choice(self):
+        return {
+            'text': ''.join(self.texts),
+            'logprobs': self.logprobs,
+        }
+
+
+class SuggestionStream:
+    """Suggestions parsed and filtered one at a time as their choices arrive.
+
+    The filters are the same as filter_suggestions on the whole batch, but
+    suggestions are indexed in the order they arrive instead of being shuffled.
+    """
+
+    def __init__(self, after_prompt, stop_rules, engine, prev_suggestions, blocklist):
+        self.after_prompt = after_prompt
+        self.stop_rules = stop_rules
+        self.engine = engine
+        self.prev_suggestions = list(prev_suggestions)
+        self.blocklist = blocklist
+
+        self.original_suggestions = []
+        self.suggestions_with_probabilities = []
+        self.counts = {
+            'empty_cnt': 0,
+            'duplicate_cnt': 0,
+            'bad_cnt': 0,
+        }
+
+    def add_choice(self, choice):
+        """Return the suggestion to show for a choice, or None if it is filtered out."""
+        with time_stage('parse_suggestion', self.engine):
+            suggestion = parse_suggestion(choice['text'], self.after_prompt, self.stop_rules)
+            probability = parse_probability(choice['logprobs'])
+        self.original_suggestions.append({
+            'original': suggestion,
+            'trimmed': suggestion.strip(),
+            'probability': probability,
+            'source': self.engine,
+        })
+
+        with time_stage('filter_suggestions', self.engine):
+            filtered_suggestions, counts = filter_suggestions(
+                [(suggestion, probability, self.engine)],
+                self.prev_suggestions,
+                self.blocklist,
+            )
+        for key, count in counts.items():
+            self.counts[key] += count
+        if not filtered_suggestions:
+            return None
+
+        suggestion_with_probability = {
+            'index': len(self.suggestions_with_probabilities),
+            'original': suggestion,
+            'trimmed': suggestion.strip(),
+            'probability': probability,
+            'source': self.engine,
+        }
+        self.suggestions_with_probabilities.append(suggestion_with_probability)
+        self.prev_suggestions.append(suggestion_with_probability)  # Remove duplicates
+        return suggestion_with_probability
+
+    def shuffle(self):
+        """Shuffle suggestions as in build_query_results when they are not shown as they arrive."""
+        random.shuffle(self.suggestions_with_probabilities)
+        for index, suggestion_with_probability in enumerate(self.suggestions_with_probabilities):
+            suggestion_with_probability['index'] = index
+
+
+def format_event(event, data):
+    """Format an event with JSON data for Server-Sent Events."""
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
@@ -0,0 +1,8 @@
+"""
+Makes the modules in ./backend importable from the tests (as when the servers run).
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
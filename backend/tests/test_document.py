@@ -0,0 +1,72 @@
+"""
+Checks that Document reproduces helper.apply_ops on random Quill deltas.
+
+Run the following in ./backend:
+    python3 -m pytest tests/test_document.py
+"""
+
+import random
+
+import pytest
+
+from helper import apply_ops
+from document import Document, ReplayIndex
+
+
+def generate_ops(rng, length):
+    ops = []
+    for _ in range(rng.randint(1, 4)):
+        value = rng.random()
+        if value < 0.4:
+            ops.append({'retain': rng.randint(0, length + 3)})  # Possibly past the end
+        elif value < 0.75:
+            ops.append({'insert': ''.join(rng.choice('ab\n ') for _ in range(rng.randint(0, 20)))})
+        elif value < 0.78:
+            ops.append({'insert': {'image': 'https://example.com/image.png'}})
+        elif value < 0.8:
+            ops.append({'attributes': {'bold': True}})
+        else:
+            ops.append({'delete': rng.randint(0, 12)})  # Including 0 and past the end
+    return ops
+
+
+@pytest.mark.parametrize('max_block_length', [4, 2048])
+def test_apply_ops_matches_helper(monkeypatch, capsys, max_block_length):
+    # Small blocks exercise splitting and edits across blocks
+    monkeypatch.setattr(Document, 'MAX_BLOCK_LENGTH', max_block_length)
+
+    for seed in range(500):
+        rng = random.Random(seed)
+        text = ''.join(rng.choice('xyz ') for _ in range(rng.randint(0, 30)))
+        doc, mask = text, 'P' * len(text)
+        document = Document(text, 'P')
+
+        for step in range(40):
+            ops = generate_ops(rng, len(doc))
+            source = rng.choice(['user', 'api'])
+            doc, mask = apply_ops(doc, mask, ops, source)
+            document.apply_ops(ops, source)
+            assert document.get_text_and_mask() == (doc, mask), (seed, step, ops)
+            assert len(document) == len(doc)
+
+            if step % 10 == 0:
+                document = Document.from_runs(document.get_text(), document.get_runs())
+    capsys.readouterr()  # Discard messages about skipped ops
+
+
+def test_replay_index_matches_full_replay(capsys):
+    rng = random.Random(0)
+    events = [{'eventName': 'system-initialize', 'eventSource': 'api', 'textDelta': '', 'currentDoc': 'Prompt'}]
+    doc, mask = 'Prompt', 'PPPPPP'
+    expected = [(doc, mask)]
+    for _ in range(300):
+        ops = generate_ops(rng, len(doc))
+        source = rng.choice(['user', 'api'])
+        events.append({'eventName': 'text-insert', 'eventSource': source, 'textDelta': {'ops': ops}})
+        doc, mask = apply_ops(doc, mask, ops, source)
+        expected.append((doc, mask))
+
+    replay_index = ReplayIndex(events, interval=16)
+    for event_id in rng.sample(range(len(events)), 100) + [0, len(events)]:
+        assert replay_index.get_text_and_mask(event_id) == expected[max(event_id - 1, 0)]
+    capsys.readouterr()
@@ -0,0 +1,110 @@
+"""
+Checks that appended batches are deduplicated and gaps are rejected.
+
+Run the following in ./backend:
+    python3 -m pytest tests/test_log_writer.py
+"""
+
+import json
+import threading
+
+import pytest
+
+from log_writer import LogWriter
+
+
+def read_events(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_events(start, end):
+    return [{'eventName': 'text-insert', 'index': i} for i in range(start, end)]
+
+
+def test_append_in_order(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log_writer = LogWriter()
+    assert log_writer.append(path, 0, get_events(0, 3)) == 3
+    assert log_writer.append(path, 3, get_events(3, 5)) == 5
+    assert read_events(path) == get_events(0, 5)
+    assert log_writer.finalize(path) == 5
+
+
+def test_append_skips_duplicates(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log_writer = LogWriter()
+    log_writer.append(path, 0, get_events(0, 4))
+
+    # A retried batch and a batch that overlaps with written events
+    assert log_writer.append(path, 0, get_events(0, 4)) == 4
+    assert log_writer.append(path, 2, get_events(2, 6)) == 6
+    assert read_events(path) == get_events(0, 6)
+
+
+def test_append_rejects_gaps(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log_writer = LogWriter()
+    log_writer.append(path, 0, get_events(0, 2))
+    with pytest.raises(ValueError):
+        log_writer.append(path, 5, get_events(5, 7))
+    assert read_events(path) == get_events(0, 2)
+
+    # The frontend resends from the expected index
+    assert log_writer.append(path, 2, get_events(2, 7)) == 7
+
+
+def test_counts_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    LogWriter().append(path, 0, get_events(0, 3))
+
+    # Another process continues the same log
+    log_writer = LogWriter()
+    assert log_writer.append(path, 0, get_events(0, 5)) == 5
+    assert read_events(path) == get_events(0, 5)
+
+
+def test_overwrite_replaces_appended_events(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log_writer = LogWriter()
+    log_writer.append(path, 0, get_events(0, 3))
+    assert log_writer.overwrite(path, get_events(10, 12)) == 2
+    assert read_events(path) == get_events(10, 12)
+    assert log_writer.append(path, 2, get_events(12, 13)) == 3
+    assert log_writer.finalize(path) == 3
+    assert list(tmp_path.iterdir()) == [tmp_path / 'session.jsonl']  # No temporary files
+
+
+def test_finalize_keeps_lock_while_in_use(tmp_path):
+    path = str(tmp_path / 'session.jsonl')
+    log_writer = LogWriter()
+    log_writer.append(path, 0, get_events(0, 2))
+
+    # Finalize and append while another thread holds the lock
+    threads = [
+        threading.Thread(target=log_writer.finalize, args=(path,)),
+        threading.Thread(target=log_writer.append, args=(path, 2, get_events(2, 3))),
+    ]
+    with log_writer.using(path):
+        lock = log_writer.locks[path]
+        for thread in threads:
+            thread.start()
+        while log_writer.users[path] < 3:
+            pass
+        assert log_writer.locks[path] is lock  # Waiting threads share the lock
+    for thread in threads:
+        thread.join()
+
+    assert path not in log_writer.locks  # Forgotten once the lock is released
+    assert log_writer.count(path) == 3  # Recovered from the file
+    assert read_events(path) == get_events(0, 3)
+
+
+def test_idle_logs_are_forgotten(tmp_path):
+    log_writer = LogWriter(idle_ttl=0)
+    paths = [str(tmp_path / f'session-{i}.jsonl') for i in range(3)]
+    for path in paths:
+        log_writer.append(path, 0, get_events(0, 1))
+    log_writer.append(paths[0], 1, get_events(1, 2))
+    assert set(log_writer.locks) == {paths[0]}
+    assert set(log_writer.counts) == {paths[0]}
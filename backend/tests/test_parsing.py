@@ -0,0 +1,92 @@
+"""
+Checks that the first sentence of suggestions is the same as with sent_tokenize.
+
+Run the following in ./backend (requires the NLTK punkt data):
+    python3 -m pytest tests/test_parsing.py
+"""
+
+import pytest
+from nltk.tokenize import sent_tokenize
+
+from parsing import get_sentence_tokenizer, get_first_sentence, parse_suggestion, FirstSentenceDetector
+
+try:
+    get_sentence_tokenizer()
+except LookupError:
+    pytest.skip('NLTK punkt data is not available', allow_module_level=True)
+
+
+TEXTS = [
+    '',
+    ' ',
+    ' Once upon a time',
+    ' Once upon a time.',
+    ' Once upon a time. There was a princess.',
+    ' She said hello.\nThen she left.',
+    '\nShe said hello. Then she left.',
+    ' She said hello\n\nand left. Then she came back.',
+    ' Mr. Smith went to Washington. He stayed there.',
+    ' Dr. Jones met Mrs. Brown at 5 p.m. on Tuesday. They talked.',
+    ' The U.S. economy grew by 3.5 percent. Prices rose.',
+    ' It was e.g. a test, i.e. a trial. Nothing more.',
+    ' "Stop!" she said. He did not stop.',
+    ' "Where are you going?" he asked. "Home," she said.',
+    ' He whispered, "It is over." Then he left.',
+    " 'Quiet.' The room fell silent.",
+    ' Wait... what was that? Nobody knew.',
+    ' What? Really! Yes.',
+    ' (This is in parentheses.) This is not.',
+    ' The end.   \n',
+    '  Two spaces before. One after.',
+    ' A sentence without a space after.Another one.',
+    ' Version 2.0 was released. It was fast.',
+    ' Chapter 1. The beginning',
+]
+
+AFTER_PROMPTS = [' ', '']
+
+
+def parse_suggestion_with_sent_tokenize(suggestion, after_prompt, stop_rules):
+    """Parse a suggestion as parse_suggestion did before get_first_sentence."""
+    processed_suggestion = suggestion
+    if suggestion.startswith(after_prompt):
+        processed_suggestion = suggestion[len(after_prompt):]
+
+    if '.' in stop_rules:
+        sentences = sent_tokenize(processed_suggestion)
+        if not sentences:
+            return ''
+        first_sentence = sentences[0].strip().split('\n')[0]
+        start = processed_suggestion.index(first_sentence)
+        end = start + len(first_sentence)
+        processed_suggestion = processed_suggestion[:end]
+    return processed_suggestion
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_get_first_sentence_matches_sent_tokenize(text):
+    sentences = sent_tokenize(text)
+    assert get_first_sentence(text) == (sentences[0] if sentences else None)
+
+
+@pytest.mark.parametrize('after_prompt', AFTER_PROMPTS)
+@pytest.mark.parametrize('text', TEXTS)
+def test_parse_suggestion_matches_sent_tokenize(text, after_prompt):
+    for stop_rules in [['.'], []]:
+        expected = parse_suggestion_with_sent_tokenize(text, after_prompt, stop_rules)
+        assert parse_suggestion(text, after_prompt, stop_rules) == expected
+
+
+@pytest.mark.parametrize('after_prompt', AFTER_PROMPTS)
+@pytest.mark.parametrize('text', TEXTS)
+def test_first_sentence_detector_fed_char_by_char(text, after_prompt):
+    expected = parse_suggestion_with_sent_tokenize(text, after_prompt, ['.'])
+
+    # Once complete, the text received so far gives the same suggestion as the full text
+    detector = FirstSentenceDetector(after_prompt)
+    for char in text:
+        if detector.feed(char):
+            assert parse_suggestion(detector.text, after_prompt, ['.']) == expected
+            break
+    else:
+        assert parse_suggestion(detector.text, after_prompt, ['.']) == expected
@@ -0,0 +1,77 @@
+"""
+Checks routing of engines to providers and rotation of API keys.
+
+Run the following in ./backend:
+    python3 -m pytest tests/test_providers.py
+"""
+
+import pytest
+
+from providers import (
+    ProviderRouter, ProviderError, KeyPool, FakeProvider, OpenAIProvider,
+    split_engine, DEFAULT_DOMAIN,
+)
+
+
+def test_split_engine():
+    assert split_engine('fake/echo') == ('fake', 'echo')
+    assert split_engine('openai/text-davinci-003') == ('openai', 'text-davinci-003')
+    assert split_engine('text-davinci-003') == ('openai', 'text-davinci-003')
+    assert split_engine('unknown/model') == ('openai', 'unknown/model')  # Not a known host
+    assert split_engine(None) == ('openai', None)
+
+
+def test_router_routes_engines_by_host():
+    router = ProviderRouter({('openai', 'default'): ['sk-1']})
+    assert isinstance(router.get('text-davinci-003'), OpenAIProvider)
+    assert isinstance(router.get('fake/test'), FakeProvider)
+    assert router.get_keys('fake/test') == [None]  # No key needed
+
+
+def test_router_without_keys_for_host():
+    router = ProviderRouter(dict())
+    with pytest.raises(ProviderError):
+        router.get('text-davinci-003')
+    assert isinstance(router.get('fake/test'), FakeProvider)
+
+
+def test_keys_fall_back_to_default_domain():
+    router = ProviderRouter({
+        ('openai', 'default'): ['sk-default'],
+        ('openai', 'story'): ['sk-story-1', 'sk-story-2'],
+    })
+    assert router.get_keys('text-davinci-003', 'story') == ['sk-story-1', 'sk-story-2']
+    assert router.get_keys('text-davinci-003', 'essay') == ['sk-default']
+    assert router.get_keys('text-davinci-003', None) == ['sk-default']
+
+
+def test_missing_domain_without_default():
+    router = ProviderRouter({('openai', 'story'): ['sk-story']})
+    with pytest.raises(ProviderError):
+        router.get_keys('text-davinci-003', DEFAULT_DOMAIN)
+
+
+def test_key_pool_rotates_keys():
+    key_pool = KeyPool(['a', 'b', 'c'])
+    assert len(key_pool) == 3
+    assert [key_pool.next() for _ in range(7)] == ['a', 'b', 'c', 'a', 'b', 'c', 'a']
+
+    provider = OpenAIProvider({'default': ['sk-1', 'sk-2']})
+    assert [provider.get_key('story') for _ in range(4)] == ['sk-1', 'sk-2', 'sk-1', 'sk-2']
+
+
+def test_fake_provider_outputs():
+    router = ProviderRouter(dict())
+    completion = {'engine': 'fake/test', 'prompt': 'Once upon a time', 'n': 3, 'max_tokens': 10, 'temperature': 0}
+    response = router.create(completion)
+    assert len(response['choices']) == 3
+    assert all(len(choice['logprobs']['tokens']) == 10 for choice in response['choices'])
+    assert response['usage']['completion_tokens'] == 30
+    assert router.create(completion) == response  # Same outputs without sampling
+
+    # Streamed choices are the same as complete ones
+    texts = [''] * 3
+    for chunk in router.stream(completion):
+        choice = chunk['choices'][0]
+        texts[choice['index']] += choice['text']
+    assert texts == [choice['text'] for choice in response['choices']]
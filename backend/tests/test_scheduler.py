@@ -0,0 +1,112 @@
+"""
+Checks admission, rejection (503 with Retry-After), and 429 retries of the scheduler.
+
+Run the following in ./backend:
+    python3 -m pytest tests/test_scheduler.py
+"""
+
+import asyncio
+import threading
+
+import pytest
+
+from providers import ProviderError
+from scheduler import Scheduler, SchedulerBusy, PRIORITY_RECENT, PRIORITY_IDLE, PRIORITY_PREFETCH
+
+
+def get_rate_limited(num_errors, total_tokens):
+    """Return a function that fails with 429 num_errors times and then uses total_tokens."""
+    api_keys = []
+
+    def func(api_key):
+        api_keys.append(api_key)
+        if len(api_keys) <= num_errors:
+            raise ProviderError('Rate limit reached', status=429, retry_after=None)
+        return {'usage': {'total_tokens': total_tokens}}
+    return func, api_keys
+
+
+def test_priority():
+    scheduler = Scheduler(recent_window=60)
+    assert scheduler.get_priority(10) == PRIORITY_RECENT
+    assert scheduler.get_priority(100) == PRIORITY_IDLE
+    assert scheduler.get_priority(0, is_prefetch=True) == PRIORITY_PREFETCH
+
+
+def test_reject_when_waiting_too_long():
+    scheduler = Scheduler(key_tpm=60, max_wait=0.2)
+    assert scheduler.acquire('engine', ['key'], 60, PRIORITY_RECENT) == 'key'
+    with pytest.raises(SchedulerBusy) as e:
+        scheduler.acquire('engine', ['key'], 60, PRIORITY_RECENT)  # Refilled after a minute
+    assert e.value.retry_after >= 1
+    assert scheduler.get_stats() == {'queued': 0, 'admitted': 1, 'rejected': 1, 'retried': 0}
+
+
+def test_reject_when_queue_is_full():
+    scheduler = Scheduler(key_tpm=60, max_queue=1, max_wait=0.5)
+    scheduler.acquire('engine', ['key'], 60, PRIORITY_RECENT)
+
+    # Another request waits in the queue
+    waiting = threading.Thread(target=lambda: pytest.raises(SchedulerBusy, scheduler.acquire, 'engine', ['key'], 60, 0))
+    waiting.start()
+    while not scheduler.is_saturated():
+        pass
+
+    with pytest.raises(SchedulerBusy) as e:
+        scheduler.acquire('engine', ['key'], 60, PRIORITY_RECENT)
+    assert e.value.retry_after == 60  # The queued request needs a minute of tokens
+    assert 'try again in 60 seconds' in str(e.value)
+    waiting.join()
+
+
+def test_busy_response_has_retry_after():
+    import api_server
+    with api_server.app.test_request_context():
+        response, status, headers = api_server.get_busy_response(dict(), SchedulerBusy(7))
+    assert status == 503
+    assert headers['Retry-After'] == '7'
+    assert response.get_json()['retry_after'] == 7
+
+
+def test_retry_and_refund_on_429():
+    scheduler = Scheduler(key_tpm=1000, engine_tpm=2000, backoff=0.01)
+    func, api_keys = get_rate_limited(2, total_tokens=100)
+    assert scheduler.run(func, 'engine', ['key-1', 'key-2'], 500, PRIORITY_RECENT) == {'usage': {'total_tokens': 100}}
+    assert len(api_keys) == 3
+    assert scheduler.get_stats()['retried'] == 2
+
+    # Only the tokens used by the last request are taken from the buckets
+    used = sum(1000 - bucket.tokens for bucket in scheduler.key_buckets.values())
+    assert used == pytest.approx(100, abs=5)
+    assert 2000 - scheduler.engine_buckets['engine'].tokens == pytest.approx(100, abs=5)
+
+
+def test_rate_limited_key_is_paused():
+    scheduler = Scheduler(key_tpm=1000, backoff=10)
+    func, api_keys = get_rate_limited(1, total_tokens=10)
+    scheduler.max_retries = 0
+    with pytest.raises(SchedulerBusy):
+        scheduler.run(func, 'engine', ['key-1'], 10, PRIORITY_RECENT)
+    assert scheduler.key_buckets['key-1'].get_wait(10, scheduler.key_buckets['key-1'].timestamp) > 5
+
+
+def test_arun_retries_and_refunds():
+    scheduler = Scheduler(key_tpm=1000, backoff=0.01)
+    func, api_keys = get_rate_limited(1, total_tokens=50)
+
+    async def afunc(api_key):
+        return func(api_key)
+
+    response = asyncio.run(scheduler.arun(afunc, 'engine', ['key'], 300, PRIORITY_RECENT))
+    assert response['usage']['total_tokens'] == 50
+    assert 1000 - scheduler.key_buckets['key'].tokens == pytest.approx(50, abs=5)
+
+
+def test_other_errors_are_raised():
+    scheduler = Scheduler()
+
+    def func(api_key):
+        raise ProviderError('Server error', status=500)
+    with pytest.raises(ProviderError):
+        scheduler.run(func, 'engine', ['key'], 10, PRIORITY_RECENT)
+    assert scheduler.get_stats()['retried'] == 0
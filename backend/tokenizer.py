@@ -0,0 +1,115 @@
+"""
+Counts and truncates prompts with the tokenizer (BPE) of each model.
+
+tiktoken is optional. If it is not installed or the encoding for a model
+cannot be loaded, prompts are truncated by assuming 4 characters per token.
+Encodings that failed to load (e.g. while offline) are tried again after
+RETRY_INTERVAL seconds.
+"""
+
+import functools
+from time import time
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SENTENCE_ENDS = ['. ', '? ', '! ']
+CHARS_PER_TOKEN = 4  # Without a tokenizer
+RETRY_INTERVAL = 60  # In seconds
+
+encodings = dict()  # engine -> encoding (or None for unknown models)
+failures = dict()  # engine -> timestamp of the last failure to load its encoding
+
+
+def get_encoding(engine):
+    """Return the tiktoken encoding for an engine or None."""
+    if tiktoken is None or engine is None:
+        return None
+    if engine in encodings:
+        return encodings[engine]
+    if time() - failures.get(engine, 0) < RETRY_INTERVAL:
+        return None
+
+    try:
+        encodings[engine] = tiktoken.encoding_for_model(engine)
+    except KeyError:
+        encodings[engine] = None  # Unknown model
+    except Exception as e:
+        failures[engine] = time()
+        print(f'# Failed to load the tokenizer for {engine}: {e}')
+        return None
+    failures.pop(engine, None)
+    return encodings[engine]
+
+
+def preload_encodings(engines):
+    """Load the encodings of engines in advance and return the engines that have one."""
+    return [engine for engine in engines if get_encoding(engine) is not None]
+
+
+@functools.lru_cache(maxsize=128)
+def encode_prefix(encoding, prefix):
+    """Encode a prefix shared by many prompts (e.g. an example) once."""
+    return tuple(encoding.encode(prefix, disallowed_special=()))
+
+
+def encode(encoding, text, prefix=''):
+    """Encode text, reusing the tokens of a prefix of it."""
+    if prefix and text.startswith(prefix):
+        return list(encode_prefix(encoding, prefix)) + encoding.encode(
+            text[len(prefix):], disallowed_special=()
+        )
+    return encoding.encode(text, disallowed_special=())
+
+
+def get_truncation_start(text, max_prompt_tokens, engine=None, prefix=''):
+    """Return the start of the longest suffix of text within max_prompt_tokens.
+
+    Text and prefix are tokenized separately, so the number of tokens around
+    the end of the prefix may differ by one from that of the whole text.
+    """
+    max_prompt_tokens = max(max_prompt_tokens, 0)
+
+    encoding = get_encoding(engine)
+    if encoding is None:
+        max_prompt_len = max_prompt_tokens * CHARS_PER_TOKEN
+        return max(len(text) - max_prompt_len, 0)
+
+    tokens = encode(encoding, text, prefix)
+    if len(tokens) <= max_prompt_tokens:
+        return 0
+
+    # Convert the number of bytes in removed tokens to a character index
+    num_removed_tokens = len(tokens) - max_prompt_tokens
+    num_bytes = len(encoding.decode_bytes(tokens[:num_removed_tokens]))
+    start = len(text.encode('utf-8')[:num_bytes].decode('utf-8', errors='ignore'))
+    if len(text[:start].encode('utf-8')) < num_bytes:
+        start += 1  # Remove a character split across tokens
+    return start
+
+
+def snap_to_boundary(text, start):
+    """Move start forward to the beginning of a line or sentence.
+
+    Only the first half of the remaining text is searched so that most of it
+    is kept; otherwise start is moved to the beginning of a word.
+    """
+    if start <= 0 or text[start - 1] == '\n' or text[max(start - 2, 0):start] in SENTENCE_ENDS:
+        return start
+
+    end = start + (len(text) - start) // 2
+    boundaries = []
+    for boundary in ['\n'] + SENTENCE_ENDS:
+        index = text.find(boundary, start, end + len(boundary))
+        if index >= 0:
+            boundaries.append(index + len(boundary))
+    if boundaries:
+        return min(boundaries)
+
+    # Do not start in the middle of a word
+    for i in range(start, len(text)):
+        if text[i].isspace():
+            return i
+    return start
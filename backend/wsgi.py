@@ -0,0 +1,38 @@
+"""
+Serves api_server.py with multiple worker processes (e.g. with gunicorn).
+
+Arguments of api_server.py are read from the API_SERVER_ARGS environment
+variable, and each worker reads configurations once when it starts. Run the
+following in ./backend:
+    API_SERVER_ARGS="--config_dir ../config --log_dir ../logs --port 5555 --proj_name pilot" \
+        gunicorn --workers 4 --threads 8 --bind 0.0.0.0:5555 wsgi:app
+
+Sessions and metadata are kept in SQLite databases in log_dir (unless
+--session_db and --metadata_db are provided), so that a request can be handled
+by any worker. When the metadata database is created, metadata.txt in log_dir
+is imported into it.
+"""
+
+import os
+import shlex
+
+import api_server
+from api_server import get_parser, setup
+
+
+def create_app(argv=None):
+    if argv is None:
+        argv = shlex.split(os.environ.get('API_SERVER_ARGS', ''))
+    args = get_parser().parse_args(argv)
+
+    # Share state across workers
+    if args.session_db is None:
+        args.session_db = os.path.join(args.log_dir, 'sessions.db')
+    if args.metadata_db is None:
+        args.metadata_db = os.path.join(args.log_dir, 'metadata.db')
+
+    setup(args)
+    return api_server.app
+
+
+app = create_app()
@@ -33,6 +33,10 @@ async function startSession(accessCode) {
 
       stop = session.stop;
       engine = session.engine;
+
+      if (useIncrementalLogging) {
+        startFlushingLogs();
+      }
     }
   } catch(e) {
     alert('Start sesion error:' + e);
@@ -47,8 +51,20 @@ async function startSession(accessCode) {
   }
 }
 
+async function saveSession() {
+  // Send only the number of logs if all logs have been sent already
+  if (useIncrementalLogging) {
+    stopFlushingLogs();  // Do not append logs while or after saving them
+    await flushLogs();
+    if (flushedLogCount == logs.length) {
+      return await wwai.api.endSession(sessionId, null, logs.length);
+    }
+  }
+  return await wwai.api.endSession(sessionId, logs);
+}
+
 async function endSession() {
-  const results = await wwai.api.endSession(sessionId, logs);
+  const results = await saveSession();
   const verificationCode = results['verification_code'];
 
   $('#verification-code').removeClass('do-not-display');
@@ -56,7 +72,7 @@ async function endSession() {
 }
 
 async function endSessionWithReplay() {
-  const results = await wwai.api.endSession(sessionId, logs);
+  const results = await saveSession();
   const verificationCode = results['verification_code'];
   // let replayLink = 'http://writingwithai-replay.glitch.me/?session_id=' + verificationCode;
   let replayLink = frontendURL + '/replay.html?session_id=' + verificationCode;
@@ -188,14 +204,22 @@ async function replay(replayLogs, start){
 
 async function replayLogsWithSessionId(sessionId, range){
   try {
-    results = await wwai.api.getLog(sessionId);
-
+    // Only request the events to replay (end is inclusive in the URL)
     let start = parseInt(range['start']);
     let end = parseInt(range['end']);
-    if (end < 0){
-      end = results['logs'].length;
+    results = await wwai.api.streamLog(sessionId, start, end < 0 ? null : end + 1);
+    if (results['status'] == FAILURE) {
+      throw new Error(results['message']);
+    }
+    replayLogs = results['logs'];
+
+    // Reconstruct the document right before the start log
+    if (start > 0) {
+      const docAt = await wwai.api.getDocAt(sessionId, start);
+      if (docAt['status'] == SUCCESS) {
+        replayLogs[0].currentDoc = docAt['text'];
+      }
     }
-    replayLogs = results['logs'].slice(start, end + 1);
 
     await replay(replayLogs, start);
 
@@ -213,7 +237,7 @@ async function replayLogsWithSessionId(sessionId, range){
 async function showFinalStoryWithSessionId(sessionId){
   console.log('Final mode: logs with session ID: ' + sessionId);
   try {
-    results = await wwai.api.getLog(sessionId);
+    results = await wwai.api.getLogStats(sessionId);
   } catch (e) {
     alert('Could not find logs for the given session ID: ' + sessionId + '\n\n' + e);
     return;
@@ -224,11 +248,10 @@ async function showFinalStoryWithSessionId(sessionId){
     return;
   }
 
-  replayLogs = results['logs'];
-
-  lastLog = replayLogs[replayLogs.length - 1];
-  quill.setText(lastLog.currentDoc);
-  quill.setSelection(lastLog.currentCursor);
+  // Only the last text is needed, not the events
+  const lastText = results['last_text'] || '';  // Missing if stats could not be computed
+  quill.setText(lastText);
+  quill.setSelection(lastText.length);
 }
 
 async function loadLogsWithSessionId(newSessionId){
@@ -262,6 +285,7 @@ async function loadLogsWithSessionId(newSessionId){
     // Overwrite the current logs with loaded logs
     loadedLogs = results['logs'];
     logs = loadedLogs;
+    flushedLogCount = 0;  // The server skips logs it already has
 
     // Set the text editor to be the last state in the log
     const lastText = results['last_text'];
@@ -331,6 +355,11 @@ function getDataForQuery(doc, exampleText) {
 }
 
 function queryGPT3() {
+  if (useStreaming) {
+    queryGPT3Stream();
+    return;
+  }
+
   const doc = getText();
   const exampleText = exampleActualText;
   const data = getDataForQuery(doc, exampleText);
@@ -360,24 +389,178 @@ function queryGPT3() {
           addSuggestionsToDropdown(data.suggestions_with_probabilities);
           showDropdownMenu('api');
         } else {
-          let msg = 'Please try again!\n\n'
-                    + 'Why is this happening? The system\n'
-                    + '- could not think of suggestions (' + data.counts.empty_cnt + ')\n'
-                    + '- generated same suggestions as before (' + data.counts.duplicate_cnt + ')\n'
-                    + '- generated suggestions that contained banned words (' + data.counts.bad_cnt + ')\n';
-          console.log(msg);
-
-          logEvent(EventName.SUGGESTION_FAIL, EventSource.API, textDelta=msg);
-          alert("The system could not generate suggestions. Please try again.");
+          alertSuggestionFail(data.counts);
         }
 
       } else {
         alert(data.message);
       }
     },
-    error: function() {
+    error: function(xhr) {
       hideLoadingSignal();
+      if (xhr.status == 503 && xhr.responseJSON) {  // Busy; try again after a while
+        alert(xhr.responseJSON.message);
+        return;
+      }
       alert("Could not get suggestions. Press tab key to try again! If the problem persists, please send a screenshot of this message to " + contactEmail + ". Our sincere apologies for the inconvenience!");
     }
   });
 }
+
+function alertSuggestionFail(counts) {
+  let msg = 'Please try again!\n\n'
+            + 'Why is this happening? The system\n'
+            + '- could not think of suggestions (' + counts.empty_cnt + ')\n'
+            + '- generated same suggestions as before (' + counts.duplicate_cnt + ')\n'
+            + '- generated suggestions that contained banned words (' + counts.bad_cnt + ')\n';
+  console.log(msg);
+
+  logEvent(EventName.SUGGESTION_FAIL, EventSource.API, textDelta=msg);
+  alert("The system could not generate suggestions. Please try again.");
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// Streaming
+////////////////////////////////////////////////////////////////////////////////
+
+var streamController = null;
+
+async function queryGPT3Stream() {
+  const doc = getText();
+  const exampleText = exampleActualText;
+  const data = getDataForQuery(doc, exampleText);
+
+  // Stop showing suggestions for the previous query
+  if (streamController) {
+    streamController.abort();
+  }
+  const controller = new AbortController();
+  streamController = controller;
+
+  hideDropdownMenu(EventSource.API);
+  setCursorAtTheEnd();
+  showLoadingSignal('Getting suggestions...');
+
+  let numSuggestions = 0;
+  try {
+    const response = await fetch(serverURL + '/api/query_stream', {
+      method: 'POST',
+      headers: {'Content-Type': 'application/json; charset=utf-8'},
+      body: JSON.stringify(data),
+      signal: controller.signal,
+    });
+    if (response.status == 503) {  // Busy; try again after a while
+      hideLoadingSignal();
+      alert((await response.json()).message);
+      return;
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += decoder.decode(value, {stream: true});
+
+      // Handle each complete event (separated by a blank line)
+      let end = buffer.indexOf('\n\n');
+      while (end >= 0) {
+        const message = parseServerSentEvent(buffer.slice(0, end));
+        buffer = buffer.slice(end + 2);
+        end = buffer.indexOf('\n\n');
+
+        if (message.event == 'suggestion') {
+          if (numSuggestions == 0) {
+            hideLoadingSignal();
+            emptyDropdownMenu();
+            originalSuggestions = [];  // Not those of the previous query; set when done
+            appendSuggestionToDropdown(message.data);
+            showDropdownMenu('api');
+          } else if (isDropdownMenuOpen()) {  // Unless users closed it or selected one
+            appendSuggestionToDropdown(message.data);
+            positionDropdownMenu();
+          }
+          numSuggestions++;
+
+        } else if (message.event == 'done') {
+          hideLoadingSignal();
+          if (message.data.status == SUCCESS) {
+            originalSuggestions = message.data.original_suggestions;
+            if (numSuggestions == 0) {
+              alertSuggestionFail(message.data.counts);
+            } else {
+              // Suggestion-open only logged the first suggestion
+              logEvent(EventName.SUGGESTION_UPDATE, EventSource.API);
+            }
+          } else if (numSuggestions == 0) {
+            alert(message.data.message);
+          }
+        }
+      }
+    }
+  } catch (error) {
+    if (error.name == 'AbortError') {
+      return;
+    }
+    hideLoadingSignal();
+    if (numSuggestions == 0) {
+      alert("Could not get suggestions. Press tab key to try again! If the problem persists, please send a screenshot of this message to " + contactEmail + ". Our sincere apologies for the inconvenience!");
+    }
+  } finally {
+    if (streamController === controller) {
+      streamController = null;
+    }
+  }
+}
+
+function parseServerSentEvent(text) {
+  let event = 'message';
+  let data = '';
+  for (const line of text.split('\n')) {
+    if (line.startsWith('event: ')) {
+      event = line.slice('event: '.length);
+    } else if (line.startsWith('data: ')) {
+      data += line.slice('data: '.length);
+    }
+  }
+  return {event: event, data: JSON.parse(data)};
+}
+
+////////////////////////////////////////////////////////////////////////////////
+// Prefetch
+////////////////////////////////////////////////////////////////////////////////
+
+var prefetchTimer = null;
+
+function schedulePrefetch() {
+  if (!usePrefetch || !sessionId) {
+    return;
+  }
+
+  // Request suggestions only after users stop typing for prefetchDelay
+  clearTimeout(prefetchTimer);
+  prefetchTimer = setTimeout(prefetchGPT3, prefetchDelay);
+}
+
+function prefetchGPT3() {
+  const doc = getText();
+  const exampleText = exampleActualText;
+  const data = getDataForQuery(doc, exampleText);
+
+  $.ajax({
+    url: serverURL + '/api/prefetch',
+    type: 'POST',
+    dataType: 'json',
+    data: JSON.stringify(data),
+    crossDomain: true,
+    contentType: 'application/json; charset=utf-8',
+    error: function() {
+      if (debug) {
+        console.log('Could not prefetch suggestions');
+      }
+    }
+  });
+}
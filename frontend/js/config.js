@@ -7,6 +7,11 @@ const frontendURL = 'http://127.0.0.1:8000';
 var contactEmail = 'YOUR_EMAIL_ADDRESS';
 var isCounterEnabled = true;
 var sortSuggestions = true;
+var usePrefetch = false;  // Request suggestions in advance while users pause typing
+var prefetchDelay = 1000;  // Pause (in ms) before requesting suggestions in advance
+var useIncrementalLogging = true;  // Send logs to the server while users are writing
+var logFlushInterval = 10000;  // Interval (in ms) between sending logs
+var useStreaming = false;  // Show each suggestion as soon as it is generated
 
 /***************************************************************/
 /****** Session ************************************************/
@@ -58,6 +63,7 @@ const EventName = {
   SUGGESTION_GET: 'suggestion-get',
   SUGGESTION_OPEN: 'suggestion-open',
   SUGGESTION_REOPEN: 'suggestion-reopen',
+  SUGGESTION_UPDATE: 'suggestion-update',  // Streamed suggestions after the first one
   SUGGESTION_UP: 'suggestion-up',
   SUGGESTION_DOWN: 'suggestion-down',
   SUGGESTION_HOVER: 'suggestion-hover',
@@ -78,7 +84,7 @@ const ReplayableEvents = [
   EventName.SYSTEM_INITIALIZE,
   EventName.TEXT_INSERT, EventName.TEXT_DELETE,
   EventName.CURSOR_FORWARD, EventName.CURSOR_BACKWARD, EventName.CURSOR_SELECT,
-  EventName.SUGGESTION_GET, EventName.SUGGESTION_OPEN, EventName.SUGGESTION_REOPEN,
+  EventName.SUGGESTION_GET, EventName.SUGGESTION_OPEN, EventName.SUGGESTION_REOPEN, EventName.SUGGESTION_UPDATE,
   EventName.SUGGESTION_UP, EventName.SUGGESTION_DOWN, EventName.SUGGESTION_HOVER,
   EventName.SUGGESTION_SELECT, EventName.SUGGESTION_CLOSE,
 ];
@@ -87,6 +87,18 @@ function addSuggestionsToDropdown(suggestions_with_probabilities) {
   currentIndex = 0;
 }
 
+function appendSuggestionToDropdown(suggestion_with_probability) {
+  // Keep the order in which suggestions arrive (not sorted while users read them)
+  addToDropdownMenu(suggestion_with_probability);
+
+  items = $('.dropdown-item');
+  numItems = items.length;
+}
+
+function isDropdownMenuOpen() {
+  return $('#frontend-overlay').length && !$('#frontend-overlay').hasClass('hidden');
+}
+
 function showDropdownMenu(source, is_reopen=false) {
   // Check if there are entries in the dropdown menu
   if ($('#frontend-overlay').children().length == 0) {
@@ -98,97 +110,100 @@ function showDropdownMenu(source, is_reopen=false) {
     return;
   }
   else {
-    // Compute offset
-    let offsetTop = $('#editor-view').offset().top;
-    let offsetLeft = $('#editor-view').offset().left;
-    let offsetBottom = $('footer').offset().top;
-
-    let position = quill.getBounds(getText().length);
-    let top = offsetTop + position.top + 60 + 40;  // + Height of toolbar + line height
-    let left = offsetLeft + position.left;
-
-    // Fit frontend-overlay to the contents
-    let maxWidth = 0;
-    let totalHeight = 0;
-    let finalWidth = 0;
-    $(".dropdown-item").each(function(){
-        width = $(this).outerWidth(true);
-        height = $(this).outerHeight(true);
-
-        if (width > maxWidth) {
-          maxWidth = width;
-        }
-        totalHeight = totalHeight + height;
-    });
-    finalWidth = Math.min(maxWidth, $('#editor-view').outerWidth(true));
-
-    let rightmost = left + maxWidth;
-    let bottommost = top + totalHeight;
+    positionDropdownMenu();
 
-    let width_overflow = rightmost > $("#editor-view").width();
-    // Push it left if it goes outside of the frontend
-    if (width_overflow) {
-      left = offsetLeft + 30;  // 30px for padding
+    // Auto-select the first suggestion
+    if (domain != 'story') {
+      $('#frontend-overlay > .dropdown-item').first().addClass('sudo-hover');
     }
 
-    // Decide whether or not to move up the dropdown
-    const bodyHeight = $('body').outerHeight(true);
-    let moveUpDropdown = false;
 
-    if (bottommost < ($("#editor-view").height() + 100)) {  // If it doesn't go over footer, no need to move up
-    } else {  // If it does go over footer, then see whether moving up is easier
-      if (top > (bodyHeight / 2)){
-        moveUpDropdown = true;
-      }
-    }
+    openDropdownMenu(source, is_reopen);
+  }
 
-    if (moveUpDropdown) {
-      console.log('$("#editor-view").height(): ' + $("#editor-view").height());
-      console.log('top: ' + top);
-      console.log('offsetTop: ' + offsetTop);
-      console.log('totalHeight: ' + totalHeight);
 
-      // Adjust height
-      var maxHeight = top - 100;
-      if (totalHeight > maxHeight) {
-        totalHeight = maxHeight;
+}
+
+function positionDropdownMenu() {
+  // Compute offset
+  let offsetTop = $('#editor-view').offset().top;
+  let offsetLeft = $('#editor-view').offset().left;
+  let offsetBottom = $('footer').offset().top;
+
+  let position = quill.getBounds(getText().length);
+  let top = offsetTop + position.top + 60 + 40;  // + Height of toolbar + line height
+  let left = offsetLeft + position.left;
+
+  // Fit frontend-overlay to the contents
+  let maxWidth = 0;
+  let totalHeight = 0;
+  let finalWidth = 0;
+  $(".dropdown-item").each(function(){
+      width = $(this).outerWidth(true);
+      height = $(this).outerHeight(true);
+
+      if (width > maxWidth) {
+        maxWidth = width;
       }
+      totalHeight = totalHeight + height;
+  });
+  finalWidth = Math.min(maxWidth, $('#editor-view').outerWidth(true));
 
-      // Set top
-      top = top - totalHeight - 60;
+  let rightmost = left + maxWidth;
+  let bottommost = top + totalHeight;
 
-    } else {
-      // Set top
-      top = top;
+  let width_overflow = rightmost > $("#editor-view").width();
+  // Push it left if it goes outside of the frontend
+  if (width_overflow) {
+    left = offsetLeft + 30;  // 30px for padding
+  }
 
-      // Adjust height
-      var maxHeight = $("#editor-view").height() - offsetTop - position.top + 60;
-      if (maxHeight < 100) {
-        maxHeight = 100;
-      }
+  // Decide whether or not to move up the dropdown
+  const bodyHeight = $('body').outerHeight(true);
+  let moveUpDropdown = false;
 
-      if (totalHeight > maxHeight){
-        totalHeight = maxHeight;
-      }
+  if (bottommost < ($("#editor-view").height() + 100)) {  // If it doesn't go over footer, no need to move up
+  } else {  // If it does go over footer, then see whether moving up is easier
+    if (top > (bodyHeight / 2)){
+      moveUpDropdown = true;
+    }
+  }
+
+  if (moveUpDropdown) {
+    console.log('$("#editor-view").height(): ' + $("#editor-view").height());
+    console.log('top: ' + top);
+    console.log('offsetTop: ' + offsetTop);
+    console.log('totalHeight: ' + totalHeight);
 
+    // Adjust height
+    var maxHeight = top - 100;
+    if (totalHeight > maxHeight) {
+      totalHeight = maxHeight;
     }
 
-    // Set top and left
-    $('#frontend-overlay').css({
-      top: top,
-      left: left,
-      height: totalHeight,
-    });
+    // Set top
+    top = top - totalHeight - 60;
 
+  } else {
+    // Set top
+    top = top;
 
-    // Auto-select the first suggestion
-    if (domain != 'story') {
-      $('#frontend-overlay > .dropdown-item').first().addClass('sudo-hover');
+    // Adjust height
+    var maxHeight = $("#editor-view").height() - offsetTop - position.top + 60;
+    if (maxHeight < 100) {
+      maxHeight = 100;
     }
 
+    if (totalHeight > maxHeight){
+      totalHeight = maxHeight;
+    }
 
-    openDropdownMenu(source, is_reopen);
   }
 
-
+  // Set top and left
+  $('#frontend-overlay').css({
+    top: top,
+    left: left,
+    height: totalHeight,
+  });
 }
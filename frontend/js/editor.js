@@ -25,6 +25,10 @@ function trackTextChanges(){
       }
       logEvent(eventName, eventSource, textDelta=delta);
 
+      if (eventSource == EventSource.USER) {
+        schedulePrefetch();
+      }
+
       if (isCounterEnabled == true) {
         updateCounter();
       }
@@ -1,4 +1,7 @@
 var logs = [];  // Save all activity logs
+var flushedLogCount = 0;  // Number of logs sent to the server
+var flushPromise = null;
+var flushTimer = null;
 
 function getSuggestionState(){
   // TODO Overwite for different output interfaces
@@ -78,7 +81,7 @@ function logEvent(eventName, eventSource, textDelta='', cursorRange=''){
     log['currentDoc'] = quill.getContents()['ops'][0]['insert'];
   }
 
-  if (eventName == EventName.SUGGESTION_OPEN) {
+  if (eventName == EventName.SUGGESTION_OPEN || eventName == EventName.SUGGESTION_UPDATE) {
     log['currentSuggestions'] = getSuggestionState();
     log['originalSuggestions'] = getOriginalSuggestions();
   }
@@ -93,6 +96,39 @@ function logEvent(eventName, eventSource, textDelta='', cursorRange=''){
   }
 }
 
+async function flushLogs() {
+  // Wait for the previous request so that logs are sent in order
+  while (flushPromise) {
+    await flushPromise;
+  }
+  if (!sessionId || flushedLogCount >= logs.length) {
+    return;
+  }
+
+  flushPromise = (async function() {
+    try {
+      const results = await wwai.api.appendLog(sessionId, flushedLogCount, logs.slice(flushedLogCount));
+      if ('next_seq' in results) {
+        flushedLogCount = results['next_seq'];  // The server skips logs it already has
+      }
+    } catch (e) {
+      console.log('Could not send logs:', e);
+    }
+  })();
+  await flushPromise;
+  flushPromise = null;
+}
+
+function startFlushingLogs() {
+  flushedLogCount = 0;
+  flushTimer = setInterval(flushLogs, logFlushInterval);
+}
+
+function stopFlushingLogs() {
+  clearInterval(flushTimer);
+  flushTimer = null;
+}
+
 function showLog(replayLog) {
   if (debug) {
     console.log(replayLog.eventName);
@@ -151,6 +187,15 @@ function showLog(replayLog) {
       case EventName.SUGGESTION_REOPEN:
         showDropdownMenu(replayLog.eventSource, is_reopen=true);
         break;
+      case EventName.SUGGESTION_UPDATE:
+        if (isDropdownMenuOpen()) {
+          emptyDropdownMenu();
+          for (const suggestion of replayLog.currentSuggestions) {
+            appendSuggestionToDropdown(suggestion);  // In the order they arrived
+          }
+          positionDropdownMenu();
+        }
+        break;
       case EventName.SUGGESTION_UP:
         $('.dropdown-item').removeClass('sudo-hover');
 
@@ -37,12 +37,21 @@ window.wwai = window.wwai || {};
     }
   };
 
-  wwai.api.endSession = async function(sessionId, logs) {
-    try {
-      const results = await serverFetch("end_session", {
+  wwai.api.endSession = async function(sessionId, logs, numLogs) {
+    // If logs is null, the server finalizes the logs sent by appendLog
+    let args = {
+      'sessionId': sessionId,
+      'logs': logs,
+    };
+    if (logs === null) {
+      args = {
         'sessionId': sessionId,
-        'logs': logs,
-      });
+        'numLogs': numLogs,
+      };
+    }
+
+    try {
+      const results = await serverFetch("end_session", args);
       return results;
     } catch (e) {
       alert('Oops, we had an error saving your writing session! Please share a screenshot of this message with ' + contactEmail + ' to help us fix the problem. Our sincere apologies for the inconvenience!\n\n' + e);
@@ -50,6 +59,15 @@ window.wwai = window.wwai || {};
     }
   };
 
+  wwai.api.appendLog = async function(sessionId, seq, logs) {
+    const results = await serverFetch("append_log", {
+      'sessionId': sessionId,
+      'seq': seq,
+      'logs': logs,
+    });
+    return results;
+  };
+
   wwai.api.saveLog = async function() {
     console.log('[wwai.api.saveLog] sessionId:' + sessionId);
     console.log('[wwai.api.saveLog] logs.length:' + logs.length);
@@ -61,6 +79,14 @@ window.wwai = window.wwai || {};
     return results;
   };
 
+  wwai.api.getDocAt = async function(replaySessionId, eventIndex) {
+    const results = await serverFetch("get_doc_at", {
+      'sessionId': replaySessionId,
+      'eventIndex': eventIndex,
+    });
+    return results;
+  };
+
   wwai.api.getLog = async function(replaySessionId) {
     const results = await serverFetch("get_log", {
       'sessionId': replaySessionId,
@@ -68,4 +94,55 @@ window.wwai = window.wwai || {};
     });
     return results;
   };
+
+  wwai.api.getLogStats = async function(replaySessionId) {
+    const results = await serverFetch("get_log_stats", {
+      'sessionId': replaySessionId,
+    });
+    return results;
+  };
+
+  wwai.api.streamLog = async function(replaySessionId, start, end) {
+    // Read events in [start, end) as the server sends them (end is null for all events)
+    const response = await fetch(getUrl("stream_log"), {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json"
+      },
+      body: JSON.stringify({
+        'sessionId': replaySessionId,
+        'start': start,
+        'end': end,
+      })
+    });
+    if (!response.ok) {
+      throw new Error(await response.text());
+    }
+
+    // The first line is the results, followed by a line for each event
+    let results = null;
+    const logs = [];
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+      const {value, done} = await reader.read();
+      if (done) {
+        break;
+      }
+      buffer += decoder.decode(value, {stream: true});
+
+      const lines = buffer.split('\n');
+      buffer = lines.pop();  // Incomplete line
+      for (const line of lines) {
+        if (results === null) {
+          results = JSON.parse(line);
+        } else {
+          logs.push(JSON.parse(line));
+        }
+      }
+    }
+    results['logs'] = logs;
+    return results;
+  };
 })(window.wwai);